@@ -0,0 +1,451 @@
+################################################################
+#  Module: baccum.py
+#  Desc  : Provides bounded-memory accumulation of B-matrix
+#          entries (B, I, J) found by thresholding
+################################################################
+import numpy as np
+import sys
+import threading
+
+
+class BBudget:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. A byte budget shared by accumulators, e.g.
+    #          those of several threads, reserved & released under a
+    #          lock
+    #  Args  : maxbytes(in): cap on bytes held (0 = no cap)
+    # Returns: none
+    ################################################################
+    def __init__(self, maxbytes=0):
+
+        self.maxbytes_ = int(maxbytes)
+        self.used_     = 0
+        self.lock_     = threading.Lock()
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: reserve
+    #  Desc  : Reserve up to nbytes, in whole items of itemsz bytes
+    #  Args  : nbytes : bytes wanted
+    #          itemsz : bytes per item
+    # Returns: number of bytes reserved; less than nbytes, possibly 0,
+    #          if the cap is reached
+    ################################################################
+    def reserve(self, nbytes, itemsz=1):
+
+        with self.lock_:
+          if self.maxbytes_ > 0:
+            nbytes = min(nbytes, ((self.maxbytes_ - self.used_)//itemsz)*itemsz)
+          nbytes = max(nbytes, 0)
+          self.used_ += nbytes
+
+        return nbytes  # end, reserve method
+
+
+    ################################################################
+    #  Method: room
+    #  Desc  : Bytes not reserved yet
+    #  Args  : none
+    # Returns: number of bytes (None if no cap)
+    ################################################################
+    def room(self):
+
+        if self.maxbytes_ <= 0:
+          return None
+
+        return self.maxbytes_ - self.used_  # end, room method
+
+
+    ################################################################
+    #  Method: release
+    #  Desc  : Release bytes reserved
+    #  Args  : nbytes : bytes released
+    # Returns: none
+    ################################################################
+    def release(self, nbytes):
+
+        with self.lock_:
+          self.used_ -= nbytes
+
+        return # end, release method
+
+
+
+class BAccum:
+
+    minchunk_ = 4096            # entries in first storage chunk
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor
+    #  Args  : dtype   (in): numpy float type of B entries
+    #          chunksz (in): max number of entries per storage chunk
+    #          maxbytes(in): cap on bytes held by accumulator (0 = no cap)
+    #          budget  (in): BBudget shared with other accumulators
+    #                        (None: own budget of maxbytes)
+    # Returns: none
+    ################################################################
+    def __init__(self, dtype, chunksz=1048576, maxbytes=0, budget=None):
+
+        assert chunksz > 0, "Invalid chunk size"
+        self.dtype_    = np.dtype(dtype)
+        self.chunksz_  = int(chunksz)
+        self.budget_   = budget if budget is not None else BBudget(maxbytes)
+        self.maxbytes_ = self.budget_.maxbytes_
+        self.entsz_    = self.dtype_.itemsize + 2*np.dtype(np.int64).itemsize
+        self.chunks_   = []
+
+        self.reset()
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: reset
+    #  Desc  : Discard all accumulated entries, and release storage
+    #  Args  : none
+    # Returns: none
+    ################################################################
+    def reset(self):
+
+        self.budget_.release(self.nbytes())
+        self.chunks_ = []   # list of [B, I, J] chunk arrays
+        self.fills_  = []   # number of entries filled in each chunk
+        self.n_      = 0    # total number of entries
+
+        return # end, reset method
+
+
+    ################################################################
+    #  Method: size
+    #  Desc  : Number of entries accumulated
+    #  Args  : none
+    # Returns: number of entries
+    ################################################################
+    def size(self):
+
+        return self.n_  # end, size method
+
+
+    ################################################################
+    #  Method: nbytes
+    #  Desc  : Bytes of storage currently held by accumulator
+    #  Args  : none
+    # Returns: number of bytes
+    ################################################################
+    def nbytes(self):
+
+        return sum([len(c[0]) for c in self.chunks_])*self.entsz_  # end, nbytes method
+
+
+    ################################################################
+    #  Method: append
+    #  Desc  : Add entries to accumulator. Storage grows a chunk
+    #          at a time, so it stays sized to the number of entries
+    #          actually found.
+    #  Args  : B    : covariances
+    #          I, J : global row, column indices of B. Each of
+    #                 same length as B
+    # Returns: none
+    ################################################################
+    def append(self, B, I, J):
+
+        n = len(B)
+        assert len(I)==n and len(J)==n, "Inconsistent B, I, J sizes"
+
+        i0 = 0
+        while i0 < n:
+          if len(self.chunks_) == 0 or self.fills_[-1] == len(self.chunks_[-1][0]):
+            self.add_chunk(n-i0)
+          chunk = self.chunks_[-1]
+          nfill = self.fills_[-1]
+          m  = min(n-i0, len(chunk[0])-nfill)
+          chunk[0][nfill:nfill+m] = B[i0:i0+m]
+          chunk[1][nfill:nfill+m] = I[i0:i0+m]
+          chunk[2][nfill:nfill+m] = J[i0:i0+m]
+          self.fills_[-1] += m
+          i0              += m
+
+        self.n_ += n
+
+        return # end, append method
+
+
+    ################################################################
+    #  Method: spawn
+    #  Desc  : Create an empty accumulator like this one, e.g. for use
+    #          by one of several threads, to be merged later. The
+    #          memory cap is shared with this accumulator, so that
+    #          it bounds the entries held by all of them together
+    #  Args  : nparts  : unused; for compatibility with BWidths
+    # Returns: new BAccum
+    ################################################################
+    def spawn(self, nparts=1):
+
+        return BAccum(self.dtype_, self.chunksz_, budget=self.budget_)  # end, spawn method
+
+
+    ################################################################
+    #  Method: merge
+    #  Desc  : Append all entries of another accumulator to this one,
+    #          by taking over its storage chunks, without copying.
+    #          The other accumulator is emptied.
+    #  Args  : other   : BAccum to merge
+    # Returns: none
+    ################################################################
+    def merge(self, other):
+
+        assert other.dtype_ == self.dtype_, "Inconsistent B types"
+        nbytes = other.nbytes()
+        if other.budget_ is not self.budget_:
+          other.budget_.release(nbytes)
+          if self.budget_.reserve(nbytes) < nbytes:
+            self.cap_exceeded()
+        self.chunks_ += other.chunks_
+        self.fills_  += other.fills_
+        self.n_      += other.n_
+        other.chunks_ = []
+        other.reset()
+
+        return # end, merge method
+
+
+    ################################################################
+    #  Method: add_chunk
+    #  Desc  : Allocate new storage chunk. Chunks double in size, from
+    #          a small first chunk, up to chunksz entries. Under a cap,
+    #          a chunk takes at most half the room left, unless more
+    #          is needed, and is cut to fit the room, so that the cap
+    #          is exceeded only by entries actually found, and room is
+    #          left for accumulators sharing the cap
+    #  Args  : need   : number of entries to be stored
+    # Returns: none
+    ################################################################
+    def add_chunk(self, need=1):
+
+        n    = min(self.chunksz_, max(BAccum.minchunk_, self.n_))
+        room = self.budget_.room()
+        if room is not None:
+          n  = min(n, max(room//self.entsz_//2, need))
+        nbytes = self.budget_.reserve(n*self.entsz_, self.entsz_)
+        if nbytes == 0:
+          self.cap_exceeded()
+        n    = nbytes//self.entsz_
+
+        self.chunks_.append([np.empty(n, dtype=self.dtype_),
+                             np.empty(n, dtype=np.int64),
+                             np.empty(n, dtype=np.int64)])
+        self.fills_.append(0)
+
+        return # end, add_chunk method
+
+
+    ################################################################
+    #  Method: cap_exceeded
+    #  Desc  : Abort, the memory cap being exceeded
+    #  Args  : none
+    # Returns: none
+    ################################################################
+    def cap_exceeded(self):
+
+        sys.exit("Error, BAccum memory cap exceeded (" + str(self.maxbytes_) \
+               + " bytes); raise cap or threshold!")  # end, cap_exceeded method
+
+
+    ################################################################
+    #  Method: get
+    #  Desc  : Return all accumulated entries as contiguous arrays,
+    #          in the order in which they were appended. Chunks are
+    #          released as they are copied, so the accumulator is
+    #          empty on return
+    #  Args  : none
+    # Returns: B    : covariances
+    #          I, J : global row, column indices of B
+    ################################################################
+    def get(self):
+
+        B = np.empty(self.n_, dtype=self.dtype_)
+        I = np.empty(self.n_, dtype=np.int64)
+        J = np.empty(self.n_, dtype=np.int64)
+
+        i0 = 0
+        for k in range(0, len(self.chunks_)):
+          m = self.fills_[k]
+          B[i0:i0+m] = self.chunks_[k][0][0:m]
+          I[i0:i0+m] = self.chunks_[k][1][0:m]
+          J[i0:i0+m] = self.chunks_[k][2][0:m]
+          self.budget_.release(len(self.chunks_[k][0])*self.entsz_)
+          self.chunks_[k] = [np.empty(0)]
+          i0 += m
+        self.reset()
+
+        return B, I, J  # end, get method
+
+
+    ################################################################
+    #  Method: state
+    #  Desc  : Return copy of accumulated entries, e.g. for 
+    #          checkpointing, leaving accumulator unchanged
+    #  Args  : since : number of entries, first appended, left out
+    #                  (e.g. those of an earlier checkpoint)
+    # Returns: dict of arrays B, I, J
+    ################################################################
+    def state(self, since=0):
+
+        s = {}
+        for (k, name) in enumerate(('B', 'I', 'J')):
+          (parts, i0) = ([], 0)
+          for c in range(0, len(self.chunks_)):
+            m  = self.fills_[c]
+            if i0 + m > since:
+              parts.append(self.chunks_[c][k][max(since-i0, 0):m])
+            i0 += m
+          s[name] = np.concatenate(parts) if len(parts) > 0 \
+                    else np.empty(0, dtype=(self.dtype_ if k == 0 else np.int64))
+
+        return s  # end, state method
+
+
+    ################################################################
+    #  Method: restore
+    #  Desc  : Replace accumulated entries with those of a saved state
+    #  Args  : s    : dict of arrays, from state
+    # Returns: none
+    ################################################################
+    def restore(self, s):
+
+        self.reset()
+        self.append(s['B'], s['I'], s['J'])
+
+        return # end, restore method
+
+
+
+class BWidths:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Accumulates, for each of a range of
+    #          B-matrix rows, the min and max column index, and the
+    #          number of entries meeting threshold, without storing
+    #          the entries themselves
+    #  Args  : nrows   (in): number of rows tracked
+    #          row0    (in): ordinal of first row tracked
+    # Returns: none
+    ################################################################
+    def __init__(self, nrows, row0=0):
+
+        self.row0_  = int(row0)
+        self.jmin_  = np.full(nrows, np.iinfo(np.int64).max, dtype=np.int64)
+        self.jmax_  = np.full(nrows, -1, dtype=np.int64)
+        self.count_ = np.zeros(nrows, dtype=np.int64)
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: update
+    #  Desc  : Update row extents and counts from a thresholded tile
+    #  Args  : mask  : boolean tile, True where entry meets threshold
+    #          r0    : row ordinal of first row of mask
+    #          cgidx : global column indices of mask columns, assumed
+    #                  in increasing order
+    # Returns: number of entries in mask meeting threshold
+    ################################################################
+    def update(self, mask, r0, cgidx):
+
+        nc   = mask.shape[1]
+        cnt  = np.count_nonzero(mask, axis=1)
+        has  = np.nonzero(cnt)[0]
+        if len(has) == 0:
+          return 0
+
+        # Columns are sorted, so first & last hits give extents:
+        first = mask.argmax(axis=1)[has]
+        last  = nc - 1 - mask[:,::-1].argmax(axis=1)[has]
+        rows  = r0 - self.row0_ + has
+        self.jmin_ [rows] = np.minimum(self.jmin_[rows], cgidx[first])
+        self.jmax_ [rows] = np.maximum(self.jmax_[rows], cgidx[last])
+        self.count_[rows] += cnt[has]
+
+        return int(cnt.sum())  # end, update method
+
+
+    ################################################################
+    #  Method: spawn
+    #  Desc  : Create an empty accumulator tracking the same rows as
+    #          this one, e.g. for use by one of several threads, to be
+    #          merged later
+    #  Args  : nparts  : unused; for compatibility with BAccum
+    # Returns: new BWidths
+    ################################################################
+    def spawn(self, nparts=1):
+
+        return BWidths(len(self.jmin_), self.row0_)  # end, spawn method
+
+
+    ################################################################
+    #  Method: merge
+    #  Desc  : Combine row data of another accumulator of the same
+    #          rows into this one
+    #  Args  : other   : BWidths to merge
+    # Returns: none
+    ################################################################
+    def merge(self, other):
+
+        assert other.row0_ == self.row0_ and len(other.jmin_) == len(self.jmin_)
+        np.minimum(self.jmin_, other.jmin_, out=self.jmin_)
+        np.maximum(self.jmax_, other.jmax_, out=self.jmax_)
+        self.count_ += other.count_
+
+        return # end, merge method
+
+
+    ################################################################
+    #  Method: get
+    #  Desc  : Return accumulated row data
+    #  Args  : none
+    # Returns: Jmin, Jmax: min & max column index in each row; rows
+    #                      with no entries have Jmin = max int64,
+    #                      Jmax = -1
+    #          count     : number of entries in each row
+    ################################################################
+    def get(self):
+
+        return self.jmin_, self.jmax_, self.count_  # end, get method
+
+
+    ################################################################
+    #  Method: state
+    #  Desc  : Return copy of accumulated row data, e.g. for 
+    #          checkpointing
+    #  Args  : since : unused; for compatibility with BAccum (row data
+    #                  are always whole)
+    # Returns: dict of arrays jmin, jmax, count
+    ################################################################
+    def state(self, since=0):
+
+        return {'jmin' : self.jmin_.copy(), 
+                'jmax' : self.jmax_.copy(), 
+                'count': self.count_.copy()}  # end, state method
+
+
+    ################################################################
+    #  Method: restore
+    #  Desc  : Replace accumulated row data with that of a saved state
+    #  Args  : s    : dict of arrays, from state
+    # Returns: none
+    ################################################################
+    def restore(self, s):
+
+        assert len(s['jmin']) == len(self.jmin_), "Inconsistent row count"
+        self.jmin_ [:] = s['jmin']
+        self.jmax_ [:] = s['jmax']
+        self.count_[:] = s['count']
+
+        return # end, restore method
+
@@ -0,0 +1,415 @@
+################################################################
+#  Module: banalyze.py
+#  Desc  : Provides an importable B-matrix analysis API: ribbon
+#          widths, and their statistics, of ensemble data, computed
+#          in process and returned as arrays. BTools instances, and
+#          their buffers, are reused across analyses; netCDF4 and
+#          MPI are imported on first use.
+#
+#          Usage (collective over comm):
+#            from banalyze import analyze
+#            R = analyze("Tmerged17.nc", [0.9, 0.95], varname="T",
+#                        decfact=8, widthsonly=True)
+#            R.maxWidth_, R.gwidths_[0], ...
+################################################################
+import numpy as np
+import sys
+import time
+from   btimer import BTimer
+
+
+class BRibbonResult:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Results of one analysis. Quantities for
+    #          each threshold are indexed as thresholds
+    #  Args  : thresholds(in): list of corr coeff thresholds
+    #          nens      (in): number of ensemble members
+    #          gdims     (in): global grid dims, (Nz, Ny, Nx)
+    # Returns: none
+    ################################################################
+    def __init__(self, thresholds, nens, gdims):
+
+        n = len(thresholds)
+        self.thresholds_ = list(thresholds)
+        self.nens_       = nens
+        self.gdims_      = gdims
+        self.counts_     = np.zeros(n, dtype=np.int64) # global no. entries meeting threshold
+        self.maxWidth_   = np.zeros(n, dtype=np.int64) # max ribbon width
+        self.irowmax_    = np.zeros(n, dtype=np.int64) # global row of max ribbon width
+        self.avgWidth_   = np.zeros(n)                 # avg of nonzero widths
+        self.avgWidth1_  = np.zeros(n)                 # avg of nonzero widths, no outliers
+        self.rows_       = None     # global indices of this task's rows
+        self.widths_     = []       # widths of this task's rows (< 0: no entries)
+        self.gwidths_    = []       # global widths (0: no entries), on root; else None
+        self.samples_    = []       # sampled estimates (see BTools.sampleStats)
+        self.B_          = None     # this task's B entries, and their I,J locations
+        self.I_          = None     #   (single threshold, B stored only)
+        self.J_          = None
+        self.ntrunc_     = 0        # rows truncated at maxdist, in banded search
+        self.nstop_      = 0        # rows stopped for patience, in banded search
+        self.elapsed_    = 0.0      # analysis time (s), max over tasks
+        self.timer_      = None     # phase timers of analysis
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: stats
+    #  Desc  : Ribbon width statistics for a threshold, as returned
+    #          by BTools.widthStats
+    #  Args  : it     : threshold index
+    # Returns: maxWidth, irowmax, avgWidth, avgWidth1
+    ################################################################
+    def stats(self, it):
+
+        return int(self.maxWidth_[it]), int(self.irowmax_[it]), \
+               float(self.avgWidth_[it]), float(self.avgWidth1_[it])  # end, stats method
+
+
+class BAnalyzer:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Settings are those of bmata, and apply
+    #          to all analyses; the BTools instance of an analysis is
+    #          kept, and reused by following analyses of data of the
+    #          same dims
+    #  Args  : comm     (in): communicator (None: MPI.COMM_WORLD)
+    #          decfact  (in): decimation factor in x, y (file sources)
+    #          levels   (in): vertical levels (file sources; None: first)
+    #          levchunk (in): levels streamed per chunk (file sources;
+    #                         0: all)
+    #          tilesz, maxmem, exchange, symmetric, nthreads, scratch,
+    #          window, decomp, band, patience, maxdist, ckptdir,
+    #          ckptint  (in): as for BTools; maxmem, window in bytes
+    #          widthsonly(in): compute widths only; no B stored
+    #          cachedir (in): slab cache dir; slabs are read, and
+    #                         cached, standardized (None: no cache)
+    #          sample   (in): fraction of rows sampled (0: all)
+    #          seed     (in): random seed for sampling
+    #          gather   (in): gather global widths on task 0
+    #          debug    (in): print debug info
+    # Returns: none
+    ################################################################
+    def __init__(self, comm=None, decfact=1, levels=None, levchunk=0, tilesz=512, maxmem=0,
+                 exchange='allgather', symmetric=False, widthsonly=False, nthreads=1,
+                 scratch=None, window=0, decomp='x', cachedir=None, sample=0.0, seed=0,
+                 band=0, patience=2, maxdist=0, ckptdir=None, ckptint=600, gather=True,
+                 debug=False):
+
+        if comm is None:
+          from bcomm import MPI
+          comm = MPI.COMM_WORLD
+        self.comm_       = comm
+        self.rank_       = comm.Get_rank()
+        self.nprocs_     = comm.Get_size()
+        self.decfact_    = decfact
+        self.levels_     = levels
+        self.levchunk_   = levchunk
+        self.tilesz_     = tilesz
+        self.maxmem_     = maxmem
+        self.exchange_   = exchange
+        self.symmetric_  = symmetric
+        self.widthsonly_ = widthsonly
+        self.nthreads_   = nthreads
+        self.scratch_    = scratch
+        self.window_     = window
+        self.decomp_     = decomp
+        self.cachedir_   = cachedir
+        self.sample_     = sample
+        self.seed_       = seed
+        self.band_       = band
+        self.patience_   = patience
+        self.maxdist_    = maxdist
+        self.ckptdir_    = ckptdir
+        self.ckptint_    = ckptint
+        self.gather_     = gather
+        self.debug_      = debug
+        self.tools_      = None     # BTools of last analysis
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: tools
+    #  Desc  : Get BTools instance for data of given dims, reusing
+    #          that of the last analysis if dims match
+    #  Args  : nens   : number of ensemble members
+    #          gdims  : global grid dims, (Nz, Ny, Nx)
+    #          timer  : BTimer for phases of analysis
+    # Returns: BTools instance
+    ################################################################
+    def tools(self, nens, gdims, timer):
+
+        import btools
+        from   bcomm import MPI
+
+        T = self.tools_
+        if T is None or T.nens_ != nens or list(T.gn_) != list(gdims):
+          self.tools_ = T = None      # release buffers first
+          T = btools.BTools(self.comm_, MPI.FLOAT, nens, gdims, self.debug_, self.tilesz_,
+                            self.maxmem_, self.exchange_, self.symmetric_, self.nthreads_,
+                            self.scratch_, self.window_, timer, self.decomp_, self.band_,
+                            self.patience_, self.maxdist_, self.ckptdir_, self.ckptint_,
+                            self.levchunk_)
+          self.tools_ = T
+        T.timer_ = timer
+
+        return T  # end, tools method
+
+
+    ################################################################
+    #  Method: dims
+    #  Desc  : Get dims of an ensemble variable in a file, as read
+    #          by this analyzer. Collective.
+    #  Args  : filename : input file name
+    #          varname  : ensemble variable name
+    # Returns: (nens, ntimes, gdims)
+    ################################################################
+    def dims(self, filename, varname):
+
+        import btools
+
+        d = None
+        if self.rank_ == 0:
+          d = btools.BTools.getDims(filename, varname, self.decfact_, self.levels_)
+
+        return self.comm_.bcast(d, root=0)  # end, dims method
+
+
+    ################################################################
+    #  Method: read
+    #  Desc  : Read this task's data of an ensemble variable. With
+    #          comm None, the task reads alone, making no MPI calls
+    #          (e.g. to prefetch data off the main thread)
+    #  Args  : filename : input file name
+    #          varname  : ensemble variable name
+    #          itime    : time index
+    #          timer    : BTimer for read phases (None: not timed)
+    #          comm     : communicator for parallel open, or None
+    #          klev     : (kb, ke) range of grid levels to read (None:
+    #                     all)
+    # Returns: (N, nens, gdims), as BTools.getSlabData; with a cache,
+    #          N is (Z, sd), of the standardized slab
+    ################################################################
+    def read(self, filename, varname, itime, timer=None, comm=None, klev=None):
+
+        import btools
+
+        return btools.BTools.getSlabData(filename, varname, itime, self.nprocs_, self.rank_, 2,
+                                         self.decfact_, comm, timer, self.decomp_, self.cachedir_,
+                                         self.levels_, klev, self.cachedir_ is not None)  # end, read method
+
+
+    ################################################################
+    #  Method: source
+    #  Desc  : Get this task's data, and its dims, from a data source
+    #  Args  : source   : input file name; or (N, nens, gdims), as
+    #                     returned by read; or this task's data array,
+    #                     N(nens, npts), with gdims given; or (reader,
+    #                     nens, gdims), with reader(kb, ke) returning
+    #                     the task's flattened data on grid levels
+    #                     kb..ke, for streamed levels
+    #          varname  : ensemble variable name (file sources)
+    #          itime    : time index (file sources)
+    #          gdims    : global grid dims (array sources)
+    #          timer    : BTimer for read phases
+    # Returns: (x, nens, gdims); x is flattened data, or (Z, sd) of
+    #          it standardized, or a reader
+    ################################################################
+    def source(self, source, varname, itime, gdims, timer):
+
+        if isinstance(source, str):
+          if varname is None:
+            sys.exit("Error, variable name required with file source!")
+          if self.levchunk_ > 0:
+            (nens, ntimes, gdims) = self.dims(source, varname)
+            reader = lambda kb, ke: self.flatten( \
+                       self.read(source, varname, itime, timer, None, (kb, ke))[0])
+            return reader, nens, gdims
+          source = self.read(source, varname, itime, timer, self.comm_)
+        elif not isinstance(source, tuple):
+          if gdims is None:
+            sys.exit("Error, grid dims required with array source!")
+          source = (source, np.shape(source)[0], gdims)
+
+        (N, nens, gdims) = source
+        if callable(N):
+          return N, nens, gdims
+
+        return self.flatten(N), nens, gdims  # end, source method
+
+
+    ################################################################
+    #  Method: flatten
+    #  Desc  : Flatten data, without a copy if possible; standardized
+    #          data, (Z, sd), are used as they are
+    #  Args  : N        : data array, or (Z, sd)
+    # Returns: flattened float32 data, or (Z, sd)
+    ################################################################
+    def flatten(self, N):
+
+        if isinstance(N, tuple):
+          return N
+
+        return np.ascontiguousarray(N, dtype=np.float32).reshape(-1)  # end, flatten method
+
+
+    ################################################################
+    #  Method: ribbonWidths
+    #  Desc  : Compute ribbon widths of this task's rows from the
+    #          B-matrix entries found by all tasks. Collective.
+    #  Args  : T      : BTools instance
+    #          I, J   : this task's B-matrix entry locations
+    # Returns: width (max(J) - min(J)) of each of this task's rows, in
+    #          local point order; < 0 for rows with no entries
+    ################################################################
+    def ribbonWidths(self, T, I, J):
+
+        from bcomm import MPI
+
+        # Extents of rows of this task's entries:
+        npts = int(np.prod(T.gn_))
+        IMAX = npts + 10
+        Jmax = np.full(npts, -1  , dtype='i')
+        Jmin = np.full(npts, IMAX, dtype='i')
+        np.maximum.at(Jmax, I, J.astype('i'))
+        np.minimum.at(Jmin, I, J.astype('i'))
+        if self.debug_:
+          print(self.rank_, ": BAnalyzer::ribbonWidths: rows=", len(np.unique(I)))
+          print(self.rank_, ": BAnalyzer::ribbonWidths: Jmax=", Jmax[0:100])
+          print(self.rank_, ": BAnalyzer::ribbonWidths: Jmin=", Jmin[0:100])
+          sys.stdout.flush()
+
+        # Global extents of rows, over tasks:
+        gJmax = np.zeros(npts, dtype='i')
+        self.comm_.Allreduce(Jmax, gJmax, op=MPI.MAX)
+        Jmax  = None
+        gJmin = np.zeros(npts, dtype='i')
+        self.comm_.Allreduce(Jmin, gJmin, op=MPI.MIN)
+        Jmin  = None
+
+        if gJmax.max() >= npts:
+          print(self.rank_, ": BAnalyzer::ribbonWidths: gJmax.max=", gJmax.max())
+          sys.stdout.flush()
+          sys.exit("Invalid index in gJmax")
+        if gJmin.min() < 0:
+          print(self.rank_, ": BAnalyzer::ribbonWidths: gJmin.max=", gJmin.max(), " gJmin.min=", gJmin.min())
+          sys.stdout.flush()
+          sys.exit("Invalid index in gJmin")
+
+        gJmax -= gJmin
+
+        return gJmax[T.slab_index(self.rank_)]  # end, ribbonWidths method
+
+
+    ################################################################
+    #  Method: analyze
+    #  Desc  : Compute ribbon widths, and their statistics, of the
+    #          B-matrix of ensemble data. Several thresholds, or
+    #          sampling, give widths only; a single threshold, unless
+    #          widthsonly, also gives the B entries. Collective.
+    #  Args  : source   : data source (see source method)
+    #          thresholds: corr coeff threshold, or list of them
+    #          varname  : ensemble variable name (file sources)
+    #          itime    : time index (file sources)
+    #          gdims    : global grid dims (array sources)
+    #          timer    : BTimer for phases (None: new one)
+    # Returns: BRibbonResult
+    ################################################################
+    def analyze(self, source, thresholds, varname=None, itime=0, gdims=None, timer=None):
+
+        from bcomm import MPI
+
+        comm       = self.comm_
+        thresholds = [float(t) for t in np.atleast_1d(thresholds)]
+        timer      = BTimer(comm) if timer is None else timer
+
+        t0 = time.time()
+        (x, nens, gdims) = self.source(source, varname, itime, gdims, timer)
+        source = None
+        T = self.tools(nens, gdims, timer)
+        R = BRibbonResult(thresholds, nens, gdims)
+        R.rows_  = T.slab_index(self.rank_)
+        R.timer_ = timer
+
+        Ws = []                     # widths of this task's rows, for each threshold
+        if self.sample_ > 0.0:
+          # Estimate statistics from a sample of rows:
+          results = T.sampleWidths(x, thresholds, self.sample_, self.seed_)
+          x = None
+          for it in range(0, len(results)):
+            (lcount, sgidx, W, Jcount) = results[it]
+            timer.start('reduce')
+            s = T.sampleStats(sgidx, W, Jcount)
+            timer.stop('reduce')
+            R.samples_.append(s)
+            R.counts_[it] = int(s["count"]+0.5)
+            (R.maxWidth_[it], R.irowmax_[it], R.avgWidth_[it], R.avgWidth1_[it]) = \
+              (s["maxWidth"], s["irowmax"], s["avgWidth"], s["avgWidth1"])
+          results = None
+        elif self.widthsonly_ or len(thresholds) > 1:
+          # Accumulate row extents directly; B, I, J never stored:
+          results = T.buildWidths(x, thresholds)
+          x = None
+          for it in range(0, len(results)):
+            (lcount, Jmin, Jmax, Jcount) = results[it]
+            R.counts_[it] = comm.allreduce(lcount, op=MPI.SUM)
+            Ws.append(np.where(Jcount > 0, Jmax - Jmin, -1))
+          results = Jmin = Jmax = Jcount = None
+        else:
+          (lcount, R.B_, R.I_, R.J_) = T.buildB(x, thresholds[0])
+          x = None
+          timer.start('reduce')
+          R.counts_[0] = comm.allreduce(lcount, op=MPI.SUM)
+          Ws.append(self.ribbonWidths(T, R.I_, R.J_))
+          timer.stop('reduce')
+
+        for it in range(0, len(Ws)):
+          # Ribbon width statistics: max, avg over all samples,
+          # and avg removing outliers:
+          timer.start('reduce')
+          (R.maxWidth_[it], R.irowmax_[it], R.avgWidth_[it], R.avgWidth1_[it]) = T.widthStats(Ws[it])
+          if self.gather_:
+            R.gwidths_.append(T.gatherWidths(np.maximum(Ws[it], 0)))
+          timer.stop('reduce')
+        R.widths_ = Ws
+
+        # Rows whose banded search may have been cut off:
+        R.ntrunc_   = T.truncatedRows() if self.band_ > 0 else 0
+        R.nstop_    = T.stoppedRows()   if self.band_ > 0 else 0
+        R.elapsed_  = comm.allreduce(time.time() - t0, op=MPI.MAX)
+
+        return R  # end, analyze method
+
+
+_analyzer = None            # analyzer of last call of analyze, and
+_settings = None            # its settings; reused if these match
+
+
+################################################################
+#  Method: analyze
+#  Desc  : Compute ribbon widths, and their statistics, of the
+#          B-matrix of ensemble data, with an analyzer that is
+#          kept, with its buffers, for following calls with the
+#          same settings. Collective.
+#  Args  : source    : data source (see BAnalyzer.source)
+#          thresholds: corr coeff threshold, or list of them
+#          comm      : communicator (None: MPI.COMM_WORLD)
+#          varname   : ensemble variable name (file sources)
+#          itime     : time index (file sources)
+#          gdims     : global grid dims (array sources)
+#          settings  : analyzer settings (see BAnalyzer)
+# Returns: BRibbonResult
+################################################################
+def analyze(source, thresholds, comm=None, varname=None, itime=0, gdims=None, **settings):
+
+  global _analyzer, _settings
+  if _analyzer is None or _settings != (comm, settings):
+    _analyzer = None            # release buffers first
+    _analyzer = BAnalyzer(comm, **settings)
+    _settings = (comm, settings)
+
+  return _analyzer.analyze(source, thresholds, varname, itime, gdims)  # end, analyze method
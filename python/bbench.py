@@ -0,0 +1,421 @@
+########################################################################
+# Name  : BBench                                                       #
+# Desc  : Synthetic-ensemble benchmark, scaling, and correctness suite #
+#         for bmata/BTools. Generates 5-D (ens,time,lev,lat,lon)       #
+#         ensemble files with a controllable grid size, member count,  #
+#         and correlation length scale; runs bmata under mpirun at     #
+#         several task counts (strong & weak scaling), or under both   #
+#         mpirun and the local backend; checks B, I, J and ribbon      #
+#         widths against a brute-force NumPy reference;                #
+#         and saves results as JSON, optionally compared against a    #
+#         baseline from an earlier run.                                #
+########################################################################
+import os, sys
+import argparse
+import json
+import shlex
+import subprocess
+import time
+import numpy as np
+from   netCDF4 import Dataset
+try:
+  import mpi4py
+  mpi4py.rc.initialize = False  # runs are launched from here; never init MPI
+except ImportError:
+  pass
+from   bsparse import BSparseReader
+
+
+################################################################
+#  Method: make_ensemble
+#  Desc  : Write a synthetic ensemble NetCDF file. Each member is
+#          white noise smoothed (periodically, in x & y) by a
+#          Gaussian kernel, so that correlations fall off with
+#          distance over roughly lscale grid points
+#  Args  : fileName : output file name
+#          nens     : number of ensemble members
+#          nz,ny,nx : grid dimensions
+#          lscale   : correlation length scale (grid points)
+#          nt       : number of times
+#          varname  : variable name
+#          seed     : random seed
+# Returns: none
+################################################################
+def make_ensemble(fileName, nens, nz, ny, nx, lscale, nt=1, varname="T", seed=0):
+
+    rng = np.random.default_rng(seed)
+    ky  = np.fft.fftfreq(ny)[:,None]
+    kx  = np.fft.rfftfreq(nx)[None,:]
+    G   = np.exp(-2.0*(np.pi*lscale)**2*(ky*ky + kx*kx))
+
+    nc = Dataset(fileName, 'w', format='NETCDF4')
+    for (d, n) in zip(('ens', 'time', 'lev', 'lat', 'lon'), (nens, nt, nz, ny, nx)):
+      nc.createDimension(d, n)
+    V = nc.createVariable(varname, 'f4', ('ens', 'time', 'lev', 'lat', 'lon'))
+    for it in range(0, nt):
+      F  = rng.standard_normal((nens, nz, ny, nx))
+      F  = np.fft.irfft2(np.fft.rfft2(F)*G, s=(ny, nx))
+      F /= max(float(F.std()), 1.0e-30)
+      V[:, it] = (280.0 + F).astype('f4')
+    nc.close()
+
+    return # end, make_ensemble
+
+
+################################################################
+#  Method: reference
+#  Desc  : Brute-force B-matrix thresholding of an ensemble file,
+#          in float64, over the whole (decimated) grid at once
+#  Args  : fileName : ensemble file name
+#          varname  : variable name
+#          decimate : decimation factor in x, y
+#          itime    : time index
+#          nlev     : number of levels used
+# Returns: corr     : (npts, npts) correlation coefficients
+#          cov      : (npts, npts) covariances
+#          valid    : (npts) True where point variance > 0
+################################################################
+def reference(fileName, varname, decimate=1, itime=0, nlev=1):
+
+    nc = Dataset(fileName, 'r')
+    V  = nc.variables[varname]
+    V.set_auto_mask(False)
+    A  = np.asarray(V[:, itime, 0:nlev, ::decimate, ::decimate], dtype=np.float64)
+    nc.close()
+
+    nens = A.shape[0]
+    A    = A.reshape(nens, -1)
+    A   -= A.mean(axis=0)
+    cov  = np.dot(A.T, A) / nens
+    sd   = np.sqrt(np.diag(cov))
+    valid= sd > 0
+    rsd  = np.where(valid, 1.0/np.where(valid, sd, 1.0), 0.0)
+    corr = cov * rsd[:,None] * rsd[None,:]
+
+    return corr, cov, valid  # end, reference
+
+
+################################################################
+#  Method: ref_widths
+#  Desc  : Ribbon width of each row of a thresholded B-matrix, as
+#          written by bmata (Jmax - Jmin; 0 for empty rows)
+#  Args  : mask     : (npts, npts) boolean thresholded matrix
+# Returns: widths
+################################################################
+def ref_widths(mask):
+
+    npts = mask.shape[1]
+    has  = mask.any(axis=1)
+    jmin = mask.argmax(axis=1)
+    jmax = npts - 1 - mask[:,::-1].argmax(axis=1)
+
+    return np.where(has, jmax - jmin, 0)  # end, ref_widths
+
+
+################################################################
+#  Method: read_results
+#  Desc  : Read B, I, J entries written by bmata tasks, in either
+#          output format
+#  Args  : prefix   : bmata output prefix
+#          ntasks   : number of tasks that wrote results
+# Returns: B, I, J
+################################################################
+def read_results(prefix, ntasks):
+
+    if os.path.exists(prefix + ".csr.json"):
+      R = BSparseReader(prefix)
+      (I, J, B) = R.rows(0, R.nrows_)
+      R.close()
+      return B, I, J
+
+    Bs, Is, Js = [], [], []
+    for r in range(0, ntasks):
+      nc = Dataset(prefix + "." + str(r) + ".nc", 'r')
+      Bs.append(np.asarray(nc.variables['B'][:]))
+      Is.append(np.asarray(nc.variables['I'][:], dtype=np.int64))
+      Js.append(np.asarray(nc.variables['J'][:], dtype=np.int64))
+      nc.close()
+
+    return np.concatenate(Bs), np.concatenate(Is), np.concatenate(Js)  # end, read_results
+
+
+################################################################
+#  Method: check
+#  Desc  : Check bmata results against brute-force reference.
+#          bmata works in single precision, so entries whose
+#          |corr| is within tol of thresh may fall either way;
+#          these are allowed, but not required, and widths must
+#          lie between those of the strict & loose reference sets
+#  Args  : ref      : (corr, cov, valid) from reference
+#          thresh   : corr coeff threshold
+#          B, I, J  : bmata entries (None: widths only)
+#          W        : bmata ribbon widths, in global row order
+#          tol      : corr coeff tolerance at threshold
+#          rtol     : relative tolerance of covariances
+# Returns: dict of check results; 'ok' is overall pass/fail
+################################################################
+def check(ref, thresh, B, I, J, W, tol=1.0e-5, rtol=1.0e-4):
+
+    (corr, cov, valid) = ref
+    acorr = np.abs(corr)
+    vv    = valid[:,None] & valid[None,:] if thresh <= 0.0 else True
+    loose = (acorr >= thresh - tol) & vv
+    strict= (acorr >= thresh + tol) & vv
+
+    res = {}
+    if B is not None:
+      found = np.zeros(corr.shape, dtype=bool)
+      found[I, J] = True
+      cscale  = np.abs(cov).max()
+      res["entries"]      = int(len(B))
+      res["duplicates"]   = int(len(B) - np.count_nonzero(found))
+      res["missing"]      = int(np.count_nonzero(strict & ~found))
+      res["spurious"]     = int(np.count_nonzero(found & ~loose))
+      res["max_rel_berr"] = float(np.max(np.abs(B - cov[I, J]), initial=0.0) / cscale)
+      ok = res["duplicates"] == 0 and res["missing"] == 0 and res["spurious"] == 0 \
+           and res["max_rel_berr"] <= rtol
+    else:
+      ok = True
+
+    wlo = ref_widths(strict)
+    whi = ref_widths(loose)
+    res["width_errors"] = int(np.count_nonzero((W < wlo) | (W > whi)))
+    res["ok"]           = bool(ok and res["width_errors"] == 0)
+
+    return res  # end, check
+
+
+################################################################
+#  Method: run_bmata
+#  Desc  : Run bmata under mpirun, in a work directory
+#  Args  : mpirun   : launcher command, to which task count is
+#                     appended; or 'local', for the single-node
+#                     backend's launcher (see bcomm)
+#          ntasks   : number of tasks
+#          workdir  : directory to run in
+#          args     : list of bmata arguments
+# Returns: wall-clock time of run (s)
+################################################################
+def run_bmata(mpirun, ntasks, workdir, args):
+
+    os.makedirs(workdir, exist_ok=True)
+    bmata = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bmata.py")
+    if mpirun == 'local':
+      cmd = [sys.executable, os.path.join(os.path.dirname(bmata), "bcomm.py"), "-n", str(ntasks), \
+             bmata] + args
+    else:
+      cmd = shlex.split(mpirun) + [str(ntasks), sys.executable, bmata] + args
+    t0    = time.time()
+    with open(os.path.join(workdir, "log"), 'w') as log:
+      rc = subprocess.call(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    dt    = time.time() - t0
+    if rc != 0:
+      sys.exit("Error, bmata failed (" + str(rc) + "); see " + os.path.join(workdir, "log"))
+
+    return dt  # end, run_bmata
+
+
+################################################################
+#  Method: bench_case
+#  Desc  : Generate ensemble, run bmata at a task count, and
+#          collect timings and (optionally) check results
+#  Args  : opts     : parsed options
+#          ntasks   : number of tasks
+#          nx       : number of x points of grid
+#          tag      : case name, used for work directory
+#          mpirun   : launcher (None: opts.mpirun)
+# Returns: dict of case results
+################################################################
+def bench_case(opts, ntasks, nx, tag, mpirun=None):
+
+    workdir = os.path.abspath(os.path.join(opts.workdir, tag))
+    os.makedirs(workdir, exist_ok=True)
+    infile  = os.path.join(workdir, "ens.nc")
+    make_ensemble(infile, opts.nens, opts.nz, opts.ny, nx, opts.lscale, seed=opts.seed)
+
+    args = ["-infile", infile, "-opref", "bench", "-dfact", str(opts.dfact), \
+            "-thresh", str(opts.thresh)] + opts.bargs
+    if opts.nz > 1:                 # all levels
+      args += ["-levels", "0:" + str(opts.nz)]
+    wall = run_bmata(opts.mpirun if mpirun is None else mpirun, ntasks, workdir, args)
+
+    tfile = os.path.join(workdir, "bench.timing." + str(opts.thresh) + "." + str(opts.dfact) + ".json")
+    with open(tfile, 'r') as f:
+      timing = json.load(f)
+
+    case = {"ntasks"        : ntasks,
+            "dims"          : timing["dims"],
+            "wall"          : wall,
+            "execution time": timing["execution time"],
+            "phases"        : dict([(p, v["time"]["max"]) for (p, v) in timing["phases"].items()]),
+            "imbalance"     : dict([(p, v["time"]["imbalance"]) for (p, v) in timing["phases"].items()]),
+            "peak_rss"      : timing["peak_rss"]["max"]}
+
+    if opts.check:
+      npts = int(np.prod(timing["dims"]))
+      if npts > opts.maxcheck:
+        print("bbench: ", tag, ": ", npts, " points; too large to check")
+      else:
+        ref = reference(infile, "T", opts.dfact, nlev=timing["dims"][0])
+        W   = np.loadtxt(os.path.join(workdir, "bench.width." + str(opts.thresh) + "." \
+                                      + str(opts.dfact) + ".txt"), ndmin=1).astype(np.int64)
+        B = I = J = None
+        if not timing["widths only"]:
+          (B, I, J) = read_results(os.path.join(workdir, "bench"), ntasks)
+        case["check"] = check(ref, opts.thresh, B, I, J, W)
+        if not case["check"]["ok"]:
+          print("bbench: ", tag, ": CHECK FAILED: ", case["check"])
+
+    print("bbench: ", tag, ": execution time=", case["execution time"], \
+          " check=", case.get("check", {}).get("ok", "skipped"))
+    sys.stdout.flush()
+
+    return case  # end, bench_case
+
+
+################################################################
+#  Method: compare
+#  Desc  : Compare execution times of cases with those of the same
+#          cases in a baseline result file
+#  Args  : results  : benchmark results
+#          baseline : baseline benchmark results
+#          slowdown : ratio of times above which a case regressed
+# Returns: list of (suite, ntasks, time, baseline time) regressions
+################################################################
+def compare(results, baseline, slowdown):
+
+    regressions = []
+    for suite in ("strong", "weak"):
+      base = dict([(c["ntasks"], c) for c in baseline.get(suite, [])])
+      for c in results.get(suite, []):
+        b = base.get(c["ntasks"])
+        if b is None or b["dims"] != c["dims"]:
+          continue
+        c["baseline ratio"] = c["execution time"] / max(b["execution time"], 1.0e-30)
+        if c["baseline ratio"] > slowdown:
+          regressions.append((suite, c["ntasks"], c["execution time"], b["execution time"]))
+
+    return regressions  # end, compare
+
+
+################################################################
+#  Method: main
+#  Desc  : Benchmark driver
+#  Args  : argv     : command line arguments
+# Returns: exit status: 0 if all checks pass, and no regressions
+################################################################
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="bmata synthetic benchmark & scaling suite", \
+                                     usage="%(prog)s [options] [-- bmata arguments]")
+    parser.add_argument("-nens"    , action="store", dest="nens"    , type=int  , default=20, \
+                        help='ensemble members')
+    parser.add_argument("-nz"      , action="store", dest="nz"      , type=int  , default=1, \
+                        help='grid levels')
+    parser.add_argument("-ny"      , action="store", dest="ny"      , type=int  , default=32, \
+                        help='grid y points')
+    parser.add_argument("-nx"      , action="store", dest="nx"      , type=int  , default=32, \
+                        help='grid x points (weak scaling: per task)')
+    parser.add_argument("-lscale"  , action="store", dest="lscale"  , type=float, default=2.0, \
+                        help='correlation length scale (grid points)')
+    parser.add_argument("-seed"    , action="store", dest="seed"    , type=int  , default=0, \
+                        help='random seed')
+    parser.add_argument("-thresh"  , action="store", dest="thresh"  , type=float, default=0.6, \
+                        help='corr coeff threshold')
+    parser.add_argument("-dfact"   , action="store", dest="dfact"   , type=int  , default=1, \
+                        help='decimation factor')
+    parser.add_argument("-ntasks"  , action="store", dest="ntasks"  , type=int  , default=[1, 2, 4], \
+                        nargs='+', help='task counts')
+    parser.add_argument("-suite"   , action="store", dest="suite"   , type=str  , default="both", \
+                        choices=['strong', 'weak', 'both', 'backend'], \
+                        help='scaling suite(s) to run; backend: strong case under -mpirun & local')
+    parser.add_argument("-nocheck" , action="store_false", dest="check", \
+                        help='skip brute-force check')
+    parser.add_argument("-maxcheck", action="store", dest="maxcheck", type=int  , default=8192, \
+                        help='max grid points checked')
+    parser.add_argument("-mpirun"  , action="store", dest="mpirun"  , type=str  , default="mpirun -n", \
+                        help='launcher; task count is appended (local: no MPI)')
+    parser.add_argument("-workdir" , action="store", dest="workdir" , type=str  , default="bbench.work", \
+                        help='work directory')
+    parser.add_argument("-o"       , action="store", dest="ofile"   , type=str  , default="bbench.json", \
+                        help='output JSON file')
+    parser.add_argument("-baseline", action="store", dest="baseline", type=str  , default=None, \
+                        help='earlier output JSON to compare against')
+    parser.add_argument("-slowdown", action="store", dest="slowdown", type=float, default=1.25, \
+                        help='time ratio vs baseline flagged as regression')
+    parser.add_argument("bargs"    , nargs=argparse.REMAINDER, \
+                        help='extra bmata arguments, after a "--" separator')
+    opts = parser.parse_args(argv)
+    if opts.bargs[:1] == ['--']:    # kept by some Python versions
+      opts.bargs = opts.bargs[1:]
+
+    results = {"config": vars(opts)}
+
+    # Strong scaling: fixed grid; weak scaling: grid x grows with tasks:
+    if opts.suite in ("strong", "both"):
+      results["strong"] = [bench_case(opts, n, opts.nx, "strong." + str(n)) for n in opts.ntasks]
+      t1 = results["strong"][0]["execution time"]*results["strong"][0]["ntasks"]
+      for c in results["strong"]:
+        c["speedup"]    = t1 / max(c["execution time"], 1.0e-30)
+        c["efficiency"] = c["speedup"] / c["ntasks"]
+    if opts.suite in ("weak", "both"):
+      results["weak"] = [bench_case(opts, n, opts.nx*n, "weak." + str(n)) for n in opts.ntasks]
+      t1 = results["weak"][0]["execution time"]
+      for c in results["weak"]:
+        c["efficiency"] = t1 / max(c["execution time"], 1.0e-30)
+
+    # Backends: fixed grid, under mpirun and the local backend:
+    if opts.suite == "backend":
+      results["backend"] = []
+      for n in opts.ntasks:
+        c = {"ntasks": n,
+             "mpi"   : bench_case(opts, n, opts.nx, "mpi."   + str(n)),
+             "local" : bench_case(opts, n, opts.nx, "local." + str(n), mpirun="local")}
+        c["local ratio"] = c["local"]["execution time"] / max(c["mpi"]["execution time"], 1.0e-30)
+        results["backend"].append(c)
+
+    status = 0
+    for suite in ("strong", "weak"):
+      if any([not c["check"]["ok"] for c in results.get(suite, []) if "check" in c]):
+        status = 1
+    for c in results.get("backend", []):
+      if any([not c[b]["check"]["ok"] for b in ("mpi", "local") if "check" in c[b]]):
+        status = 1
+
+    if opts.baseline is not None:
+      with open(opts.baseline, 'r') as f:
+        regressions = compare(results, json.load(f), opts.slowdown)
+      results["regressions"] = regressions
+      for (suite, n, t, tb) in regressions:
+        print("bbench: REGRESSION: ", suite, " ntasks=", n, " time=", t, " baseline=", tb)
+      if len(regressions) > 0:
+        status = 1
+
+    with open(opts.ofile, 'w') as f:
+      json.dump(results, f, indent=2)
+      f.write("\n")
+
+    # Scaling tables:
+    for suite in ("strong", "weak"):
+      if suite not in results:
+        continue
+      print("bbench: ", suite, " scaling:")
+      print("  %6s %14s %10s %10s" % ("ntasks", "dims", "time (s)", "eff."))
+      for c in results[suite]:
+        print("  %6d %14s %10.4f %10.3f" % (c["ntasks"], "x".join([str(d) for d in c["dims"]]), \
+                                            c["execution time"], c["efficiency"]))
+    if "backend" in results:
+      print("bbench:  backends (execution time, reduce phase; s):")
+      print("  %6s %14s %10s %10s %10s %10s %8s" % ("ntasks", "dims", "mpi", "reduce", "local", "reduce", \
+                                                    "ratio"))
+      for c in results["backend"]:
+        (m, l) = (c["mpi"], c["local"])
+        print("  %6d %14s %10.4f %10.4f %10.4f %10.4f %8.2f" % (c["ntasks"], "x".join([str(d) for d in m["dims"]]), \
+              m["execution time"], m["phases"].get("reduce", 0.0), l["execution time"], \
+              l["phases"].get("reduce", 0.0), c["local ratio"]))
+
+    return status  # end, main
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+################################################################
+#  Module: bcache.py
+#  Desc  : Provides an on-disk cache of per-task anomaly slabs, so
+#          that repeated runs on the same input need not re-read and
+#          re-decode the NetCDF file, nor (for slabs cached in the
+#          standardized form that tasks exchange) re-standardize it
+################################################################
+import numpy as np
+import hashlib
+import json
+import os
+
+
+class BCache:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Each entry is a slab, stored as a raw .npy
+    #          file that is memory-mapped on load (with, if it is
+    #          standardized, a second one of its points' RMS), and a
+    #          small JSON file holding its key, written last, so that
+    #          an entry without one is incomplete. Entries are named by
+    #          a hash of what was read (file, variable, time, mean mode,
+    #          decimation, decomposition, task, levels, form); the
+    #          input file's identity (size, mtime, inode) is kept in
+    #          the key file, so that entries made from an earlier
+    #          version of the file are found to be stale, and are
+    #          rebuilt in place
+    #  Args  : cachedir (in): cache directory; created if necessary
+    # Returns: none
+    ################################################################
+    def __init__(self, cachedir):
+
+        self.dir_ = cachedir
+        os.makedirs(self.dir_, exist_ok=True)
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: key
+    #  Desc  : Make cache key of a task's slab
+    #  Args  : fileName : input file
+    #          varname  : variable name
+    #          itime    : time index
+    #          means    : mean mode (see BTools.getSlabData)
+    #          decimate : decimation factor
+    #          decomp   : domain decomposition mode
+    #          mpiTasks : number of tasks
+    #          mpiRank  : task id
+    #          levels   : file levels used (None: default)
+    #          klev     : grid level range read (None: all)
+    #          standardized: slab is cached standardized, with RMS
+    #                     (see BTools.standardizeSlab)
+    # Returns: (name, key): entry name, and dict of key data
+    ################################################################
+    @staticmethod
+    def key(fileName, varname, itime, means, decimate, decomp, mpiTasks, mpiRank, levels=None, klev=None,
+            standardized=False):
+
+        what = {"file"    : os.path.abspath(fileName),
+                "variable": varname,
+                "time"    : int(itime),
+                "means"   : int(means),
+                "decimate": int(decimate),
+                "decomp"  : decomp,
+                "ntasks"  : int(mpiTasks),
+                "rank"    : int(mpiRank)}
+        if levels is not None:
+          what["levels"] = [int(k) for k in levels]
+        if klev is not None:
+          what["klev"]   = [int(k) for k in klev]
+        if standardized:
+          what["form"]   = "standardized"
+        name = hashlib.sha1(json.dumps(what, sort_keys=True).encode()).hexdigest()[0:20] \
+             + "." + str(mpiRank)
+
+        st  = os.stat(fileName)
+        key = dict(what, identity={"size" : st.st_size,
+                                   "mtime": st.st_mtime_ns,
+                                   "inode": st.st_ino})
+
+        return name, key  # end, key method
+
+
+    ################################################################
+    #  Method: load
+    #  Desc  : Look up slab in cache
+    #  Args  : name, key: from key method
+    # Returns: (N, nens, gdims) as from getSlabData, with N, or, if
+    #          standardized, each of (Z, sd), memory-mapped read-only;
+    #          or None if entry is missing, or stale
+    ################################################################
+    def load(self, name, key):
+
+        base = os.path.join(self.dir_, name)
+        try:
+          with open(base + ".json", 'r') as f:
+            meta = json.load(f)
+        except (OSError, ValueError):
+          return None
+        if meta.get("key") != key:
+          return None
+
+        try:
+          N = np.load(base + ".npy", mmap_mode='r')
+        except (OSError, ValueError):
+          return None
+        if list(N.shape) != meta["shape"]:
+          return None
+
+        if "sdshape" in meta:
+          try:
+            sd = np.load(base + ".sd.npy", mmap_mode='r')
+          except (OSError, ValueError):
+            return None
+          if list(sd.shape) != meta["sdshape"]:
+            return None
+          N = (N, sd)
+
+        return N, meta["nens"], meta["gdims"]  # end, load method
+
+
+    ################################################################
+    #  Method: store
+    #  Desc  : Add (or replace) slab in cache. Files are written under
+    #          temporary names, and renamed into place
+    #  Args  : name, key: from key method
+    #          N        : slab, or (Z, sd) of a standardized slab
+    #          nens     : number of ensemble members
+    #          gdims    : global grid dims
+    # Returns: none
+    ################################################################
+    def store(self, name, key, N, nens, gdims):
+
+        base = os.path.join(self.dir_, name)
+        if os.path.exists(base + ".json"):   # invalidate old entry first
+          os.remove(base + ".json")
+
+        sd = None
+        if isinstance(N, tuple):
+          (N, sd) = N
+        with open(base + ".tmp.npy", 'wb') as f:
+          np.save(f, np.ascontiguousarray(N))
+        os.replace(base + ".tmp.npy", base + ".npy")
+
+        meta = {"key"  : key,
+                "shape": list(N.shape),
+                "dtype": str(N.dtype),
+                "nens" : int(nens),
+                "gdims": [int(d) for d in gdims]}
+        if sd is not None:
+          with open(base + ".sd.tmp.npy", 'wb') as f:
+            np.save(f, np.ascontiguousarray(sd))
+          os.replace(base + ".sd.tmp.npy", base + ".sd.npy")
+          meta["sdshape"] = list(sd.shape)
+        with open(base + ".tmp.json", 'w') as f:
+          json.dump(meta, f, indent=2)
+        os.replace(base + ".tmp.json", base + ".json")
+
+        return # end, store method
+
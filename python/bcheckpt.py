@@ -0,0 +1,205 @@
+################################################################
+#  Module: bcheckpt.py
+#  Desc  : Provides per-task checkpoint/restart of B-matrix
+#          thresholding progress, at slab-pair granularity
+################################################################
+import numpy as np
+import glob
+import hashlib
+import json
+import os
+import time
+
+
+class BCheckpoint:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. A task's checkpoint records the slabs it
+    #          has finished thresholding against, the entry counts,
+    #          and the state of its accumulators, in a .npz index 
+    #          file, with entries of growing (appended) accumulator
+    #          states held in .npz segment files, one per save, of
+    #          the entries added since the previous save; so the I/O
+    #          of a save is that of the progress since the last. Files
+    #          are written under a temporary name and renamed into
+    #          place, segment before index, so that a checkpoint is
+    #          always complete. Temporary files left by a crash are
+    #          removed
+    #  Args  : ckptdir  (in): checkpoint directory; created if necessary
+    #          rank     (in): task id
+    #          interval (in): min seconds between saves
+    # Returns: none
+    ################################################################
+    def __init__(self, ckptdir, rank, interval=600):
+
+        self.dir_      = ckptdir
+        self.interval_ = float(interval)
+        self.prefix_   = os.path.join(ckptdir, "ckpt." + str(rank))
+        self.file_     = self.prefix_ + ".npz"
+        self.nseg_     = 0          # segments of the current checkpoint
+        self.tlast_    = time.time()
+        os.makedirs(self.dir_, exist_ok=True)
+        for f in glob.glob(glob.escape(self.prefix_) + ".*tmp.npz"):
+          os.remove(f)
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: key
+    #  Desc  : Make checkpoint compatibility key. Includes a digest of
+    #          the task's input data, so that a changed input, time,
+    #          decimation, etc. is detected
+    #  Args  : ldata  : this task's (local) data
+    #          config : dict of settings that determine results
+    # Returns: key string
+    ################################################################
+    @staticmethod
+    def key(ldata, config):
+
+        h = hashlib.sha1(np.ascontiguousarray(ldata).view(np.uint8)).hexdigest()
+
+        return json.dumps(dict(config, data=h), sort_keys=True)  # end, key method
+
+
+    ################################################################
+    #  Method: segment
+    #  Desc  : Name of a segment file
+    #  Args  : iseg   : segment number
+    # Returns: file name
+    ################################################################
+    def segment(self, iseg):
+
+        return self.prefix_ + ".seg" + str(iseg) + ".npz"  # end, segment method
+
+
+    ################################################################
+    #  Method: load
+    #  Desc  : Read checkpoint, if there is a compatible one. Appended
+    #          states are concatenated over segments. Later saves
+    #          add to this checkpoint; if there is none, they start a
+    #          new one
+    #  Args  : key    : compatibility key
+    # Returns: (done, ntot, states): list of finished slab ids, array
+    #          of entry counts, and list over threads of lists over
+    #          thresholds of accumulator states; or None
+    ################################################################
+    def load(self, key):
+
+        self.nseg_ = 0
+        try:
+          z = np.load(self.file_, allow_pickle=False)
+        except (OSError, ValueError):
+          return None
+        meta = json.loads(str(z['meta']))
+        if meta['key'] != key:
+          z.close()
+          return None
+
+        segs = [np.load(self.segment(k), allow_pickle=False) for k in range(0, meta['nseg'])]
+        states = []
+        for t in range(0, meta['nthreads']):
+          states.append([])
+          for it in range(0, meta['nacc']):
+            names = meta['names'][t][it]
+            if meta['append'][t][it]:
+              s = dict([(name, np.concatenate([g['s%d.%d.%s' % (t, it, name)] for g in segs])) \
+                        for name in names])
+            else:
+              s = dict([(name, z['s%d.%d.%s' % (t, it, name)]) for name in names])
+            states[t].append(s)
+        done = [int(i) for i in z['done']]
+        ntot = np.array(z['ntot'], dtype=np.int64)
+        z.close()
+        for g in segs:
+          g.close()
+        self.nseg_ = meta['nseg']
+
+        return done, ntot, states  # end, load method
+
+
+    ################################################################
+    #  Method: due
+    #  Desc  : Check whether a save is due
+    #  Args  : none
+    # Returns: True if interval has elapsed since last save
+    ################################################################
+    def due(self):
+
+        return time.time() - self.tlast_ >= self.interval_  # end, due method
+
+
+    ################################################################
+    #  Method: save
+    #  Desc  : Write checkpoint atomically
+    #  Args  : key    : compatibility key
+    #          done   : list of finished slab ids
+    #          ntot   : array of entry counts
+    #          states : list over threads of lists over thresholds of
+    #                   accumulator states
+    #          append : list over threads of lists over thresholds of
+    #                   flags: True if the state holds the entries 
+    #                   added since the last save (or load), to be
+    #                   appended; False if it is whole (None: all whole)
+    # Returns: none
+    ################################################################
+    def save(self, key, done, ntot, states, append=None):
+
+        if append is None:
+          append = [[False for s in st] for st in states]
+
+        # Entries added, to a new segment; whole states, to the index:
+        (arrays, added) = ({}, {})
+        for t in range(0, len(states)):
+          for it in range(0, len(states[t])):
+            for name in states[t][it].keys():
+              (added if append[t][it] else arrays)['s%d.%d.%s' % (t, it, name)] = states[t][it][name]
+        nseg = self.nseg_
+        if len(added) > 0:
+          self.write(self.segment(nseg), added)
+          nseg += 1
+        meta = {'key': key, 'nthreads': len(states), 'nacc': len(states[0]) if states else 0,
+                'names': [[sorted(s.keys()) for s in st] for st in states], 
+                'append': append, 'nseg': nseg}
+        self.write(self.file_, dict(arrays, meta=np.array(json.dumps(meta)), 
+                                    done=np.array(sorted(done), dtype=np.int64),
+                                    ntot=np.asarray(ntot, dtype=np.int64)))
+        self.nseg_  = nseg
+        self.tlast_ = time.time()
+
+        return # end, save method
+
+
+    ################################################################
+    #  Method: write
+    #  Desc  : Write arrays to a .npz file atomically
+    #  Args  : fname  : file name
+    #          arrays : dict of arrays
+    # Returns: none
+    ################################################################
+    def write(self, fname, arrays):
+
+        tmp = fname[:-len(".npz")] + ".tmp.npz"
+        with open(tmp, 'wb') as f:
+          np.savez(f, **arrays)
+          f.flush()
+          os.fsync(f.fileno())
+        os.replace(tmp, fname)
+
+        return # end, write method
+
+
+    ################################################################
+    #  Method: remove
+    #  Desc  : Remove checkpoint files, e.g. once results are written
+    #  Args  : none
+    # Returns: none
+    ################################################################
+    def remove(self):
+
+        for f in glob.glob(glob.escape(self.prefix_) + ".*npz"):
+          os.remove(f)
+        self.nseg_ = 0
+
+        return # end, remove method
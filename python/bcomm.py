@@ -0,0 +1,708 @@
+################################################################
+#  Module: bcomm.py
+#  Desc  : Provides an MPI-optional communicator layer. Modules
+#          import MPI from here: if bmata runs under the single-
+#          node launcher below, MPI resolves to a local backend,
+#          in which tasks are multiprocessing workers that share
+#          slab data in multiprocessing.shared_memory; otherwise,
+#          to mpi4py's MPI, or, if mpi4py isn't installed (and no
+#          MPI launcher started this process), to a single task of
+#          the local backend. Usage of the launcher, like mpirun:
+#              python bcomm.py -n 4 bmata.py [bmata args]
+################################################################
+import numpy as np
+import multiprocessing as mp
+import multiprocessing.connection
+from   multiprocessing import shared_memory, resource_tracker
+import argparse
+import functools
+import pickle
+import platform
+import runpy
+import sys
+import os
+
+
+class BLocalOp:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Reduction operation of local backend
+    #  Args  : name    (in): operation name
+    #          scalar  (in): function of two Python values
+    #          array   (in): elementwise function of two arrays
+    # Returns: none
+    ################################################################
+    def __init__(self, name, scalar, array):
+
+        self.name_   = name
+        self.scalar_ = scalar
+        self.array_  = array
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: __call__
+    #  Desc  : Apply operation
+    #  Args  : a, b    : operands
+    # Returns: result
+    ################################################################
+    def __call__(self, a, b):
+
+        if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+          return self.array_(a, b)
+
+        return self.scalar_(a, b)  # end, __call__ method
+
+
+
+class BLocalComm:
+
+    world_  = None          # this worker's communicator, if under launcher
+    slotsz_ = 65536         # mailbox bytes of each task; larger objects are queued
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Communicator of the local backend, with
+    #          the subset of the mpi4py Comm interface used by BTools
+    #          and bmata. Collectives are done in the same order by
+    #          all tasks, as in MPI; each gets its own message tag.
+    #          Objects of collectives are posted to a shared-memory
+    #          mailbox, and arrays to a shared scratch segment, each
+    #          read after a barrier; other messages go through an
+    #          inbox queue of each task
+    #  Args  : rank    (in): task id
+    #          size    (in): number of tasks
+    #          inbox   (in): list of each task's multiprocessing Queue
+    #          barrier (in): multiprocessing Barrier of all tasks
+    #          mbox    (in): multiprocessing RawArray of mailbox, of
+    #                        mboxsz(size) bytes
+    # Returns: none
+    ################################################################
+    def __init__(self, rank, size, inbox, barrier, mbox):
+
+        self.rank_    = int(rank)
+        self.size_    = int(size)
+        self.inbox_   = inbox
+        self.barrier_ = barrier
+        self.stash_   = []      # messages received before wanted
+        self.tag_     = 0
+        self.shm_     = []      # shared-memory segments in use
+        self.scratch_ = None    # shared-memory segment of array collectives
+        self.scrsz_   = 0       # size of each half of scratch segment
+        self.nscr_    = 0       # number of scratch uses
+        self.nbox_    = 0       # number of mailbox uses
+
+        # Mailbox: lengths of objects posted, and pickled objects, of
+        # each task; two sets, used in turn:
+        self.boxlen_  = np.frombuffer(mbox, dtype=np.int64, count=2*self.size_).reshape(2, self.size_)
+        self.box_     = np.frombuffer(mbox, dtype=np.uint8, offset=self.boxlen_.nbytes) \
+                          .reshape(2, self.size_, BLocalComm.slotsz_)
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: mboxsz
+    #  Desc  : Size of mailbox
+    #  Args  : size    : number of tasks
+    # Returns: size (bytes)
+    ################################################################
+    @staticmethod
+    def mboxsz(size):
+
+        return 2*size*(8 + BLocalComm.slotsz_)  # end, mboxsz method
+
+
+    ################################################################
+    #  Method: single
+    #  Desc  : Communicator of a single task of the local backend, in
+    #          this process
+    #  Args  : none
+    # Returns: communicator
+    ################################################################
+    @staticmethod
+    def single():
+
+        ctx = mp.get_context()
+
+        return BLocalComm(0, 1, [ctx.Queue()], ctx.Barrier(1), \
+                          ctx.RawArray('b', BLocalComm.mboxsz(1)))  # end, single method
+
+
+    ################################################################
+    #  Method: Get_rank
+    #  Desc  : Task id
+    #  Args  : none
+    # Returns: task id
+    ################################################################
+    def Get_rank(self):
+
+        return self.rank_  # end, Get_rank method
+
+
+    ################################################################
+    #  Method: Get_size
+    #  Desc  : Number of tasks
+    #  Args  : none
+    # Returns: number of tasks
+    ################################################################
+    def Get_size(self):
+
+        return self.size_  # end, Get_size method
+
+
+    ################################################################
+    #  Method: Split_type
+    #  Desc  : Split by type; all tasks of the local backend are on
+    #          one node, so the communicator itself is returned
+    #  Args  : split_type : ignored
+    # Returns: communicator
+    ################################################################
+    def Split_type(self, split_type, key=0, info=None):
+
+        return self  # end, Split_type method
+
+
+    ################################################################
+    #  Method: Free
+    #  Desc  : Free communicator; a no-op, as Split_type returns the
+    #          communicator itself, which lives as long as the tasks
+    #  Args  : none
+    # Returns: none
+    ################################################################
+    def Free(self):
+
+        return # end, Free method
+
+
+    ################################################################
+    #  Method: barrier
+    #  Desc  : Wait for all tasks
+    #  Args  : none
+    # Returns: none
+    ################################################################
+    def barrier(self):
+
+        self.barrier_.wait()
+
+        return # end, barrier method
+
+
+    ################################################################
+    #  Method: next_tag
+    #  Desc  : Message tag of next collective
+    #  Args  : none
+    # Returns: tag
+    ################################################################
+    def next_tag(self):
+
+        self.tag_ += 1
+
+        return self.tag_  # end, next_tag method
+
+
+    ################################################################
+    #  Method: send
+    #  Desc  : Send object to a task
+    #  Args  : dest    : task id
+    #          tag     : message tag
+    #          obj     : object (pickled)
+    # Returns: none
+    ################################################################
+    def send(self, dest, tag, obj):
+
+        self.inbox_[dest].put((self.rank_, tag, obj))
+
+        return # end, send method
+
+
+    ################################################################
+    #  Method: recv
+    #  Desc  : Receive object from a task, holding any others that
+    #          arrive first
+    #  Args  : source  : task id
+    #          tag     : message tag
+    # Returns: object
+    ################################################################
+    def recv(self, source, tag):
+
+        for n in range(0, len(self.stash_)):
+          if self.stash_[n][0:2] == (source, tag):
+            return self.stash_.pop(n)[2]
+        while True:
+          m = self.inbox_[self.rank_].get()
+          if m[0:2] == (source, tag):
+            return m[2]
+          self.stash_.append(m)  # end, recv method
+
+
+    ################################################################
+    #  Method: post
+    #  Desc  : Post objects of a collective to the mailbox, and read
+    #          them after a barrier. The two sets of the mailbox are
+    #          used in turn, so a set is not written again until all
+    #          tasks have passed the barrier of the next use, having
+    #          read it. Objects too large for a slot are queued to
+    #          the tasks reading them
+    #  Args  : obj     : object (if this task posts)
+    #          posts   : whether this task posts
+    #          readers : tasks reading objects posted
+    # Returns: list of objects posted, in task order (None for tasks
+    #          not posting), if this task reads; None otherwise
+    ################################################################
+    def post(self, obj, posts, readers):
+
+        tag   = self.next_tag()
+        k     = self.nbox_ % 2
+        self.nbox_ += 1
+        if posts:
+          b = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+          if len(b) <= BLocalComm.slotsz_:
+            self.box_[k, self.rank_, 0:len(b)] = np.frombuffer(b, dtype=np.uint8)
+            self.boxlen_[k, self.rank_] = len(b)
+          else:
+            self.boxlen_[k, self.rank_] = -1
+            for i in readers:
+              if i != self.rank_:
+                self.send(i, tag, obj)
+        else:
+          self.boxlen_[k, self.rank_] = -2
+        self.barrier()
+        if self.rank_ not in readers:
+          return None
+
+        objs = []
+        for i in range(0, self.size_):
+          n = int(self.boxlen_[k, i])
+          if i == self.rank_ and posts:
+            objs.append(obj)
+          elif n >= 0:
+            objs.append(pickle.loads(self.box_[k, i, 0:n].tobytes()))
+          elif n == -1:
+            objs.append(self.recv(i, tag))
+          else:
+            objs.append(None)
+
+        return objs  # end, post method
+
+
+    ################################################################
+    #  Method: bcast
+    #  Desc  : Broadcast object, as in mpi4py
+    #  Args  : obj     : object (root only)
+    #          root    : task broadcasting
+    # Returns: object
+    ################################################################
+    def bcast(self, obj, root=0):
+
+        return self.post(obj, self.rank_ == root, range(0, self.size_))[root]  # end, bcast method
+
+
+    ################################################################
+    #  Method: gather
+    #  Desc  : Gather objects to root, as in mpi4py
+    #  Args  : obj     : object
+    #          root    : task gathering to
+    # Returns: list of objects in task order on root; None elsewhere
+    ################################################################
+    def gather(self, obj, root=0):
+
+        return self.post(obj, True, [root])  # end, gather method
+
+
+    ################################################################
+    #  Method: allgather
+    #  Desc  : Gather objects to all tasks, as in mpi4py
+    #  Args  : obj     : object
+    # Returns: list of objects in task order
+    ################################################################
+    def allgather(self, obj):
+
+        return self.post(obj, True, range(0, self.size_))  # end, allgather method
+
+
+    ################################################################
+    #  Method: allreduce
+    #  Desc  : Reduce objects to all tasks, as in mpi4py. Reduction
+    #          is done in task order
+    #  Args  : obj     : object
+    #          op      : BLocalOp
+    # Returns: result
+    ################################################################
+    def allreduce(self, obj, op):
+
+        return functools.reduce(op, self.allgather(obj))  # end, allreduce method
+
+
+    ################################################################
+    #  Method: scratch
+    #  Desc  : Shared scratch array of an array collective, one row
+    #          for each task. The scratch segment has two halves,
+    #          used in turn by successive collectives, so a half is
+    #          not written again until all tasks have passed the
+    #          first barrier of the next collective, having read it.
+    #          The segment grows, by at least doubling, if too small.
+    #          Collective, with the same shape on all tasks
+    #  Args  : shape   : shape of a task's row
+    #          dtype   : array type
+    # Returns: array [size, shape]
+    ################################################################
+    def scratch(self, shape, dtype):
+
+        shape  = [self.size_] + list(shape)
+        nbytes = -(-int(np.prod(shape))*np.dtype(dtype).itemsize // 64)*64
+        if nbytes > self.scrsz_:
+          old = self.scratch_
+          self.scrsz_   = max(nbytes, 2*self.scrsz_)
+          self.scratch_ = self.segment(2*self.scrsz_)
+          if old is not None:
+            old.close()
+        k = self.nscr_ % 2
+        self.nscr_ += 1
+
+        return np.ndarray(shape, dtype=dtype, buffer=self.scratch_.buf, offset=k*self.scrsz_)  # end, scratch method
+
+
+    ################################################################
+    #  Method: Allreduce
+    #  Desc  : Reduce arrays to all tasks, as in mpi4py. Each task
+    #          writes its array to the scratch segment, and reduces,
+    #          in task order, a 1/size part of the elements of all,
+    #          in place of task 0's, which all then read
+    #  Args  : sendbuf : array
+    #          recvbuf : array of result
+    #          op      : BLocalOp
+    # Returns: none
+    ################################################################
+    def Allreduce(self, sendbuf, recvbuf, op):
+
+        a = np.asarray(sendbuf).reshape(-1)
+        S = self.scratch(a.shape, a.dtype)
+        S[self.rank_] = a
+        self.barrier()
+        i0 = (len(a)*self.rank_) // self.size_
+        i1 = (len(a)*(self.rank_+1)) // self.size_
+        r  = S[0, i0:i1]
+        for i in range(1, self.size_):
+          r = op(r, S[i, i0:i1])
+        S[0, i0:i1] = r
+        self.barrier()
+        recvbuf[...] = S[0].reshape(np.shape(recvbuf))
+
+        return # end, Allreduce method
+
+
+    ################################################################
+    #  Method: Reduce_scatter
+    #  Desc  : Reduce arrays, and scatter parts of result, as in
+    #          mpi4py. Each task writes its array to the scratch
+    #          segment, and reduces its part of all, in task order
+    #  Args  : sendbuf : array
+    #          recvbuf : array of this task's part of result
+    #          recvcounts: size of each task's part
+    #          op      : BLocalOp
+    # Returns: none
+    ################################################################
+    def Reduce_scatter(self, sendbuf, recvbuf, recvcounts, op):
+
+        a = np.asarray(sendbuf).reshape(-1)
+        S = self.scratch(a.shape, a.dtype)
+        S[self.rank_] = a
+        self.barrier()
+        i0 = int(np.sum(recvcounts[0:self.rank_]))
+        i1 = i0 + int(recvcounts[self.rank_])
+        r  = S[0, i0:i1]
+        for i in range(1, self.size_):
+          r = op(r, S[i, i0:i1])
+        recvbuf[...] = r
+
+        return # end, Reduce_scatter method
+
+
+    ################################################################
+    #  Method: Gatherv
+    #  Desc  : Gather arrays to root, in task order, as in mpi4py.
+    #          Each task writes its array to the scratch segment,
+    #          from which root reads all
+    #  Args  : sendbuf : array
+    #          recvbuf : [array, counts] on root (None elsewhere)
+    #          root    : task gathering to
+    # Returns: none
+    ################################################################
+    def Gatherv(self, sendbuf, recvbuf, root=0):
+
+        a      = np.asarray(sendbuf).reshape(-1)
+        counts = self.allgather(len(a))
+        S      = self.scratch([max(counts)], a.dtype)
+        S[self.rank_, 0:len(a)] = a
+        self.barrier()
+        if self.rank_ == root:
+          o = 0
+          for i in range(0, self.size_):
+            recvbuf[0][o:o+counts[i]] = S[i, 0:counts[i]]
+            o += counts[i]
+
+        return # end, Gatherv method
+
+
+    ################################################################
+    #  Method: Alltoall
+    #  Desc  : Send element j of array to task j, as in mpi4py
+    #  Args  : sendbuf : array, one element for each task
+    #          recvbuf : array, one element from each task
+    # Returns: none
+    ################################################################
+    def Alltoall(self, sendbuf, recvbuf):
+
+        parts = [np.asarray(sendbuf)[j:j+1] for j in range(0, self.size_)]
+        recvbuf[...] = np.concatenate(self.alltoall_parts(parts))
+
+        return # end, Alltoall method
+
+
+    ################################################################
+    #  Method: Alltoallv
+    #  Desc  : Send part j of array to task j, as in mpi4py
+    #  Args  : sendbuf : [array, (counts, displs), type]
+    #          recvbuf : [array, (counts, displs), type]
+    # Returns: none
+    ################################################################
+    def Alltoallv(self, sendbuf, recvbuf):
+
+        (sb, (scount, sdispl), stype) = sendbuf
+        (rb, (rcount, rdispl), rtype) = recvbuf
+        parts = [sb[sdispl[j]:sdispl[j]+scount[j]] for j in range(0, self.size_)]
+        parts = self.alltoall_parts(parts)
+        for j in range(0, self.size_):
+          rb[rdispl[j]:rdispl[j]+len(parts[j])] = parts[j]
+
+        return # end, Alltoallv method
+
+
+    ################################################################
+    #  Method: alltoall_parts
+    #  Desc  : Send part j of a list to task j
+    #  Args  : parts   : list of objects, one for each task
+    # Returns: list of objects received, one from each task
+    ################################################################
+    def alltoall_parts(self, parts):
+
+        tag = self.next_tag()
+        for j in range(0, self.size_):
+          if j != self.rank_:
+            self.send(j, tag, parts[j])
+
+        return [parts[j] if j == self.rank_ else self.recv(j, tag) for j in range(0, self.size_)]  # end, alltoall_parts method
+
+
+    ################################################################
+    #  Method: segment
+    #  Desc  : Allocate shared-memory segment, attached by all tasks.
+    #          Task 0 creates the segment and unlinks its name once
+    #          all have attached, so it is freed when the last task
+    #          closes it, or exits; as tasks share the launcher's
+    #          resource tracker, the unlink also drops the name that
+    #          each registered with it on attaching. Collective.
+    #  Args  : nbytes  : size (bytes)
+    # Returns: multiprocessing SharedMemory
+    ################################################################
+    def segment(self, nbytes):
+
+        if self.rank_ == 0:
+          shm = shared_memory.SharedMemory(create=True, size=max(int(nbytes), 1))
+          self.bcast(shm.name, 0)
+        else:
+          shm = shared_memory.SharedMemory(name=self.bcast(None, 0))
+        self.barrier()
+        if self.rank_ == 0:
+          shm.unlink()
+
+        return shm  # end, segment method
+
+
+    ################################################################
+    #  Method: share
+    #  Desc  : Allocate array in shared memory, visible to all tasks,
+    #          for as long as they run. Collective.
+    #  Args  : shape   : array shape
+    #          dtype   : array type
+    # Returns: array
+    ################################################################
+    def share(self, shape, dtype):
+
+        shm = self.segment(int(np.prod(shape))*np.dtype(dtype).itemsize)
+        self.shm_.append(shm)
+
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)  # end, share method
+
+
+    ################################################################
+    #  Method: run
+    #  Desc  : Body of a worker: run script as task rank, with this
+    #          module's MPI resolving to the local backend
+    #  Args  : rank, size, inbox, barrier, mbox: see constructor
+    #          script  : script to run
+    #          argv    : its arguments
+    # Returns: none
+    ################################################################
+    @staticmethod
+    def run(rank, size, inbox, barrier, mbox, script, argv):
+
+        import bcomm      # not __main__, if launched from command line
+        bcomm.BLocalComm.world_ = bcomm.BLocalComm(rank, size, inbox, barrier, mbox)
+        sys.argv = [script] + list(argv)
+        runpy.run_path(script, run_name='__main__')
+
+        return # end, run method
+
+
+    ################################################################
+    #  Method: launch
+    #  Desc  : Run script in nprocs local worker processes, as
+    #          tasks 0..nprocs-1. If one fails, the rest are stopped.
+    #          The shared-memory resource tracker is started here, so
+    #          that workers share it, rather than each starting its
+    #          own (a new interpreter) when first sharing memory
+    #  Args  : nprocs  : number of tasks
+    #          script  : script to run
+    #          argv    : its arguments
+    # Returns: exit code: 0, or that of first worker to fail
+    ################################################################
+    @staticmethod
+    def launch(nprocs, script, argv):
+
+        ctx   = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else None)
+        inbox = [ctx.Queue() for i in range(0, nprocs)]
+        bar   = ctx.Barrier(nprocs)
+        mbox  = ctx.RawArray('b', BLocalComm.mboxsz(nprocs))
+        resource_tracker.ensure_running()
+        procs = [ctx.Process(target=BLocalComm.run, args=(i, nprocs, inbox, bar, mbox, script, argv)) \
+                 for i in range(0, nprocs)]
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        for p in procs:
+          p.start()
+
+        rc      = 0
+        running = list(procs)
+        while len(running) > 0:
+          multiprocessing.connection.wait([p.sentinel for p in running])
+          for p in [p for p in running if p.exitcode is not None]:
+            running.remove(p)
+            if p.exitcode != 0 and rc == 0:
+              rc = p.exitcode if p.exitcode > 0 else 1
+              for q in running:
+                q.terminate()
+
+        return rc  # end, launch method
+
+
+
+# Names of mpi4py's MPI used here, for the local backend:
+class BLocalMPI:
+
+    SUM    = BLocalOp("SUM" , lambda a, b: a + b      , np.add)
+    MAX    = BLocalOp("MAX" , max                     , np.maximum)
+    MIN    = BLocalOp("MIN" , min                     , np.minimum)
+    LAND   = BLocalOp("LAND", lambda a, b: bool(a and b), np.logical_and)
+    FLOAT  = np.dtype(np.float32)
+    DOUBLE = np.dtype(np.float64)
+    INT64_T= np.dtype(np.int64)
+    COMM_TYPE_SHARED = 0
+    INFO_NULL        = None
+
+    ################################################################
+    #  Method: Get_processor_name
+    #  Desc  : Name of this node
+    #  Args  : none
+    # Returns: name
+    ################################################################
+    @staticmethod
+    def Get_processor_name():
+
+        return platform.node()  # end, Get_processor_name method
+
+
+
+# Stands in for mpi4py's MPI module:
+class BMPI:
+
+    # Environment variables of MPI launchers (Open MPI, MPICH/Hydra &
+    # PMI, PMIx, Slurm): task counts, which are > 1 in a run of
+    # several tasks, and ranks, which are set in any launched task:
+    sizevars_ = ["OMPI_COMM_WORLD_SIZE", "PMI_SIZE", "MPI_LOCALNRANKS", "SLURM_NTASKS", \
+                 "SLURM_STEP_NUM_TASKS"]
+    rankvars_ = ["OMPI_COMM_WORLD_RANK", "PMI_RANK", "PMIX_RANK"]
+
+    ################################################################
+    #  Method: launcher
+    #  Desc  : Find whether this process was started by an MPI
+    #          launcher (mpirun, srun, ...)
+    #  Args  : none
+    # Returns: name of the environment variable that shows it, or
+    #          None if none does
+    ################################################################
+    @staticmethod
+    def launcher():
+
+        for v in BMPI.sizevars_:
+          try:
+            if int(os.environ.get(v, "1")) > 1:
+              return v
+          except ValueError:
+            return v
+        for v in BMPI.rankvars_:
+          if v in os.environ:
+            return v
+
+        return None  # end, launcher method
+
+
+    ################################################################
+    #  Method: __getattr__
+    #  Desc  : Resolve name, when first used, to the local backend if
+    #          this process is a worker of the local launcher, else to
+    #          mpi4py's MPI, which is not imported (nor initialized)
+    #          until then. Without mpi4py, this process is made a
+    #          single task of the local backend, unless it was started
+    #          by an MPI launcher, when its tasks would otherwise each
+    #          run alone, overwriting each other's output
+    #  Args  : name    : name
+    # Returns: object named
+    ################################################################
+    def __getattr__(self, name):
+
+        if BLocalComm.world_ is None:
+          try:
+            from mpi4py import MPI as mpi
+          except ImportError as e:
+            v = BMPI.launcher()
+            if v is not None:
+              raise ImportError("Error, mpi4py is required to run under an MPI launcher (" + v + \
+                                " is set); install it, or use: python bcomm.py -n N script") from e
+            BLocalComm.world_ = BLocalComm.single()
+          else:
+            return getattr(mpi, name)
+        if name == 'COMM_WORLD':
+          return BLocalComm.world_
+
+        return getattr(BLocalMPI, name)  # end, __getattr__ method
+
+
+MPI = BMPI()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run a script as tasks of the local (single-node) backend')
+    parser.add_argument("-n"     , action="store", dest="nprocs", type=int, default=1, \
+                        help='number of tasks')
+    parser.add_argument("script" , help='script to run, e.g. bmata.py')
+    parser.add_argument("args"   , nargs=argparse.REMAINDER, help='script arguments')
+    args = parser.parse_args()
+    if args.nprocs < 1:
+      sys.exit("Error, bad number of tasks!")
+
+    sys.exit(BLocalComm.launch(args.nprocs, os.path.abspath(args.script), args.args))
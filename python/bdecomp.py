@@ -0,0 +1,306 @@
+################################################################
+#  Module: bdecomp.py
+#  Desc  : Provides domain decomposition of the (decimated) global
+#          grid over tasks: which grid points each task owns, their
+#          global B-matrix indices, and reading them from file
+################################################################
+import numpy as np
+
+
+class BDecomp:
+
+    # Decomposition modes:
+    #   'x', 'y', 'z': slabs along one dimension
+    #   'xyz'        : boxes on a 3-D grid of tasks, chosen to
+    #                  minimize the largest box
+    #   'points'     : contiguous, equal ranges of flattened global
+    #                  point index
+    modes = ('x', 'y', 'z', 'xyz', 'points')
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor
+    #  Args  : gn      (in): global grid dims, (Nz, Ny, Nx)
+    #          nprocs  (in): number of tasks
+    #          mode    (in): decomposition mode (see modes)
+    # Returns: none
+    ################################################################
+    def __init__(self, gn, nprocs, mode='x'):
+
+        assert len(gn)==3, "Invalid dimension spec"
+        assert mode in BDecomp.modes, "Invalid decomposition mode"
+        self.gn_     = [int(n) for n in gn]
+        self.nprocs_ = int(nprocs)
+        self.mode_   = mode
+
+        # Task grid, (Pz, Py, Px), for box modes:
+        if   mode == 'x':
+          self.pgrid_ = (1, 1, self.nprocs_)
+        elif mode == 'y':
+          self.pgrid_ = (1, self.nprocs_, 1)
+        elif mode == 'z':
+          self.pgrid_ = (self.nprocs_, 1, 1)
+        elif mode == 'xyz':
+          self.pgrid_ = BDecomp.task_grid(self.gn_, self.nprocs_)
+        else:
+          self.pgrid_ = None
+
+        # Number of points owned by each task:
+        self.counts_ = np.array([self.count(i) for i in range(0, self.nprocs_)], dtype=np.int64)
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: range
+    #  Desc  : Compute (Fortran) array bounds given global length
+    #  Args  :
+    #          gn     (in): global length
+    #          nprocs (in): total number of tasks
+    #          myrank (in): task's rank
+    # Returns: (ib ie): task's local starting, ending indices (zero-
+    #          based, inclusive)
+    ################################################################
+    @staticmethod
+    def range(gn, nprocs, myrank):
+
+        i1 = gn // nprocs
+        i2 = gn %  nprocs
+        ib = myrank*i1 + min(myrank, i2)
+        ie = ib + i1 - 1
+        if i2 > myrank:
+           ie = ie + 1
+
+        return int(ib), int(ie)  # end, range method
+
+
+    ################################################################
+    #  Method: task_grid
+    #  Desc  : Factor number of tasks into a 3-D task grid, such that
+    #          the largest box of the grid has fewest points; ties are
+    #          broken toward splitting the slowest-varying dimensions
+    #          (fewer, longer contiguous runs in file)
+    #  Args  : gn     (in): global grid dims, (Nz, Ny, Nx)
+    #          nprocs (in): number of tasks
+    # Returns: (Pz, Py, Px)
+    ################################################################
+    @staticmethod
+    def task_grid(gn, nprocs):
+
+        best = None
+        for pz in range(1, nprocs+1):
+          if nprocs % pz != 0:
+            continue
+          for py in range(1, nprocs//pz+1):
+            if (nprocs//pz) % py != 0:
+              continue
+            px   = nprocs//(pz*py)
+            cost = ((-(-gn[0]//pz))*(-(-gn[1]//py))*(-(-gn[2]//px)), -pz, -py)
+            if best is None or cost < best[0]:
+              best = (cost, (pz, py, px))
+
+        return best[1]  # end, task_grid method
+
+
+    ################################################################
+    #  Method: box
+    #  Desc  : Grid box owned by a task, in box modes
+    #  Args  : irank : task id
+    # Returns: ((kb,ke), (jb,je), (ib,ie)): zero-based, inclusive
+    #          bounds in z, y, x; None in 'points' mode
+    ################################################################
+    def box(self, irank):
+
+        if self.pgrid_ is None:
+          return None
+        t = np.unravel_index(irank, self.pgrid_)
+
+        return tuple([BDecomp.range(self.gn_[d], self.pgrid_[d], int(t[d])) \
+                      for d in range(0, 3)])  # end, box method
+
+
+    ################################################################
+    #  Method: bbox
+    #  Desc  : Bounding box of the grid points owned by a task
+    #  Args  : irank : task id
+    # Returns: ((kb,ke), (jb,je), (ib,ie)): zero-based, inclusive
+    #          bounds in z, y, x; None if the task owns no points
+    ################################################################
+    def bbox(self, irank):
+
+        if self.count(irank) <= 0:
+          return None
+        if self.pgrid_ is not None:
+          return self.box(irank)
+
+        # A range of flattened points spans whole rows, and planes,
+        # between its first & last points:
+        (nz, ny, nx) = self.gn_
+        (gb, ge) = BDecomp.range(nz*ny*nx, self.nprocs_, irank)
+        (k0, j0, i0) = np.unravel_index(gb, self.gn_)
+        (k1, j1, i1) = np.unravel_index(ge, self.gn_)
+        if k0 < k1:
+          return ((int(k0), int(k1)), (0, ny-1), (0, nx-1))
+        if j0 < j1:
+          return ((int(k0), int(k1)), (int(j0), int(j1)), (0, nx-1))
+
+        return ((int(k0), int(k1)), (int(j0), int(j1)), (int(i0), int(i1)))  # end, bbox method
+
+
+    ################################################################
+    #  Method: near
+    #  Desc  : Tasks owning points within a (Chebyshev, max over
+    #          dimensions) grid distance of a task's points, by
+    #          distance between their bounding boxes; so, no such
+    #          task is missed. Symmetric: i is near j if j is near i
+    #  Args  : irank : task id
+    #          dist  : grid distance (<= 0: any distance)
+    # Returns: list of task ids, in increasing order, including irank
+    ################################################################
+    def near(self, irank, dist):
+
+        if dist <= 0:
+          return list(range(0, self.nprocs_))
+        b = self.bbox(irank)
+        if b is None:
+          return [irank]
+
+        tasks = []
+        for i in range(0, self.nprocs_):
+          c = self.bbox(i)
+          if c is not None and max([max(b[d][0]-c[d][1], c[d][0]-b[d][1]) \
+                                    for d in range(0, 3)]) <= dist:
+            tasks.append(i)
+
+        return tasks  # end, near method
+
+
+    ################################################################
+    #  Method: count
+    #  Desc  : Number of grid points owned by a task
+    #  Args  : irank : task id
+    # Returns: number of points
+    ################################################################
+    def count(self, irank):
+
+        if self.pgrid_ is None:
+          (ib, ie) = BDecomp.range(int(np.prod(self.gn_)), self.nprocs_, irank)
+          return ie - ib + 1
+
+        return int(np.prod([e-b+1 for (b, e) in self.box(irank)]))  # end, count method
+
+
+    ################################################################
+    #  Method: index
+    #  Desc  : Global B-matrix (row/column) index of each point owned
+    #          by a task, in the task's local point order. Global index
+    #          of grid point (k,j,i) is
+    #              i + j*Nx + k*Nx*Ny
+    #          Local points of a box are ordered as the flattened
+    #          (Nz_p, Ny_p, Nx_p) box, so indices are in increasing
+    #          order in all modes.
+    #  Args  : irank : task id
+    # Returns: int64 array of global indices
+    ################################################################
+    def index(self, irank):
+
+        (nz, ny, nx) = self.gn_
+        if self.pgrid_ is None:
+          (ib, ie) = BDecomp.range(nz*ny*nx, self.nprocs_, irank)
+          return np.arange(ib, ie+1, dtype=np.int64)
+
+        ((kb, ke), (jb, je), (ib, ie)) = self.box(irank)
+        gidx = (np.arange(kb, ke+1, dtype=np.int64)[:,None,None]*ny \
+             +  np.arange(jb, je+1, dtype=np.int64)[None,:,None])*nx \
+             +  np.arange(ib, ie+1, dtype=np.int64)[None,None,:]
+
+        return gidx.ravel()  # end, index method
+
+
+    ################################################################
+    #  Method: segment
+    #  Desc  : Range of a task's local points that lie on a range of
+    #          grid levels. A task's points on consecutive levels are
+    #          consecutive in its local order, in all modes
+    #  Args  : irank : task id
+    #          kb, ke: first, last grid level (inclusive)
+    # Returns: (s0, s1): local point range, s1 excluded
+    ################################################################
+    def segment(self, irank, kb, ke):
+
+        (nz, ny, nx) = self.gn_
+        if self.pgrid_ is None:
+          (gb, ge) = BDecomp.range(nz*ny*nx, self.nprocs_, irank)
+          s0 = max(gb, kb*nx*ny) - gb
+          s1 = min(ge+1, (ke+1)*nx*ny) - gb
+          return s0, max(s0, s1)
+
+        ((zb, ze), (jb, je), (ib, ie)) = self.box(irank)
+        area = (je-jb+1)*(ie-ib+1)
+        s0   = max(kb-zb, 0)*area
+        s1   = (min(ke, ze)-zb+1)*area
+
+        return s0, max(s0, s1)  # end, segment method
+
+
+    ################################################################
+    #  Method: read
+    #  Desc  : Read the points owned by a task from a 5-D ensemble
+    #          variable, (ens, time, lev, lat, lon), as strided 
+    #          hyperslabs of the undecimated file grid. In 'points' 
+    #          mode, the range of whole rows (or levels) containing
+    #          the task's points is read, and trimmed. Grid level k is
+    #          file level levels[k]; runs of consecutive file levels
+    #          are read together.
+    #  Args  : V        : netCDF4 variable
+    #          itime    : time index
+    #          irank    : task id
+    #          decimate : decimation factor in x, y
+    #          levels   : file level of each grid level (None: grid
+    #                     levels are file levels)
+    #          klev     : (kb, ke): read only the task's points on
+    #                     grid levels kb..ke (None: all; see segment)
+    # Returns: (nens, npts) array of task's points, in local order
+    ################################################################
+    def read(self, V, itime, irank, decimate, levels=None, klev=None):
+
+        d    = decimate
+        nens = V.shape[0]
+        (nz, ny, nx) = self.gn_
+        if levels is None:
+          levels = list(range(0, nz))
+        (kb, ke) = (0, nz-1) if klev is None else klev
+
+        # Read grid levels k0..k1 (inclusive), rows & columns given:
+        def read_levels(k0, k1, js, iss):
+          parts = []
+          while k0 <= k1:
+            k = k0
+            while k < k1 and levels[k+1] == levels[k] + 1:
+              k += 1
+            parts.append(np.asarray(V[:, itime, levels[k0]:levels[k]+1, js, iss]).reshape(nens, -1))
+            k0 = k + 1
+          if len(parts) == 1:
+            return parts[0]
+          return np.concatenate(parts, axis=1)
+
+        if self.pgrid_ is not None:
+          ((zb, ze), (jb, je), (ib, ie)) = self.box(irank)
+          (zb, ze) = (max(zb, kb), min(ze, ke))
+          if ze < zb:
+            return np.empty((nens, 0), dtype=V.dtype)
+          return read_levels(zb, ze, slice(jb*d, je*d+1, d), slice(ib*d, ie*d+1, d))
+
+        (gb, ge) = BDecomp.range(nz*ny*nx, self.nprocs_, irank)
+        (gb, ge) = (max(gb, kb*nx*ny), min(ge, (ke+1)*nx*ny-1))
+        if ge < gb:
+          return np.empty((nens, 0), dtype=V.dtype)
+        (zb, ze) = (gb//(nx*ny), ge//(nx*ny))
+        if zb == ze:                     # rows within a single level
+          (jb, je) = ((gb//nx) % ny, (ge//nx) % ny)
+        else:
+          (jb, je) = (0, ny-1)
+        N  = read_levels(zb, ze, slice(jb*d, je*d+1, d), slice(None, None, d))
+        g0 = (zb*ny + jb)*nx
+
+        return N[:, gb-g0:ge-g0+1]  # end, read method
@@ -7,204 +7,435 @@
 ########################################################################
 import os, sys
 import argparse
-import math
 import numpy as np
-from   mpi4py import MPI
-from   netCDF4 import Dataset
 import time
-import btools
+from   bcomm import MPI, BLocalComm
+from   concurrent.futures import ThreadPoolExecutor, wait
+from   btimer import BTimer
+from   bplan import BPlan
+from   banalyze import BAnalyzer
 
 # User specifiable data:
 filename   = "Tmerged17.nc" # input file
-svarname   = "T"            # input file variable name
-threshold  = 0.95           # correl. coeff thrreshold
+svarname   = "T"            # input file variable name (or list of them)
+times      = ["0"]          # time indices, or ranges 'a:b[:s]' (b excluded)
+levels     = None           # vertical levels, as times (None = first level only)
+levchunk   = 0              # levels streamed per chunk (0 = all, unless over memory budget)
+threshold  = 0.95           # correl. coeff thrreshold (or list of them)
 decfact    = 8              # 'decimation factor' in x, y directions
 soutprefix = "Bmatrix"      # B matrix output prefix
 nensembles = 0              # no. ensembles to use (0 includes all)
+tilesz     = 512            # correlation tile size (points per edge)
+maxmem     = 0              # cap on result memory per task, MB (0 = no cap)
+exchange   = "allgather"    # slab exchange mode: 'allgather' or 'ring'
+symmetric  = False          # compute symmetric B entries only once
+widthsonly = False          # compute ribbon widths only; don't store B
+nthreads   = 1              # threads per task for correlation tiles
+scratch    = None           # scratch dir for out-of-core slabs (None = in-core)
+window     = 0              # out-of-core in-memory slab window, MB, may be fractional (0 = default)
+decomp     = "x"            # domain decomposition: 'x','y','z','xyz' or 'points'
+ofmt       = "nc"           # B output format: 'nc' (B,I,J per task) or 'csr'
+cachedir   = None           # standardized slab cache dir (None = no cache)
+sample     = 0.0            # fraction of rows sampled for width estimates (0 = all)
+seed       = 0              # random seed for sampling
+band       = 0              # banded search shell width, grid points (0 = full search); approximate
+patience   = 2              # banded search: stop after this many empty shells
+maxdist    = 0              # banded search: distance limit, grid points (0 = none)
+plan       = False          # print memory/runtime plan, and exit (dry run)
+plantasks  = 0              # task count to plan for (0 = tasks running)
+nodemem    = 0              # memory budget per node, MB (0 = node's physical memory)
+ppn        = 0              # tasks per node (0 = tasks running on this node)
+hitfrac    = 0.0            # expected fraction of B entries meeting threshold, to plan result memory (0 = unknown)
+ckptdir    = None           # checkpoint dir for restart (None = no checkpoints)
+ckptint    = 600            # min seconds between checkpoints
 
-# Get world size and rank:
-comm     = MPI.COMM_WORLD
-mpiTasks = MPI.COMM_WORLD.Get_size()
-mpiRank  = MPI.COMM_WORLD.Get_rank()
-name     = MPI.Get_processor_name()
-
-print("main: tasks=",mpiTasks, " rank=", mpiRank,"machine name=",name)
-sys.stdout.flush()
-
-# Get command line arguments:
-parser = argparse.ArgumentParser()
-parser.add_argument("-infile" , action="store", dest="filename"  , \
-                    type=str  , help='output filename prefix'    , default=filename)
-parser.add_argument("-varname", action="store", dest="svarname"  , \
-                    type=str  , help='ensemble variable name'    , default=svarname)
-parser.add_argument("-thresh" , action="store", dest="threshold" , \
-                    type=float, help='corr coeff threshold'      , default=threshold)
-parser.add_argument("-opref"  , action="store", dest="soutprefix", \
-                    type=str  , help='output fileprefix'         , default=soutprefix)
-parser.add_argument("-dfact"  , action="store", dest="decfact"   , \
-                    type=int  , help='decimation factor'         , default=decfact)
-#parser.add_argument("-nens"   , action="store", dest="nensembles", \
-#                    type=int  , help='number of ensembles to use', default=nensembles)
-args = parser.parse_args()
-
-filename   = args.filename
-threshold  = args.threshold
-soutprefix = args.soutprefix
-svarname   = args.svarname
-decfact    = args.decfact
-#nensembles = args.nensembles
-
-
-# Get the local data:
-(N,nens,gdims) = btools.BTools.getSlabData(filename, svarname, 0, mpiTasks, mpiRank, 2, decfact)
-if mpiRank == 0:
-  print (mpiRank, ": main: constructing BTools, nens   =",nens)
-  print (mpiRank, ": main: constructing BTools, gdims  =",gdims)
-  print (mpiRank, ": main: constructing BTools, N.shape=",N.shape)
-  sys.stdout.flush()
 
-# Instantiate the BTools class before building B:
-prdebug = False
-BTools = btools.BTools(comm, MPI.FLOAT, nens, gdims, prdebug)
-
-N = np.asarray(N, order='C')
-x=N.flatten()
-N = None
-
-# Here's where the work is done!
-t0 = time.time()
-lcount,B,I,J = BTools.buildB(x, threshold) 
-x = None
- 
-# Write out the results:
-BTools.writeResults(B, I, J, soutprefix, mpiRank)
- 
-comm.barrier()
-gcount = comm.allreduce(lcount, op=MPI.SUM) # global number of entries
-
-# Compute 'ribbon widths':
-# First, sort B, I, J on I:
-isort = np.argsort(I)
-B = B[isort]
-I = I[isort]
-J = J[isort]
-
-if mpiRank == 0:
-  print(mpiRank, ": main: sort(I)=", I)
-  print(mpiRank, ": main: sort(J)=", J)
-
-# Next, find unique row indices:
-iu, iunique = np.unique(I, return_index=True)
-iu, counts  = np.unique(I, return_counts=True)  
-print(mpiRank,": main: len(counts)=",len(counts))
-sys.stdout.flush()
-iu = None
-
-# Then, for each unique row, find J's and find 
-# 'local' ribbon width by taking max(J) - min(J):
-#ilen  = np.zeros(np.prod(gdims), dtype='i')
-Jmax  = np.zeros(np.prod(gdims), dtype='i') #np.int)
-Jmin  = np.zeros(np.prod(gdims), dtype='i') #np.int)
-
-IMAX  = np.prod(gdims)+10
-Jmax.fill(-1)
-Jmin.fill(IMAX)
-for i in range(0,len(iunique)):
-  jjmax = -1
-  jjmin = IMAX
-  for j in range(0,int(counts[i])):
-#   print(mpiRank,": main: iunique=",iunique[j], " iunique+i=",iunique[j]+i," len((J)=",len(J))
-#   sys.stdout.flush()
-    Jchk   = J[iunique[i]+j]
-    jjmax  = max(jjmax, Jchk)
-    jjmin  = min(jjmin, Jchk)
-
-# lwidth    = jjmax - jjmin + 1
-  ind       = int(I[iunique[i]])
-  Jmax[ind] = jjmax
-  Jmin[ind] = jjmin
-# ilen[ind] = int(lwidth)
-
-
-# Find sum of 'local' widths in each row:
-#print(mpiRank, ": main: Doing global ribbon vector...; ix=", ix)
-#sys.stdout.flush()
-#glen  = np.zeros(np.prod(gdims), dtype='i')
-#comm.Allreduce(ilen, glen, op=MPI.SUM) # Sum of widths over tasks
-
-print(mpiRank, ": main: Jmax=", Jmax[0:100])
-print(mpiRank, ": main: Jmin=", Jmin[0:100])
-sys.stdout.flush()
-
-
-gJmax = np.zeros(np.prod(gdims), dtype='i') #np.int)
-comm.Allreduce(Jmax, gJmax, op=MPI.MAX) # Sum of widths over tasks
-Jmax = None
-gJmin = np.zeros(np.prod(gdims), dtype='i') #np.int)
-comm.Allreduce(Jmin, gJmin, op=MPI.MIN) # Sum of widths over tasks
-Jmin = None
-
-if gJmax.max() >= np.prod(gdims): 
-  print(mpiRank, ": main: gJmax.max=", gJmax.max())
-  sys.stdout.flush()
-  sys.exit("Invalid index in gJmax")
-if gJmin.min() < 0: 
-  print(mpiRank, ": main: gJmin.max=", gJmin.max(), " gJmin.min=", gJmin.min())
+# Expand list of indices, or ranges 'a:b[:s]' (b excluded):
+def index_list(specs, what):
+  l = []
+  for spec in specs:
+    r = [int(v) for v in spec.split(':')]
+    if len(r) < 1 or len(r) > 3 or min(r) < 0:
+      sys.exit("Error, bad " + what + " spec " + spec + "!")
+    l += [r[0]] if len(r) == 1 else list(range(*r))
+  return l
+
+
+# Get command line arguments, from argv (None: sys.argv[1:]):
+def parse_args(argv=None):
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-infile" , action="store", dest="filename"  , \
+                      type=str  , help='output filename prefix'    , default=filename)
+  parser.add_argument("-varname", action="store", dest="svarname"  , \
+                      type=str  , help='ensemble variable name(s)' , default=[svarname], \
+                      nargs='+')
+  parser.add_argument("-times"  , action="store", dest="times"     , \
+                      type=str  , help='time indices, or ranges a:b[:s]', default=times, \
+                      nargs='+')
+  parser.add_argument("-thresh" , action="store", dest="threshold" , \
+                      type=float, help='corr coeff threshold(s)'   , default=[threshold], \
+                      nargs='+')
+  parser.add_argument("-opref"  , action="store", dest="soutprefix", \
+                      type=str  , help='output fileprefix'         , default=soutprefix)
+  parser.add_argument("-dfact"  , action="store", dest="decfact"   , \
+                      type=int  , help='decimation factor'         , default=decfact)
+  parser.add_argument("-tile"   , action="store", dest="tilesz"    , \
+                      type=int  , help='correlation tile size'     , default=tilesz)
+  parser.add_argument("-maxmem" , action="store", dest="maxmem"    , \
+                      type=int  , help='max result memory/task (MB)', default=maxmem)
+  parser.add_argument("-exch"   , action="store", dest="exchange"  , \
+                      type=str  , help='slab exchange mode'        , default=exchange, \
+                      choices=['allgather', 'ring'])
+  parser.add_argument("-sym"    , action="store_true", dest="symmetric", \
+                      help='compute upper triangle only, and mirror', default=symmetric)
+  parser.add_argument("-widths" , action="store_true", dest="widthsonly", \
+                      help='compute ribbon widths only; no B output', default=widthsonly)
+  parser.add_argument("-nthreads", action="store", dest="nthreads"  , \
+                      type=int  , help='threads per task'          , default=nthreads)
+  parser.add_argument("-scratch", action="store", dest="scratch"   , \
+                      type=str  , help='out-of-core scratch dir'   , default=scratch)
+  parser.add_argument("-window" , action="store", dest="window"    , \
+                      type=float, help='out-of-core window (MB)'   , default=window)
+  parser.add_argument("-decomp" , action="store", dest="decomp"    , \
+                      type=str  , help='domain decomposition'      , default=decomp, \
+                      choices=['x', 'y', 'z', 'xyz', 'points'])
+  parser.add_argument("-ofmt"   , action="store", dest="ofmt"      , \
+                      type=str  , help='B output format'           , default=ofmt, \
+                      choices=['nc', 'csr'])
+  parser.add_argument("-cache"  , action="store", dest="cachedir"  , \
+                      type=str  , help='slab cache dir'            , default=cachedir)
+  parser.add_argument("-sample" , action="store", dest="sample"    , \
+                      type=float, help='fraction of rows to sample', default=sample)
+  parser.add_argument("-seed"   , action="store", dest="seed"      , \
+                      type=int  , help='random seed for sampling'  , default=seed)
+  parser.add_argument("-band"   , action="store", dest="band"      , \
+                      type=int  , help='banded search shell width; approximate results', default=band)
+  parser.add_argument("-patience", action="store", dest="patience" , \
+                      type=int  , help='banded search empty shells', default=patience)
+  parser.add_argument("-maxdist", action="store", dest="maxdist"   , \
+                      type=int  , help='banded search max distance', default=maxdist)
+  parser.add_argument("-plan", "--plan", action="store_true", dest="plan", \
+                      help='print memory/runtime plan and exit', default=plan)
+  parser.add_argument("-plantasks", action="store", dest="plantasks", \
+                      type=int  , help='task count to plan for'    , default=plantasks)
+  parser.add_argument("-nodemem", action="store", dest="nodemem"   , \
+                      type=int  , help='memory budget per node (MB)', default=nodemem)
+  parser.add_argument("-ppn"    , action="store", dest="ppn"       , \
+                      type=int  , help='tasks per node'            , default=ppn)
+  parser.add_argument("-hitfrac", action="store", dest="hitfrac"   , \
+                      type=float, help='expected fraction of entries, to plan', default=hitfrac)
+  parser.add_argument("-levels" , action="store", dest="levels"    , \
+                      type=str  , help='levels, or ranges a:b[:s]' , default=levels, \
+                      nargs='+')
+  parser.add_argument("-levchunk", action="store", dest="levchunk" , \
+                      type=int  , help='levels streamed per chunk' , default=levchunk)
+  parser.add_argument("-ckpt"   , action="store", dest="ckptdir"   , \
+                      type=str  , help='checkpoint dir for restart', default=ckptdir)
+  parser.add_argument("-ckptint", action="store", dest="ckptint"   , \
+                      type=float, help='seconds between checkpoints', default=ckptint)
+  #parser.add_argument("-nens"   , action="store", dest="nensembles", \
+  #                    type=int  , help='number of ensembles to use', default=nensembles)
+
+  return parser.parse_args(argv)
+
+
+################################################################
+#  Method: main
+#  Desc  : Console entry point: analyze each (variable, time) item
+#          of the command line, writing B, widths, summary and
+#          timing files
+#  Args  : argv   : command line arguments (None: sys.argv[1:])
+# Returns: none
+################################################################
+def main(argv=None):
+
+  # Get world size and rank:
+  comm     = MPI.COMM_WORLD
+  mpiTasks = comm.Get_size()
+  mpiRank  = comm.Get_rank()
+  name     = MPI.Get_processor_name()
+
+  print("main: tasks=",mpiTasks, " rank=", mpiRank,"machine name=",name)
   sys.stdout.flush()
-  sys.exit("Invalid index in gJmin")
-
-# Compute ribbon width for each row of B-matrix:
-gJmax -= gJmin
-maxWidth  = gJmax.max()
-irowmax   = np.argmax(gJmax)
-Wkeep     = gJmax[gJmax > 0]
-avgWidth  = np.sum(Wkeep) / len(Wkeep) # avg over all samples
-stdWidth  = math.sqrt(np.sum((Wkeep-avgWidth)*(Wkeep-avgWidth)) / len(Wkeep))
-Wkeep     = Wkeep[Wkeep < (avgWidth+2*stdWidth)]
-avgWidth1 = np.sum(Wkeep) / len(Wkeep) # avg rremoving outliers
-
-#print(mpiRank, ": main: Global ribbon max done.")
-#sys.stdout.flush()
-
-# Write width distribution to a file:
-gJmax[gJmax < 0] = 0 
-wfilename = soutprefix + "." + "width" + "." + str(threshold) + "." + str(decfact) + ".txt"
-np.savetxt(wfilename, gJmax, delimiter="\n")
-
-
-# Compute total run time:
-ldt = time.time() - t0;
-gdt = comm.allreduce(ldt, op=MPI.MAX) # global number of entries
-
-comm.barrier()
-
-if mpiRank == 0:
-  sfilename = soutprefix + "." + "summary" + "." + str(threshold) + "." + str(decfact) + ".txt"
-  f = open(sfilename,'w')
-  f.write("main: input file..................: %s\n"% filename)
-  f.write("main: input variable............. : %s\n"% svarname)
-  f.write("main: max number entries ........ : %d\n"% (np.prod(gdims))**2)
-  f.write("main: decimation factor.......... : %d\n"% decfact)
-  f.write("main: corr. coeff. threshold..... : %f\n"% threshold)
-  f.write("main: number entries > threshold  : %d\n"% gcount)
-  f.write("main: data written to file........: %s\n"% soutprefix)
-  f.write("main: max possible ribbon width...: %d\n"% np.prod(gdims))
-  f.write("main: max ribbon width............: %d\n"% maxWidth)
-  f.write("main: avg ribbon width............: %d\n"% int(avgWidth+0.5))
-  f.write("main: avg ribbon width no outliers: %d\n"% int(avgWidth1+0.5))
-  f.write("main: row of ribbon width.max.....: %d\n"% irowmax)
-  f.write("main: execution time..............: %f\n"% gdt)
-  f.close()
-  print(mpiRank, ": main: input file..................: ", filename)
-  print(mpiRank, ": main: input variable..............: ", svarname)
-  print(mpiRank, ": main: max number entries .........: ", (np.prod(gdims))**2)
-  print(mpiRank, ": main: decimation factor...........: ", decfact)
-  print(mpiRank, ": main: corr. coeff. threshold......: ", threshold)
-  print(mpiRank, ": main: number entries > threshold..: ", gcount)
-  print(mpiRank, ": main: data written to file........: ", soutprefix)
-  print(mpiRank, ": main: max possible ribbon width...: ", np.prod(gdims))
-  print(mpiRank, ": main: max ribbon width............: ", maxWidth)
-  print(mpiRank, ": main: avg ribbon width............: ", int(avgWidth+0.5))
-  print(mpiRank, ": main: avg ribbon width no outliers: ", int(avgWidth1+0.5))
-  print(mpiRank, ": main: row of ribbon width.max.....: ", irowmax)
-  print(mpiRank, ": main: execution time..............: ", gdt)
+
+  args = parse_args(argv)
+
+  filename   = args.filename
+  thresholds = args.threshold
+  soutprefix = args.soutprefix
+  svarnames  = args.svarname
+  itimes     = index_list(args.times, "time")
+  levels     = index_list(args.levels, "level") if args.levels is not None else None
+  levchunk   = args.levchunk
+  decfact    = args.decfact
+  tilesz     = args.tilesz
+  maxmem     = args.maxmem
+  exchange   = args.exchange
+  symmetric  = args.symmetric
+  widthsonly = args.widthsonly
+  nthreads   = args.nthreads
+  scratch    = args.scratch
+  window     = args.window
+  decomp     = args.decomp
+  ofmt       = args.ofmt
+  cachedir   = args.cachedir
+  sample     = args.sample
+  seed       = args.seed
+  band       = args.band
+  patience   = args.patience
+  maxdist    = args.maxdist
+  plan       = args.plan
+  plantasks  = args.plantasks
+  nodemem    = args.nodemem
+  ppn        = args.ppn
+  hitfrac    = args.hitfrac
+  ckptdir    = args.ckptdir
+  ckptint    = args.ckptint
+  #nensembles = args.nensembles
+
+  # A threshold sweep, or sampling, is done in a single pass, keeping 
+  # widths only:
+  if sample > 0.0 and not widthsonly:
+    widthsonly = True
+    if mpiRank == 0:
+      print(mpiRank, ": main: sampling rows; estimating ribbon widths only")
+      sys.stdout.flush()
+  if len(thresholds) > 1 and not widthsonly:
+    widthsonly = True
+    if mpiRank == 0:
+      print(mpiRank, ": main: multiple thresholds; computing ribbon widths only")
+      sys.stdout.flush()
+
+  # Batch of (variable, time) items, done back to back in this job:
+  items = [(v, t) for v in svarnames for t in itimes]
+  batch = len(items) > 1
+
+  # Analyzer of the items. Its buffers are reused by following items
+  # of the same dims:
+  A = BAnalyzer(comm, decfact=decfact, levels=levels, tilesz=tilesz, maxmem=maxmem*1024*1024,
+                exchange=exchange, symmetric=symmetric, widthsonly=widthsonly, nthreads=nthreads,
+                scratch=scratch, window=int(window*1024*1024), decomp=decomp, cachedir=cachedir,
+                sample=sample, seed=seed, band=band, patience=patience, maxdist=maxdist,
+                ckptdir=ckptdir, ckptint=ckptint)
+
+  # Plan memory from file metadata alone, and refuse to start a run
+  # that can't fit, before anything is allocated:
+  dims = dict([(v, A.dims(filename, v)) for v in svarnames])
+  for (v, t) in items:
+    if t >= dims[v][1]:
+      sys.exit("Error, time index " + str(t) + " out of range for variable " + v + "!")
+  if ppn <= 0:
+    node = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    ppn  = node.Get_size()
+    node.Free()
+  budget = nodemem*1024*1024 if nodemem > 0 else BPlan.node_budget()
+  budget = budget // max(ppn, 1)
+  def make_plan(levchunk):      # plan for largest variable
+    bplan = None
+    for v in svarnames:
+      (nens, ntimes, gdims) = dims[v]
+      p = BPlan(gdims, nens, plantasks if plantasks > 0 else mpiTasks, decomp, tilesz, \
+                nthreads, exchange, symmetric, widthsonly, len(thresholds), \
+                maxmem*1024*1024, scratch, band, sample, prefetch=batch and levchunk == 0, \
+                levchunk=levchunk, maxdist=maxdist, hitfrac=hitfrac, \
+                shared=isinstance(comm, BLocalComm))
+      if bplan is None or p.memory() > bplan.memory():
+        bplan = p
+    return bplan
+
+  # Stream levels, if all levels at once don't fit:
+  bplan = make_plan(levchunk)
+  if levchunk <= 0 and bplan.memory() > budget > 0:
+    nl = bplan.level_chunk(budget)
+    if nl is not None and nl > 0:
+      levchunk = nl
+      bplan    = make_plan(levchunk)
+  levchunk = bplan.levchunk_
+  if mpiRank == 0 and (plan or bplan.memory() > budget > 0):
+    print(bplan.report(budget, ppn))
+    sys.stdout.flush()
+  if plan:
+    sys.exit(0)
+  if bplan.memory() > budget > 0:
+    sys.exit("Error, predicted memory per task exceeds budget; see plan (-plan)!")
+  if mpiRank == 0 and bplan.unbounded():
+    print("main: note: result memory is unbounded, and not planned; set -maxmem or -hitfrac")
+    sys.stdout.flush()
+  A.levchunk_ = levchunk
+
+  pool    = ThreadPoolExecutor(max_workers=1) if batch and levchunk == 0 else None
+  pending = None              # prefetch of next item's data
+  ntimer  = None              # phase timers of the prefetch
+
+  for iitem in range(0, len(items)):
+    (svarname, itime) = items[iitem]
+    (nens, ntimes, gdims) = dims[svarname]
+
+    # Phase timers of this item, reported next to its summary:
+    timer = BTimer(comm)
+    opref = soutprefix
+    if batch:
+      opref = soutprefix + "." + svarname + ".t" + str(itime)
+
+    # Get the local data. If levels are streamed, the analyzer reads
+    # it by chunk of levels. Prefetches are read by each task alone
+    # (comm None), so no MPI calls are made off the main thread:
+    if levchunk > 0:
+      source = filename
+    elif pending is not None:
+      timer.start('prefetch')
+      source = pending.result()
+      timer.stop('prefetch')
+      timer.merge(ntimer)           # phases of the prefetch itself
+    else:
+      source = A.read(filename, svarname, itime, timer, comm)
+    if mpiRank == 0:
+      print (mpiRank, ": main: item..........................",svarname, itime)
+      print (mpiRank, ": main: constructing BTools, nens   =",nens)
+      print (mpiRank, ": main: constructing BTools, gdims  =",gdims)
+      if levchunk > 0:
+        print (mpiRank, ": main: levels streamed per chunk...",levchunk)
+      else:
+        N = source[0][0] if isinstance(source[0], tuple) else source[0]
+        print (mpiRank, ": main: constructing BTools, N.shape=",N.shape)
+        N = None
+      sys.stdout.flush()
+
+    # Start reading next item's data, overlapping this item's compute:
+    pending = None
+    if iitem+1 < len(items) and pool is not None:
+      ntimer  = BTimer(comm)
+      pending = pool.submit(A.read, filename, items[iitem+1][0], items[iitem+1][1], ntimer)
+
+    # Here's where the work is done!
+    t0 = time.time()
+    R  = A.analyze(source, thresholds, svarname, itime, timer=timer)
+    source = None
+
+    # Write out the results:
+    if R.B_ is not None:
+      if pending is not None:   # NetCDF isn't thread-safe
+        wait([pending])
+      timer.start('write')
+      attrs = {"threshold": thresholds[0], "decimation": decfact}
+      if ofmt == 'csr':
+        A.tools_.writeSparse(R.B_, R.I_, R.J_, opref, attrs)
+      else:
+        A.tools_.writeResults(R.B_, R.I_, R.J_, opref, mpiRank, attrs)
+      timer.stop('write', nbytes=R.B_.nbytes+R.I_.nbytes+R.J_.nbytes)
+      R.B_ = R.I_ = R.J_ = None
+
+    # Write width distributions to files:
+    for it in range(0, len(R.gwidths_)):
+      timer.start('write')
+      if mpiRank == 0:
+        wfilename = opref + "." + "width" + "." + str(thresholds[it]) + "." + str(decfact) + ".txt"
+        np.savetxt(wfilename, R.gwidths_[it], delimiter="\n")
+      R.gwidths_[it] = None
+      timer.stop('write')
+
+    # Compute total run time:
+    ldt = time.time() - t0;
+    gdt = comm.allreduce(ldt, op=MPI.MAX) # global number of entries
+
+    comm.barrier()
+
+    ntrunc = R.ntrunc_
+    nstop  = R.nstop_
+    for it in range(0, len(thresholds)):
+      threshold = thresholds[it]
+      gcount    = int(R.counts_[it])
+      maxWidth, irowmax, avgWidth, avgWidth1 = R.stats(it)
+      if mpiRank == 0:
+        sfilename = opref + "." + "summary" + "." + str(threshold) + "." + str(decfact) + ".txt"
+        f = open(sfilename,'w')
+        f.write("main: input file..................: %s\n"% filename)
+        f.write("main: input variable............. : %s\n"% svarname)
+        f.write("main: input time index........... : %d\n"% itime)
+        if levels is not None:
+          f.write("main: input levels............... : %s\n"% " ".join([str(k) for k in levels]))
+          f.write("main: levels streamed per chunk.. : %d\n"% levchunk)
+        f.write("main: max number entries ........ : %d\n"% (np.prod(gdims))**2)
+        f.write("main: decimation factor.......... : %d\n"% decfact)
+        f.write("main: corr. coeff. threshold..... : %f\n"% threshold)
+        f.write("main: number entries > threshold  : %d\n"% gcount)
+        f.write("main: data written to file........: %s\n"% opref)
+        f.write("main: max possible ribbon width...: %d\n"% np.prod(gdims))
+        f.write("main: max ribbon width............: %d\n"% maxWidth)
+        f.write("main: avg ribbon width............: %d\n"% int(avgWidth+0.5))
+        f.write("main: avg ribbon width no outliers: %d\n"% int(avgWidth1+0.5))
+        f.write("main: row of ribbon width.max.....: %d\n"% irowmax)
+        if sample > 0.0:
+          s = R.samples_[it]
+          f.write("main: sampled rows................: %d of %d\n"% (s["nsample"], s["nrows"]))
+          f.write("main: confidence level............: %f\n"% s["level"])
+          f.write("main: number entries > thresh. CI : %d %d\n"% (int(s["countCI"][0]+0.5), int(s["countCI"][1]+0.5)))
+          f.write("main: frac. rows > max width, max : %f\n"% s["maxWidthExceed"])
+          f.write("main: avg ribbon width CI.........: %f %f\n"% s["avgWidthCI"])
+          f.write("main: avg ribbon width no outl. CI: %f %f\n"% s["avgWidth1CI"])
+        if band > 0:
+          f.write("main: banded search shell width...: %d\n"% band)
+          f.write("main: rows truncated at maxdist...: %d\n"% ntrunc)
+          f.write("main: rows stopped for patience...: %d\n"% nstop)
+        f.write("main: execution time..............: %f\n"% gdt)
+        f.close()
+        print(mpiRank, ": main: input file..................: ", filename)
+        print(mpiRank, ": main: input variable..............: ", svarname)
+        print(mpiRank, ": main: input time index............: ", itime)
+        if levels is not None:
+          print(mpiRank, ": main: input levels................: ", levels)
+          print(mpiRank, ": main: levels streamed per chunk...: ", levchunk)
+        print(mpiRank, ": main: max number entries .........: ", (np.prod(gdims))**2)
+        print(mpiRank, ": main: decimation factor...........: ", decfact)
+        print(mpiRank, ": main: corr. coeff. threshold......: ", threshold)
+        print(mpiRank, ": main: number entries > threshold..: ", gcount)
+        print(mpiRank, ": main: data written to file........: ", opref)
+        print(mpiRank, ": main: max possible ribbon width...: ", np.prod(gdims))
+        print(mpiRank, ": main: max ribbon width............: ", maxWidth)
+        print(mpiRank, ": main: avg ribbon width............: ", int(avgWidth+0.5))
+        print(mpiRank, ": main: avg ribbon width no outliers: ", int(avgWidth1+0.5))
+        print(mpiRank, ": main: row of ribbon width.max.....: ", irowmax)
+        if sample > 0.0:
+          print(mpiRank, ": main: sampled rows................: ", s["nsample"], " of ", s["nrows"])
+          print(mpiRank, ": main: number entries > thresh. CI : ", s["countCI"])
+          print(mpiRank, ": main: frac. rows > max width, max : ", s["maxWidthExceed"])
+          print(mpiRank, ": main: avg ribbon width CI.........: ", s["avgWidthCI"])
+          print(mpiRank, ": main: avg ribbon width no outl. CI: ", s["avgWidth1CI"])
+        if band > 0:
+          print(mpiRank, ": main: rows truncated at maxdist...: ", ntrunc)
+          print(mpiRank, ": main: rows stopped for patience...: ", nstop)
+        print(mpiRank, ": main: execution time..............: ", gdt)
+
+    # Write phase timing report:
+    tfilename = opref + "." + "timing" + "." + "-".join([str(t) for t in thresholds]) \
+              + "." + str(decfact) + ".json"
+    timer.write(tfilename, {"input file"    : filename,
+                            "input variable": svarname,
+                            "input time"    : itime,
+                            "input levels"  : levels,
+                            "levels per chunk": levchunk,
+                            "dims"          : gdims,
+                            "nens"          : nens,
+                            "thresholds"    : thresholds,
+                            "decimation"    : decfact,
+                            "exchange"      : exchange,
+                            "symmetric"     : symmetric,
+                            "widths only"   : widthsonly,
+                            "threads"       : nthreads,
+                            "decomposition" : decomp,
+                            "sample"        : sample,
+                            "band"          : band,
+                            "execution time": gdt})
+    if mpiRank == 0:
+      print(mpiRank, ": main: timing report written to...: ", tfilename)
+
+    # Results are written, so checkpoints of this item are removed:
+    A.tools_.ckpt_clear()
+
+  if pool is not None:
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,462 @@
+################################################################
+#  Module: boffline.py
+#  Desc  : Provides an offline analyzer of B-matrix results already
+#          written by bmata: per-task B,I,J files (see
+#          BTools.writeResults), or CSR files (see BSparse). Row
+#          extents (Jmin, Jmax) & entry counts, and optionally entry
+#          counts by lag |J - I|, are accumulated from the files a
+#          chunk of entries at a time, by a pool of processes, each
+#          scanning whole files; their row data are merged as they
+#          complete, so that memory is bounded by grid size, not by
+#          number of entries. Given each point's variance, entries
+#          may be re-thresholded, at one or more (stricter) corr
+#          coeff thresholds. Width & summary files are written as by
+#          bmata.
+#
+#          Usage:
+#            python boffline.py -ipref Bmatrix -infile Tmerged17.nc \
+#                   -dfact 8 -thresh 0.97 0.98 -var Tvar.npy
+################################################################
+import os, sys
+import argparse
+import glob
+import math
+import re
+import time
+import multiprocessing as mp
+import numpy as np
+from   netCDF4 import Dataset
+
+
+class BOffline:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Finds the result files of a run
+    #  Args  : ipref   (in): prefix of result files: B,I,J files are
+    #                        <ipref>.<rank>.nc; a CSR index is
+    #                        <ipref>.csr.json
+    #          npts    (in): number of grid points (B-matrix rows);
+    #                        None: from CSR index
+    #          var     (in): variance (<T'T'>) of each point, in
+    #                        global index order, to re-threshold
+    #                        entries (None: entries are not
+    #                        re-thresholded)
+    #          chunk   (in): entries read at once
+    #          nproc   (in): processes scanning files (0: one per core)
+    #          lags    (in): also count entries by lag |J - I|
+    # Returns: none
+    ################################################################
+    def __init__(self, ipref, npts=None, var=None, chunk=1<<20, nproc=0, lags=False):
+
+        self.ipref_ = ipref
+        self.chunk_ = max(int(chunk), 1)
+        self.nproc_ = nproc if nproc > 0 else (os.cpu_count() or 1)
+        self.lags_  = lags
+        self.attrs_ = {}            # attributes stored with results
+
+        if os.path.exists(ipref + ".csr.json"):
+          from bsparse import BSparseReader
+          R = BSparseReader(ipref)
+          self.csr_   = True
+          self.units_ = list(range(0, len(R.files_)))
+          self.attrs_ = R.index_["attrs"]
+          if npts is None:
+            npts = R.nrows_
+          R = None
+        else:
+          # Files <ipref>.<rank>.nc, in rank order:
+          pat   = re.compile(re.escape(os.path.basename(ipref)) + r"\.([0-9]+)\.nc$")
+          files = [(int(m.group(1)), f) for f in glob.glob(glob.escape(ipref) + ".*.nc") \
+                   for m in [pat.match(os.path.basename(f))] if m is not None]
+          self.csr_   = False
+          self.units_ = [f for (r, f) in sorted(files)]
+        if len(self.units_) == 0:
+          sys.exit("Error, no result files with prefix " + ipref + "!")
+        if not self.csr_:
+          nc = Dataset(self.units_[0], 'r')
+          for a in nc.ncattrs():
+            v = nc.getncattr(a)
+            self.attrs_[a] = v.item() if isinstance(v, np.generic) else v
+          nc.close()
+        if npts is None:
+          sys.exit("Error, number of grid points required!")
+        self.npts_ = int(npts)
+
+        self.var_  = None
+        if var is not None:
+          self.var_ = np.asarray(var, dtype=np.float64)
+          if len(self.var_) != self.npts_:
+            sys.exit("Error, variance has wrong size!")
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: variance
+    #  Desc  : Compute the variance of each point of an ensemble
+    #          variable, as standardized by BTools, reading the
+    #          (decimated) grid in nparts contiguous parts of points,
+    #          so that memory is bounded
+    #  Args  : filename : input file name
+    #          varname  : ensemble variable name
+    #          itime    : time index
+    #          decfact  : decimation factor in x, y
+    #          levels   : vertical levels (None: first level only)
+    #          nparts   : number of parts read
+    # Returns: variance of each point, in global index order
+    ################################################################
+    @staticmethod
+    def variance(filename, varname, itime, decfact, levels=None, nparts=16):
+
+        import btools
+
+        (nens, ntimes, gdims) = btools.BTools.getDims(filename, varname, decfact, levels)
+        npts   = int(np.prod(gdims))
+        nparts = max(min(int(nparts), npts), 1)
+        var    = np.empty(npts, dtype=np.float64)
+        for ip in range(0, nparts):
+          N = btools.BTools.getSlabData(filename, varname, itime, nparts, ip, 2, decfact, \
+                                        decomp='points', levels=levels)[0]
+          (ib, ie) = btools.BTools.range(npts, nparts, ip)
+          var[ib:ie+1] = np.einsum('ep,ep->p', N, N, dtype=np.float64) / nens
+          N = None
+
+        return var  # end, variance method
+
+
+    ################################################################
+    #  Method: run
+    #  Desc  : Scan all result files, by pool of processes, and merge
+    #          their row data
+    #  Args  : thresholds: list of corr coeff thresholds to keep
+    #                      entries at, if re-thresholding; otherwise
+    #                      a single (nominal) threshold
+    # Returns: list, for each threshold, of dict of:
+    #          jmin, jmax: min & max column of each row (-1 & max int64,
+    #                      resp., for rows with no entries)
+    #          count     : number of entries in each row
+    #          lag       : number of entries at each lag (lags only)
+    ################################################################
+    def run(self, thresholds):
+
+        state = (self.ipref_, self.csr_, self.npts_, self.var_, list(thresholds), \
+                 self.chunk_, self.lags_)
+        res   = None
+        if self.nproc_ == 1 or len(self.units_) == 1:
+          BOffline.init_worker(state)
+          for u in self.units_:
+            res = BOffline.merge(res, BOffline.scan(u))
+        else:
+          ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else None)
+          with ctx.Pool(min(self.nproc_, len(self.units_)), BOffline.init_worker, (state,)) as pool:
+            for r in pool.imap_unordered(BOffline.scan, self.units_):
+              res = BOffline.merge(res, r)
+
+        return res  # end, run method
+
+
+    state_ = None               # scan settings of a worker (see run)
+
+    ################################################################
+    #  Method: init_worker
+    #  Desc  : Set scan settings of a worker process
+    #  Args  : state  : (ipref, csr, npts, var, thresholds, chunk, lags)
+    # Returns: none
+    ################################################################
+    @staticmethod
+    def init_worker(state):
+
+        BOffline.state_ = state
+
+        return # end, init_worker method
+
+
+    ################################################################
+    #  Method: scan
+    #  Desc  : Accumulate row data of one result file, a chunk of
+    #          entries at a time
+    #  Args  : unit   : B,I,J file name, or CSR file number
+    # Returns: row data, as for run
+    ################################################################
+    @staticmethod
+    def scan(unit):
+
+        (ipref, csr, npts, var, thresh, chunk, lags) = BOffline.state_
+        res = [{"jmin" : np.full(npts, np.iinfo(np.int64).max, dtype=np.int64),
+                "jmax" : np.full(npts, -1, dtype=np.int64),
+                "count": np.zeros(npts, dtype=np.int64),
+                "lag"  : np.zeros(npts, dtype=np.int64) if lags else None} for t in thresh]
+
+        if csr:
+          from bsparse import BSparseReader
+          R = BSparseReader(ipref)
+          (nc, rowptr) = R.file(unit)
+          row0 = R.files_[unit]["row0"]
+          nnz  = int(rowptr[-1])
+        else:
+          nc   = Dataset(unit, 'r')
+          nc.set_auto_mask(False)
+          nnz  = len(nc.dimensions['nResults'])
+
+        for p0 in range(0, nnz, chunk):
+          p1 = min(p0 + chunk, nnz)
+          B  = np.asarray(nc.variables['B'][p0:p1], dtype=np.float64)
+          if csr:
+            I = row0 + np.searchsorted(rowptr, np.arange(p0, p1), side='right') - 1
+            J = I + np.asarray(nc.variables['col'][p0:p1], dtype=np.int64)
+          else:
+            I = np.asarray(nc.variables['I'][p0:p1], dtype=np.int64)
+            J = np.asarray(nc.variables['J'][p0:p1], dtype=np.int64)
+
+          # Corr. coeff = covariance / sqrt(CII*CJJ):
+          corr = None
+          if var is not None:
+            sd   = np.sqrt(var[I]*var[J])
+            corr = np.zeros(len(B))
+            np.divide(np.abs(B), sd, out=corr, where=sd > 0)
+          for it in range(0, len(thresh)):
+            (Ik, Jk) = (I, J)
+            if corr is not None:
+              keep = corr >= thresh[it]
+              if thresh[it] <= 0.0:
+                keep &= sd > 0
+              (Ik, Jk) = (I[keep], J[keep])
+            r = res[it]
+            np.minimum.at(r["jmin"], Ik, Jk)
+            np.maximum.at(r["jmax"], Ik, Jk)
+            r["count"] += np.bincount(Ik, minlength=npts)
+            if lags:
+              r["lag"] += np.bincount(np.abs(Jk - Ik), minlength=npts)
+          B = I = J = corr = None
+
+        if csr:
+          R.close()
+        else:
+          nc.close()
+
+        return res  # end, scan method
+
+
+    ################################################################
+    #  Method: merge
+    #  Desc  : Merge row data of a file into totals
+    #  Args  : tot    : row data totals, as for run (None: none yet)
+    #          res    : row data of a file
+    # Returns: merged totals
+    ################################################################
+    @staticmethod
+    def merge(tot, res):
+
+        if tot is None:
+          return res
+
+        for (t, r) in zip(tot, res):
+          np.minimum(t["jmin"], r["jmin"], out=t["jmin"])
+          np.maximum(t["jmax"], r["jmax"], out=t["jmax"])
+          t["count"] += r["count"]
+          if t["lag"] is not None:
+            t["lag"] += r["lag"]
+
+        return tot  # end, merge method
+
+
+    ################################################################
+    #  Method: widthStats
+    #  Desc  : Ribbon width statistics, as BTools.widthStats, of
+    #          global widths
+    #  Args  : W      : width of each row; < 0 for rows with no
+    #                   entries
+    # Returns: maxWidth, irowmax, avgWidth, avgWidth1 (see
+    #          BTools.widthStats)
+    ################################################################
+    @staticmethod
+    def widthStats(W):
+
+        maxWidth = int(W.max())
+        irowmax  = int(np.argmax(W))
+
+        # Averages, over nonzero widths:
+        Wkeep    = W[W > 0]
+        avgWidth = 0.0
+        if len(Wkeep) > 0:
+          avgWidth = int(np.sum(Wkeep)) / len(Wkeep)
+        stdWidth = math.sqrt(float(np.sum((Wkeep-avgWidth)*(Wkeep-avgWidth))) / max(len(Wkeep), 1))
+
+        Wkeep     = Wkeep[Wkeep < (avgWidth+2*stdWidth)]
+        avgWidth1 = 0.0
+        if len(Wkeep) > 0:
+          avgWidth1 = int(np.sum(Wkeep)) / len(Wkeep)
+
+        return maxWidth, irowmax, avgWidth, avgWidth1  # end, widthStats method
+
+
+# User specifiable data:
+ipref      = "Bmatrix"      # prefix of result files to analyze
+filename   = None           # input file of run (None: not known)
+svarname   = "T"            # input file variable name
+itime      = 0              # time index
+levels     = None           # vertical levels (None = first level only)
+decfact    = 0              # 'decimation factor' of run (0 = from results, else 1)
+npts       = 0              # number of grid points (0 = from results or input file)
+threshold  = None           # corr coeff threshold(s) (None = that of run)
+varfile    = None           # .npy file of point variances (computed from input file if absent)
+soutprefix = None           # output file prefix (None = ipref)
+chunk      = 1048576        # entries read at once
+nproc      = 0              # processes (0 = one per core)
+
+
+# Get command line arguments, from argv (None: sys.argv[1:]):
+def parse_args(argv=None):
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-ipref"  , action="store", dest="ipref"     , \
+                      type=str  , help='result file prefix'        , default=ipref)
+  parser.add_argument("-infile" , action="store", dest="filename"  , \
+                      type=str  , help='input file of run'         , default=filename)
+  parser.add_argument("-varname", action="store", dest="svarname"  , \
+                      type=str  , help='ensemble variable name'    , default=svarname)
+  parser.add_argument("-time"   , action="store", dest="itime"     , \
+                      type=int  , help='time index'                , default=itime)
+  parser.add_argument("-levels" , action="store", dest="levels"    , \
+                      type=str  , help='levels, or ranges a:b[:s]' , default=levels, \
+                      nargs='+')
+  parser.add_argument("-dfact"  , action="store", dest="decfact"   , \
+                      type=int  , help='decimation factor'         , default=decfact)
+  parser.add_argument("-npts"   , action="store", dest="npts"      , \
+                      type=int  , help='number of grid points'     , default=npts)
+  parser.add_argument("-thresh" , action="store", dest="threshold" , \
+                      type=float, help='corr coeff threshold(s)'   , default=threshold, \
+                      nargs='+')
+  parser.add_argument("-var"    , action="store", dest="varfile"   , \
+                      type=str  , help='point variance file (.npy)', default=varfile)
+  parser.add_argument("-opref"  , action="store", dest="soutprefix", \
+                      type=str  , help='output fileprefix'         , default=soutprefix)
+  parser.add_argument("-counts" , action="store_true", dest="counts", \
+                      help='write entry count of each row'         , default=False)
+  parser.add_argument("-lags"   , action="store_true", dest="lags" , \
+                      help='write entry count at each lag |J-I|'   , default=False)
+  parser.add_argument("-chunk"  , action="store", dest="chunk"     , \
+                      type=int  , help='entries read at once'      , default=chunk)
+  parser.add_argument("-nproc"  , action="store", dest="nproc"     , \
+                      type=int  , help='processes'                 , default=nproc)
+
+  return parser.parse_args(argv)
+
+
+################################################################
+#  Method: main
+#  Desc  : Console entry point: analyze result files of a run,
+#          writing width & summary files, as bmata does, and
+#          optionally row count & lag files
+#  Args  : argv   : command line arguments (None: sys.argv[1:])
+# Returns: none
+################################################################
+def main(argv=None):
+
+  from bmata import index_list
+
+  args    = parse_args(argv)
+  t0      = time.time()
+  opref   = args.soutprefix if args.soutprefix is not None else args.ipref
+  levels  = index_list(args.levels, "level") if args.levels is not None else None
+  npts    = args.npts if args.npts > 0 else None
+  decfact = args.decfact
+
+  # Grid size and decimation, from input file, if given:
+  if args.filename is not None:
+    import btools
+    (nens, ntimes, gdims) = btools.BTools.getDims(args.filename, args.svarname, max(decfact, 1), levels)
+    npts = int(np.prod(gdims)) if npts is None else npts
+
+  # Point variances, to re-threshold; computed from the input file,
+  # and stored, if the variance file isn't there yet:
+  var = None
+  if args.varfile is not None:
+    if os.path.exists(args.varfile):
+      var = np.load(args.varfile)
+    elif args.filename is not None:
+      var = BOffline.variance(args.filename, args.svarname, args.itime, max(decfact, 1), levels)
+      np.save(args.varfile, var)
+    else:
+      sys.exit("Error, variance file " + args.varfile + " not found, and no input file!")
+    npts = len(var) if npts is None else npts
+
+  A = BOffline(args.ipref, npts, var, args.chunk, args.nproc, args.lags)
+  if decfact <= 0:
+    decfact = int(A.attrs_.get("decimation", 1))
+  thresholds = args.threshold
+  known      = "threshold" in A.attrs_
+  if thresholds is None:
+    if not known:
+      sys.exit("Error, threshold of results unknown; give it (-thresh), with point variances (-var)!")
+    thresholds = [float(A.attrs_["threshold"])]
+  # Without variances, entries are kept as stored, so only the
+  # threshold of the results, if known, can be given:
+  if var is None and (len(thresholds) > 1 or not known or \
+                      thresholds[0] != float(A.attrs_["threshold"])):
+    sys.exit("Error, re-thresholding needs point variances (-var)" + \
+             ("" if known else "; threshold of results unknown") + "!")
+  if var is not None and "threshold" in A.attrs_ and min(thresholds) < float(A.attrs_["threshold"]):
+    print("boffline: warning: entries below threshold of results,", A.attrs_["threshold"], \
+          ", aren't stored")
+
+  print("boffline: result files..............: ", len(A.units_), "CSR" if A.csr_ else "B,I,J")
+  print("boffline: grid points...............: ", A.npts_)
+  print("boffline: processes.................: ", min(A.nproc_, len(A.units_)))
+  sys.stdout.flush()
+
+  res = A.run(thresholds)
+  gdt = time.time() - t0
+
+  for it in range(0, len(thresholds)):
+    threshold = thresholds[it]
+    r         = res[it]
+    gcount    = int(np.sum(r["count"]))
+
+    # Ribbon width of each row, and statistics:
+    W = np.where(r["count"] > 0, r["jmax"] - r["jmin"], -1)
+    maxWidth, irowmax, avgWidth, avgWidth1 = BOffline.widthStats(W)
+
+    # Width distribution, and optional row count & lag files:
+    suffix = "." + str(threshold) + "." + str(decfact) + ".txt"
+    W[W < 0] = 0
+    np.savetxt(opref + ".width" + suffix, W.astype('i'), delimiter="\n")
+    if args.counts:
+      np.savetxt(opref + ".count" + suffix, r["count"], fmt="%d")
+    if args.lags:
+      lag = np.nonzero(r["lag"])[0]
+      np.savetxt(opref + ".lag" + suffix, np.stack((lag, r["lag"][lag]), axis=1), fmt="%d")
+
+    f = open(opref + ".summary" + suffix, 'w')
+    if args.filename is not None:
+      f.write("main: input file..................: %s\n"% args.filename)
+      f.write("main: input variable............. : %s\n"% args.svarname)
+      f.write("main: input time index........... : %d\n"% args.itime)
+      if levels is not None:
+        f.write("main: input levels............... : %s\n"% " ".join([str(k) for k in levels]))
+    else:
+      f.write("main: input results...............: %s\n"% args.ipref)
+    f.write("main: max number entries ........ : %d\n"% A.npts_**2)
+    f.write("main: decimation factor.......... : %d\n"% decfact)
+    f.write("main: corr. coeff. threshold..... : %f\n"% threshold)
+    f.write("main: number entries > threshold  : %d\n"% gcount)
+    f.write("main: data written to file........: %s\n"% args.ipref)
+    f.write("main: max possible ribbon width...: %d\n"% A.npts_)
+    f.write("main: max ribbon width............: %d\n"% maxWidth)
+    f.write("main: avg ribbon width............: %d\n"% int(avgWidth+0.5))
+    f.write("main: avg ribbon width no outliers: %d\n"% int(avgWidth1+0.5))
+    f.write("main: row of ribbon width.max.....: %d\n"% irowmax)
+    f.write("main: execution time..............: %f\n"% gdt)
+    f.close()
+    print("boffline: corr. coeff. threshold......: ", threshold)
+    print("boffline: number entries > threshold..: ", gcount)
+    print("boffline: max ribbon width............: ", maxWidth)
+    print("boffline: avg ribbon width............: ", int(avgWidth+0.5))
+    print("boffline: avg ribbon width no outliers: ", int(avgWidth1+0.5))
+    print("boffline: row of ribbon width.max.....: ", irowmax)
+  print("boffline: execution time..............: ", gdt)
+
+
+if __name__ == "__main__":
+  main()
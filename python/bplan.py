@@ -0,0 +1,348 @@
+################################################################
+#  Module: bplan.py
+#  Desc  : Provides a memory, communication & runtime planner for
+#          BTools/bmata runs, computed from problem dims alone,
+#          before anything is allocated
+################################################################
+import numpy as np
+import os
+from   bdecomp import BDecomp
+
+
+class BPlan:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Arguments are as for BTools (and bmata);
+    #          estimates are for the most heavily loaded task
+    #  Args  : gn       (in): global grid dims, (Nz, Ny, Nx)
+    #          nens     (in): number of ensemble members
+    #          nprocs   (in): number of tasks
+    #          decomp   (in): domain decomposition mode
+    #          tilesz   (in): correlation tile size
+    #          nthreads (in): threads per task
+    #          exchange (in): slab exchange mode
+    #          symmetric(in): symmetric mode
+    #          widthsonly(in): widths only (no B stored)
+    #          nthresh  (in): number of thresholds
+    #          maxmem   (in): cap on result memory per task, bytes
+    #          scratch  (in): out-of-core scratch dir (None: in-core)
+    #          band     (in): banded search shell width (0: off)
+    #          sample   (in): fraction of rows sampled (0: all)
+    #          itemsz   (in): bytes per data value
+    #          prefetch (in): next input slab is read during compute
+    #                         (batch runs)
+    #          levchunk (in): levels streamed per chunk (0: all)
+    #          maxdist  (in): banded search distance limit (0: none)
+    #          hitfrac  (in): expected fraction of B-matrix entries
+    #                         meeting threshold, to estimate result
+    #                         memory with no cap (0: unknown)
+    #          shared   (in): single-node (local) backend; slabs of all
+    #                         tasks are held once, in shared memory
+    # Returns: none
+    ################################################################
+    def __init__(self, gn, nens, nprocs, decomp='x', tilesz=512, nthreads=1,
+                 exchange='allgather', symmetric=False, widthsonly=False, nthresh=1,
+                 maxmem=0, scratch=None, band=0, sample=0.0, itemsz=4, prefetch=False,
+                 levchunk=0, maxdist=0, hitfrac=0.0, shared=False):
+
+        self.gn_       = [int(n) for n in gn]
+        self.nens_     = int(nens)
+        self.nprocs_   = int(nprocs)
+        self.decomp_   = decomp
+        self.tilesz_   = int(tilesz)
+        self.nthreads_ = int(nthreads)
+        self.exchange_ = exchange
+        self.symmetric_= symmetric and sample <= 0.0
+        self.widths_   = widthsonly or nthresh > 1 or sample > 0.0
+        self.nthresh_  = int(nthresh)
+        self.maxmem_   = int(maxmem)
+        self.scratch_  = scratch
+        self.band_     = int(band)
+        self.sample_   = float(sample)
+        self.itemsz_   = int(itemsz)
+        self.prefetch_ = prefetch
+        self.maxdist_  = int(maxdist)
+        self.hitfrac_  = float(hitfrac)
+        self.shared_   = shared
+
+        D = BDecomp(self.gn_, self.nprocs_, decomp)
+        self.ntot_   = int(np.prod(self.gn_))
+        self.nptmax_ = int(D.counts_.max())
+
+        # Banded search gathers points of tasks near a task's points
+        # (see BTools.gather_near); here, of the most loaded task:
+        self.nnear_  = self.ntot_
+        if self.band_ > 0 and self.maxdist_ > 0:
+          self.nnear_= int(D.counts_[D.near(int(np.argmax(D.counts_)), self.maxdist_)].sum())
+
+        # Streamed levels, as in BTools: slab buffers hold the largest
+        # chunk of a slab:
+        nz = self.gn_[0]
+        nl = nz if levchunk <= 0 or self.band_ > 0 else min(int(levchunk), nz)
+        self.levchunk_ = nl if nl < nz else 0
+        self.nchunks_  = -(-nz//nl)
+        self.nptchunk_ = self.nptmax_
+        if self.nchunks_ > 1:
+          self.symmetric_= False
+          self.nptchunk_ = int(max([np.diff(D.segment(i, kb, min(kb+nl, nz)-1))[0] \
+                                    for i in range(0, self.nprocs_) for kb in range(0, nz, nl)]))
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: buffers
+    #  Desc  : Predicted memory of each major buffer of a task.
+    #          Buffers held in scratch files out-of-core count as 0
+    #  Args  : tilesz : tile size (default: as constructed)
+    # Returns: list of (name, bytes)
+    ################################################################
+    def buffers(self, tilesz=None):
+
+        ts    = self.tilesz_ if tilesz is None else int(tilesz)
+        npl   = self.nptchunk_
+        slab  = self.nens_*npl*self.itemsz_
+        core  = self.scratch_ is None
+        nslot = self.nprocs_ if self.exchange_ == 'allgather' or self.shared_ else 2
+
+        # Slabs are exchanged standardized, with their RMS, and used in
+        # place; only local slabs are standardized:
+        sdsz  = npl*8
+        if self.nchunks_ > 1:
+          b = [("input chunks p,q (read&anomaly)", 4*slab),
+               ("standardized local chunks p, q" , 2*slab if core else 0)]
+        else:
+          b = [("input slab (read & anomaly)"    , 2*slab),
+               ("standardized local slab"        , slab if core else 0)]
+        b += [("receive buffer (%d slabs)"%nslot, nslot*slab if core else 0),
+              ("receive buffer, slab RMS"       , nslot*sdsz),
+              ("tile workspace (%d threads)"%self.nthreads_,
+                                                  self.nthreads_*min(ts, npl)*min(ts, self.ntot_) \
+                                                  *(2*self.itemsz_ + 1))]
+
+        if self.prefetch_:
+          b.append(("prefetched input slab"        , 2*slab))
+
+        if self.band_ > 0:
+          b.append(("gathered standardized points" , self.nnear_*(self.nens_*self.itemsz_ + 32) \
+                                                    if core else self.nnear_*32))
+
+        if self.widths_:
+          nrows = self.ntot_ if self.symmetric_ else self.nptmax_
+          b.append(("row width accumulators"       , self.nthresh_*(self.nthreads_+1)*nrows*3*8))
+        else:
+          # Entries found aren't known until run; the cap is reserved,
+          # else entries of the expected fraction of this task's rows'
+          # pairs (B, I, J each) are counted, else none (unbounded; see
+          # unbounded). The global width arrays of the ribbon stage are
+          # counted:
+          if self.maxmem_ > 0:
+            b.append(("result entries (cap)"       , self.maxmem_))
+          elif self.hitfrac_ > 0.0:
+            b.append(("result entries (%g of pairs)"%self.hitfrac_,
+                                                    int(self.hitfrac_*self.nptmax_*self.ntot_) \
+                                                    *(self.itemsz_ + 16)))
+          else:
+            b.append(("result entries (unbounded)"   , 0))
+          b.append(("global ribbon width arrays"   , 4*self.ntot_*4))
+
+        return b  # end, buffers method
+
+
+    ################################################################
+    #  Method: memory
+    #  Desc  : Predicted peak memory of a task, taken as the sum of
+    #          all buffers
+    #  Args  : tilesz : tile size (default: as constructed)
+    # Returns: bytes
+    ################################################################
+    def memory(self, tilesz=None):
+
+        return sum([n for (name, n) in self.buffers(tilesz)])  # end, memory method
+
+
+    ################################################################
+    #  Method: unbounded
+    #  Desc  : Check whether result memory is unbounded, and not
+    #          counted in memory: B entries are stored, with neither
+    #          a cap, nor an expected fraction of entries
+    #  Args  : none
+    # Returns: True if unbounded
+    ################################################################
+    def unbounded(self):
+
+        return not self.widths_ and self.maxmem_ <= 0 and self.hitfrac_ <= 0.0  # end, unbounded method
+
+
+    ################################################################
+    #  Method: comm_volume
+    #  Desc  : Predicted bytes of slab data received by a task. With
+    #          streamed levels, each chunk is exchanged once for each
+    #          chunk of rows
+    #  Args  : none
+    # Returns: bytes
+    ################################################################
+    def comm_volume(self):
+
+        slab   = self.nens_*self.nptmax_*self.itemsz_
+        nsteps = self.nprocs_
+        if self.symmetric_ and self.band_ == 0:
+          nsteps = self.nprocs_//2 + 1
+
+        return (nsteps-1)*slab*self.nchunks_  # end, comm_volume method
+
+
+    ################################################################
+    #  Method: flops
+    #  Desc  : Predicted correlation flops of a task (2 per member
+    #          per pair of points). In banded mode this is an upper
+    #          bound.
+    #  Args  : none
+    # Returns: flops
+    ################################################################
+    def flops(self):
+
+        rows = self.nptmax_
+        if self.sample_ > 0.0:
+          rows = max(1, int(round(self.sample_*rows)))
+        f = 2.0*self.nens_*rows*self.ntot_
+        if self.symmetric_ and self.band_ == 0:
+          f *= 0.5
+
+        return f  # end, flops method
+
+
+    ################################################################
+    #  Method: node_budget
+    #  Desc  : Physical memory of this node
+    #  Args  : none
+    # Returns: bytes (0 if unknown)
+    ################################################################
+    @staticmethod
+    def node_budget():
+
+        try:
+          return os.sysconf('SC_PHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+          return 0  # end, node_budget method
+
+
+    ################################################################
+    #  Method: suggest
+    #  Desc  : Suggest tile size, and task count, that fit a memory
+    #          budget per task. Tile size is the largest power of two,
+    #          up to 2048, that fits with this task count; task count
+    #          is the smallest multiple of tasks per node for which
+    #          the configuration fits with the smallest tile size
+    #          (memory is assumed not to grow with task count)
+    #  Args  : budget : bytes of memory per task
+    #          ppn    : tasks per node
+    #          maxprocs: largest task count considered
+    # Returns: (tilesz, nprocs); either is None if none fits
+    ################################################################
+    def suggest(self, budget, ppn=1, maxprocs=65536):
+
+        tile = None
+        for ts in [2048, 1024, 512, 256, 128, 64]:
+          if self.memory(ts) <= budget:
+            tile = ts
+            break
+
+        # Double the number of nodes until it fits, then bisect:
+        ppn    = max(int(ppn), 1)
+        nprocs = None
+        (lo, hi) = (0, 1)
+        while hi*ppn <= maxprocs:
+          if self.fits(hi*ppn, budget):
+            nprocs = hi*ppn
+            break
+          (lo, hi) = (hi, 2*hi)
+        if nprocs is not None:
+          while hi - lo > 1:
+            mid = (lo + hi)//2
+            if self.fits(mid*ppn, budget):
+              hi = mid
+            else:
+              lo = mid
+          nprocs = hi*ppn
+
+        return tile, nprocs  # end, suggest method
+
+
+    ################################################################
+    #  Method: level_chunk
+    #  Desc  : Largest number of levels streamed per chunk for which
+    #          this configuration fits a budget
+    #  Args  : budget : bytes of memory per task
+    # Returns: levels per chunk (0: all levels fit at once; None: no
+    #          chunk size fits)
+    ################################################################
+    def level_chunk(self, budget):
+
+        nz = self.gn_[0]
+        for nl in range(nz, 0, -1):
+          P = BPlan(self.gn_, self.nens_, self.nprocs_, self.decomp_, self.tilesz_, self.nthreads_,
+                    self.exchange_, self.symmetric_, self.widths_, self.nthresh_, self.maxmem_,
+                    self.scratch_, self.band_, self.sample_, self.itemsz_, self.prefetch_, nl,
+                    self.maxdist_, self.hitfrac_, self.shared_)
+          if P.memory() <= budget:
+            return P.levchunk_
+
+        return None  # end, level_chunk method
+
+
+    ################################################################
+    #  Method: fits
+    #  Desc  : Check whether this configuration, with another task
+    #          count, and the smallest tile size, fits a budget
+    #  Args  : nprocs : number of tasks
+    #          budget : bytes of memory per task
+    # Returns: True if it fits
+    ################################################################
+    def fits(self, nprocs, budget):
+
+        P = BPlan(self.gn_, self.nens_, nprocs, self.decomp_, 64, self.nthreads_, 
+                  self.exchange_, self.symmetric_, self.widths_, self.nthresh_, self.maxmem_,
+                  self.scratch_, self.band_, self.sample_, self.itemsz_, self.prefetch_,
+                  self.levchunk_, self.maxdist_, self.hitfrac_, self.shared_)
+
+        return P.memory() <= budget  # end, fits method
+
+
+    ################################################################
+    #  Method: report
+    #  Desc  : Format plan as text
+    #  Args  : budget : bytes of memory per task (0: not checked)
+    #          ppn    : tasks per node
+    # Returns: report string
+    ################################################################
+    def report(self, budget=0, ppn=1):
+
+        MB = 1024.0*1024.0
+        r  = []
+        r.append("plan: grid (Nz, Ny, Nx)...........: %s" % str(self.gn_))
+        r.append("plan: ensemble members............: %d" % self.nens_)
+        r.append("plan: tasks, decomposition........: %d, %s" % (self.nprocs_, self.decomp_))
+        r.append("plan: max points per task.........: %d" % self.nptmax_)
+        if self.nchunks_ > 1:
+          r.append("plan: levels streamed per chunk...: %d (%d chunks, max %d points per task)" \
+                   % (self.levchunk_, self.nchunks_, self.nptchunk_))
+        r.append("plan: predicted memory per task (MB):")
+        for (name, n) in self.buffers():
+          r.append("plan:   %-32s: %12.1f" % (name, n/MB))
+        r.append("plan:   %-32s: %12.1f" % ("total", self.memory()/MB))
+        if self.unbounded():
+          r.append("plan: result entries are UNBOUNDED, and not counted in total; set a cap")
+          r.append("plan: (-maxmem), or an expected fraction of entries (-hitfrac)")
+        r.append("plan: slab data received (MB).....: %.1f" % (self.comm_volume()/MB))
+        r.append("plan: correlation GFlop per task..: %.3f" % (self.flops()/1.0e9))
+        if budget > 0:
+          (ts, p) = self.suggest(budget, ppn)
+          r.append("plan: memory budget per task (MB).: %.1f (%d tasks per node)" % (budget/MB, ppn))
+          r.append("plan: fits budget.................: %s" % ("yes" if self.memory() <= budget else "NO"))
+          r.append("plan: suggested tile size.........: %s" % (str(ts) if ts else "none fits"))
+          r.append("plan: suggested task count........: %s" % (str(p) if p else "none fits"))
+
+        return "\n".join(r)  # end, report method
+
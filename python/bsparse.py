@@ -0,0 +1,254 @@
+################################################################
+#  Module: bsparse.py
+#  Desc  : Provides compact, row-sorted, compressed sparse (CSR)
+#          storage of distributed B-matrix entries, and a reader
+#          that loads individual rows lazily
+################################################################
+from   netCDF4 import Dataset
+from   bcomm import MPI
+import numpy as np
+from   bdecomp import BDecomp
+import json
+import os
+
+
+class BSparse:
+
+    ################################################################
+    #  Method: write
+    #  Desc  : Write distributed B-matrix entries in CSR form. Entries
+    #          are redistributed so that each task holds a contiguous
+    #          range of global rows, sorted by row, then column. Each
+    #          task writes its rows to one NetCDF file:
+    #              rowptr(nrows+1): int64 offset of each row's entries
+    #              col   (nnz)    : int32 column offset from diagonal,
+    #                               J - I (the ribbon offset)
+    #              B     (nnz)    : float32 covariance
+    #          compressed with zlib & shuffle, and task 0 writes a JSON
+    #          index of the files, <prefix>.csr.json. Collective.
+    #  Args  : comm    : MPI communicator
+    #          B       : this task's covariances
+    #          I, J    : this task's global row, column indices
+    #          nrows   : number of global rows (& columns)
+    #          prefix  : output file prefix
+    #          complevel: zlib compression level (0: none)
+    #          attrs   : dict of global attributes, e.g. threshold
+    # Returns: name of index file
+    ################################################################
+    @staticmethod
+    def write(comm, B, I, J, nrows, prefix, complevel=4, attrs=None):
+
+        assert len(B) == len(I) and len(I) == len(J), "Inconsistent B, I, J sizes"
+        assert nrows < 2**31, "Too many rows for int32 column offsets"
+        myrank = comm.Get_rank()
+        nprocs = comm.Get_size()
+
+        # Contiguous row range of each task:
+        rbounds = np.array([BDecomp.range(nrows, nprocs, i)[0] for i in range(0, nprocs)] \
+                         + [nrows], dtype=np.int64)
+
+        # Send each entry to the task holding its row:
+        I     = np.asarray(I, dtype=np.int64)
+        isort = np.argsort(I, kind='stable')
+        I     = I[isort]
+        J     = np.asarray(J, dtype=np.int64)[isort]
+        B     = np.asarray(B, dtype=np.float32)[isort]
+        isort = None
+        scount = np.diff(np.searchsorted(I, rbounds)).astype(np.int64)
+        rcount = np.empty(nprocs, dtype=np.int64)
+        comm.Alltoall(scount, rcount)
+        sdispl = np.concatenate(([0], np.cumsum(scount)[:-1])).astype(np.int64)
+        rdispl = np.concatenate(([0], np.cumsum(rcount)[:-1])).astype(np.int64)
+        nnz    = int(rcount.sum())
+
+        rI = np.empty(nnz, dtype=np.int64)
+        rJ = np.empty(nnz, dtype=np.int64)
+        rB = np.empty(nnz, dtype=np.float32)
+        comm.Alltoallv([I, (scount, sdispl), MPI.INT64_T], [rI, (rcount, rdispl), MPI.INT64_T])
+        I = None
+        comm.Alltoallv([J, (scount, sdispl), MPI.INT64_T], [rJ, (rcount, rdispl), MPI.INT64_T])
+        J = None
+        comm.Alltoallv([B, (scount, sdispl), MPI.FLOAT  ], [rB, (rcount, rdispl), MPI.FLOAT  ])
+        B = None
+
+        # Sort on (I, J), and build row pointers:
+        (row0, row1) = (int(rbounds[myrank]), int(rbounds[myrank+1]))
+        isort  = np.lexsort((rJ, rI))
+        rI     = rI[isort]
+        col    = (rJ[isort] - rI).astype(np.int32)
+        rJ     = None
+        rB     = rB[isort]
+        isort  = None
+        rowptr = np.searchsorted(rI, np.arange(row0, row1+1, dtype=np.int64)).astype(np.int64)
+        rI     = None
+
+        # Write this task's rows:
+        fileName = prefix + ".csr." + str(myrank) + ".nc"
+        nc = Dataset(fileName, 'w', format='NETCDF4')
+        nc.createDimension('nrowptr', row1-row0+1)
+        nc.createDimension('nnz', None)
+        comp = dict(zlib=complevel > 0, complevel=max(complevel, 1), shuffle=complevel > 0)
+        vptr = nc.createVariable('rowptr', 'i8', ('nrowptr',), **comp)
+        vcol = nc.createVariable('col'   , 'i4', ('nnz',), chunksizes=(1<<18,), **comp)
+        vB   = nc.createVariable('B'     , 'f4', ('nnz',), chunksizes=(1<<18,), **comp)
+        nc.row0  = row0
+        nc.row1  = row1
+        nc.nrows = nrows
+        for (k, v) in (attrs or {}).items():
+          nc.setncattr(k, v)
+        vptr[:] = rowptr
+        vcol[:] = col
+        vB  [:] = rB
+        nc.close()
+
+        # Index of files:
+        allnnz    = comm.gather(nnz, root=0)
+        indexName = prefix + ".csr.json"
+        if myrank == 0:
+          index = {"format": "bsparse-csr",
+                   "nrows" : int(nrows),
+                   "nnz"   : int(sum(allnnz)),
+                   "attrs" : dict([(k, v) for (k, v) in (attrs or {}).items()]),
+                   "files" : [{"file": os.path.basename(prefix) + ".csr." + str(i) + ".nc",
+                               "row0": int(rbounds[i]),
+                               "row1": int(rbounds[i+1]),
+                               "nnz" : int(allnnz[i])} for i in range(0, nprocs)]}
+          with open(indexName, 'w') as f:
+            json.dump(index, f, indent=2)
+            f.write("\n")
+        comm.barrier()
+
+        return indexName  # end, write method
+
+
+
+class BSparseReader:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Opens CSR index; row files are opened,
+    #          and their row pointers read, only when first needed,
+    #          and entries are read a row (or range of rows) at a time
+    #  Args  : indexName : index file written by BSparse.write, or
+    #                      its prefix
+    # Returns: none
+    ################################################################
+    def __init__(self, indexName):
+
+        if not indexName.endswith(".csr.json"):
+          indexName = indexName + ".csr.json"
+        with open(indexName, 'r') as f:
+          self.index_ = json.load(f)
+        assert self.index_["format"] == "bsparse-csr", "Not a CSR index file"
+
+        self.dir_   = os.path.dirname(os.path.abspath(indexName))
+        self.nrows_ = int(self.index_["nrows"])
+        self.nnz_   = int(self.index_["nnz"])
+        self.files_ = self.index_["files"]
+        self.row0_  = np.array([f["row0"] for f in self.files_], dtype=np.int64)
+        self.open_  = {}    # file number -> (Dataset, rowptr)
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: close
+    #  Desc  : Close any open row files
+    #  Args  : none
+    # Returns: none
+    ################################################################
+    def close(self):
+
+        for (nc, rowptr) in self.open_.values():
+          nc.close()
+        self.open_ = {}
+
+        return # end, close method
+
+
+    ################################################################
+    #  Method: file
+    #  Desc  : Open row file, if not already open
+    #  Args  : ifile : file number
+    # Returns: (Dataset, rowptr)
+    ################################################################
+    def file(self, ifile):
+
+        if ifile not in self.open_:
+          nc = Dataset(os.path.join(self.dir_, self.files_[ifile]["file"]), 'r')
+          nc.set_auto_mask(False)
+          self.open_[ifile] = (nc, np.asarray(nc.variables['rowptr'][:]))
+
+        return self.open_[ifile]  # end, file method
+
+
+    ################################################################
+    #  Method: rows
+    #  Desc  : Read entries of a range of global rows
+    #  Args  : ib    : first row
+    #          ie    : one past last row (default: ib+1)
+    # Returns: I, J  : int64 global row, column indices
+    #          B     : float32 covariances
+    #          sorted by row, then column
+    ################################################################
+    def rows(self, ib, ie=None):
+
+        if ie is None:
+          ie = ib + 1
+        assert 0 <= ib and ib <= ie and ie <= self.nrows_, "Invalid row range"
+
+        Is, Js, Bs = [], [], []
+        ifile = int(np.searchsorted(self.row0_, ib, side='right')) - 1
+        while ifile < len(self.files_) and ib < ie:
+          f  = self.files_[ifile]
+          i1 = min(ie, f["row1"])
+          if i1 > ib:
+            (nc, rowptr) = self.file(ifile)
+            p0  = int(rowptr[ib-f["row0"]])
+            p1  = int(rowptr[i1-f["row0"]])
+            cnt = np.diff(rowptr[ib-f["row0"]:i1-f["row0"]+1])
+            I   = np.repeat(np.arange(ib, i1, dtype=np.int64), cnt)
+            Is.append(I)
+            Js.append(I + np.asarray(nc.variables['col'][p0:p1], dtype=np.int64))
+            Bs.append(np.asarray(nc.variables['B'][p0:p1]))
+            ib = i1
+          ifile += 1
+
+        if len(Is) == 0:
+          return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), \
+                 np.empty(0, dtype=np.float32)
+
+        return np.concatenate(Is), np.concatenate(Js), np.concatenate(Bs)  # end, rows method
+
+
+    ################################################################
+    #  Method: row
+    #  Desc  : Read entries of one global row
+    #  Args  : i     : row
+    # Returns: J     : int64 global column indices, in increasing order
+    #          B     : float32 covariances
+    ################################################################
+    def row(self, i):
+
+        (I, J, B) = self.rows(i, i+1)
+
+        return J, B  # end, row method
+
+
+    ################################################################
+    #  Method: row_counts
+    #  Desc  : Number of entries in each global row, from row
+    #          pointers only
+    #  Args  : none
+    # Returns: int64 array of length nrows
+    ################################################################
+    def row_counts(self):
+
+        counts = np.zeros(self.nrows_, dtype=np.int64)
+        for ifile in range(0, len(self.files_)):
+          f = self.files_[ifile]
+          if f["row1"] > f["row0"]:
+            counts[f["row0"]:f["row1"]] = np.diff(self.file(ifile)[1])
+
+        return counts  # end, row_counts method
+
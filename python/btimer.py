@@ -0,0 +1,206 @@
+################################################################
+#  Module: btimer.py
+#  Desc  : Provides phase-level timing, and load-imbalance
+#          instrumentation, for BTools/bmata runs
+################################################################
+import json
+import resource
+import sys
+import time
+import numpy as np
+
+
+class BTimer:
+
+    ################################################################
+    #  Method: __init__
+    #  Desc  : Constructor. Phases are identified by name, and each
+    #          accumulates, over any number of start/stop intervals,
+    #          wall-clock time, bytes moved, and hit counts
+    #  Args  : comm    (in): MPI communicator over which report is
+    #                        reduced (None: this task only)
+    # Returns: none
+    ################################################################
+    def __init__(self, comm=None):
+
+        self.comm_   = comm
+        self.t0_     = time.time()
+        self.phases_ = {}   # name -> [seconds, bytes, hits, calls]
+        self.start_  = {}   # name -> start time of open interval
+
+        # end, constructor
+
+
+    ################################################################
+    #  Method: start
+    #  Desc  : Start an interval of a phase
+    #  Args  : name    : phase name
+    # Returns: none
+    ################################################################
+    def start(self, name):
+
+        self.start_[name] = time.time()
+        if name not in self.phases_:
+          self.phases_[name] = [0.0, 0, 0, 0]
+
+        return # end, start method
+
+
+    ################################################################
+    #  Method: stop
+    #  Desc  : End the open interval of a phase, adding its time,
+    #          and any bytes moved & hits found, to the phase
+    #  Args  : name    : phase name
+    #          nbytes  : bytes moved during interval
+    #          nhits   : hits (e.g. entries found) during interval
+    # Returns: interval length (s)
+    ################################################################
+    def stop(self, name, nbytes=0, nhits=0):
+
+        assert name in self.start_, "Phase " + name + " not started"
+        dt = time.time() - self.start_.pop(name)
+        self.add(name, dt, nbytes, nhits)
+
+        return dt  # end, stop method
+
+
+    ################################################################
+    #  Method: add
+    #  Desc  : Add time, bytes and hits to a phase directly
+    #  Args  : name    : phase name
+    #          dt      : seconds
+    #          nbytes  : bytes moved
+    #          nhits   : hits found
+    # Returns: none
+    ################################################################
+    def add(self, name, dt=0.0, nbytes=0, nhits=0):
+
+        p = self.phases_.setdefault(name, [0.0, 0, 0, 0])
+        p[0] += dt
+        p[1] += int(nbytes)
+        p[2] += int(nhits)
+        p[3] += 1
+
+        return # end, add method
+
+
+    ################################################################
+    #  Method: merge
+    #  Desc  : Add the phase data of another timer to this one, e.g.
+    #          of work done ahead, in the background, for this one's
+    #  Args  : other   : BTimer to merge
+    # Returns: none
+    ################################################################
+    def merge(self, other):
+
+        for (name, p) in other.phases_.items():
+          q = self.phases_.setdefault(name, [0.0, 0, 0, 0])
+          for k in range(0, 4):
+            q[k] += p[k]
+
+        return # end, merge method
+
+
+    ################################################################
+    #  Method: peak_rss
+    #  Desc  : Peak resident set size of this process
+    #  Args  : none
+    # Returns: bytes
+    ################################################################
+    @staticmethod
+    def peak_rss():
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':    # kB, except on macOS
+          rss *= 1024
+
+        return int(rss)  # end, peak_rss method
+
+
+    ################################################################
+    #  Method: report
+    #  Desc  : Reduce phase data over tasks. Collective over comm.
+    #          For each phase, time, bytes & hits are summarized
+    #          by min/mean/max over tasks, with the task holding the
+    #          max (the straggler), and the load imbalance, max/mean
+    #  Args  : root    : task on which report is assembled
+    # Returns: report dict on root; None elsewhere
+    ################################################################
+    def report(self, root=0):
+
+        local = (self.phases_, BTimer.peak_rss(), time.time() - self.t0_)
+        if self.comm_ is None:
+          allr = [local]
+        else:
+          allr = self.comm_.gather(local, root=root)
+          if self.comm_.Get_rank() != root:
+            return None
+
+        # Phases in order first seen, over all tasks:
+        names = []
+        for (phases, rss, wall) in allr:
+          names += [n for n in phases if n not in names]
+
+        phases = {}
+        for n in names:
+          v = np.array([r[0].get(n, [0.0, 0, 0, 0]) for r in allr], dtype=np.float64)
+          phases[n] = {"time" : BTimer.summarize(v[:,0]),
+                       "bytes": BTimer.summarize(v[:,1], True),
+                       "hits" : BTimer.summarize(v[:,2], True),
+                       "calls": int(v[:,3].max())}
+
+        rep = {"ntasks"  : len(allr),
+               "wall"    : BTimer.summarize(np.array([r[2] for r in allr])),
+               "peak_rss": BTimer.summarize(np.array([r[1] for r in allr]), True),
+               "phases"  : phases}
+
+        return rep  # end, report method
+
+
+    ################################################################
+    #  Method: summarize
+    #  Desc  : Summarize a per-task quantity
+    #  Args  : v       : array of value on each task
+    #          integral: if True, values are integers, and total
+    #                    is included
+    # Returns: dict of min, mean, max, argmax task & max/mean
+    ################################################################
+    @staticmethod
+    def summarize(v, integral=False):
+
+        mean = float(np.mean(v))
+        s    = {"min"      : float(v.min()),
+                "mean"     : mean,
+                "max"      : float(v.max()),
+                "max_task" : int(np.argmax(v)),
+                "imbalance": float(v.max())/mean if mean > 0 else 1.0}
+        if integral:
+          for k in ("min", "max"):
+            s[k] = int(s[k])
+          s["total"] = int(np.sum(v))
+
+        return s  # end, summarize method
+
+
+    ################################################################
+    #  Method: write
+    #  Desc  : Write report to a JSON file. Collective over comm.
+    #  Args  : fileName: output file name
+    #          info    : dict of additional run data to include
+    #          root    : task writing the file
+    # Returns: report dict on root; None elsewhere
+    ################################################################
+    def write(self, fileName, info=None, root=0):
+
+        rep = self.report(root)
+        if rep is None:
+          return None
+
+        if info is not None:
+          rep = dict(info, **rep)
+        with open(fileName, 'w') as f:
+          json.dump(rep, f, indent=2)
+          f.write("\n")
+
+        return rep  # end, write method
+
@@ -4,12 +4,22 @@
 #          operations in parallel
 ################################################################
 from   netCDF4 import Dataset
-from   mpi4py import MPI
+import netCDF4
+from   bcomm import MPI, BLocalComm
 import numpy as np
+from   concurrent.futures import ThreadPoolExecutor
+from   baccum import BAccum, BWidths
+from   btimer import BTimer
+from   bdecomp import BDecomp
+from   bsparse import BSparse
+from   bcache import BCache
+from   bcheckpt import BCheckpoint
 import array
 import math
 import sys
 import os
+import tempfile
+import statistics
 
 
 class BTools:
@@ -22,9 +32,53 @@ class BTools:
     #          nens    (in): number of ensembles 
     #          gn      (in): 1d array of global data sizes: (Nz, Ny, Nz)
     #          debug   (in): print debug info (1); else don't (0)
+    #          tilesz  (in): number of points along each edge of
+    #                        correlation tiles in do_thresh. Larger
+    #                        tiles mean fewer, bigger GEMMs, at the
+    #                        cost of tilesz^2 scratch memory
+    #          maxmem  (in): cap, in bytes, on memory used to accumulate
+    #                        entries meeting threshold (0 = no cap)
+    #          exchange(in): how slabs are shared among tasks in buildB:
+    #                        'allgather' (all slabs held by each task) or 
+    #                        'ring' (point-to-point, two slabs held)
+    #          symmetric(in): if True, compute each symmetric pair of
+    #                        B-matrix entries only once in buildB
+    #          nthreads(in): number of threads per task computing 
+    #                        correlation tiles. For best results, 
+    #                        BLAS threading should be disabled 
+    #                        (e.g., OMP_NUM_THREADS=1) when > 1
+    #          scratch (in): directory for out-of-core operation. If set,
+    #                        received slabs, and standardized slabs,
+    #                        are held in memory-mapped scratch files 
+    #                        there, rather than in memory (None: in-core)
+    #          window  (in): out-of-core only: bytes of slab data held
+    #                        in memory at one time (0: 256 MB)
+    #          timer   (in): BTimer in which phase timings are recorded
+    #                        (None: private timer)
+    #          decomp  (in): domain decomposition mode; see BDecomp. 
+    #                        Must be that used to read the data
+    #          band    (in): if > 0, use banded search (see do_banded),
+    #                        with shells this many grid points wide
+    #          patience(in): banded search: stop after this many 
+    #                        consecutive shells without entries
+    #          maxdist (in): banded search: limit of search distance,
+    #                        in grid points (0: none)
+    #          ckptdir (in): directory for checkpoints of thresholding
+    #                        progress, from which an interrupted run
+    #                        resumes (None: no checkpoints)
+    #          ckptint (in): min seconds between checkpoints
+    #          levchunk(in): if > 0, and less than Nz, grid levels are 
+    #                        streamed this many at a time through read,
+    #                        anomaly & thresholding, given a reader of
+    #                        levels in place of data (see thresh_levels).
+    #                        Symmetric mode is then not used, nor is 
+    #                        streaming in banded mode (0: no streaming)
     # Returns: none
     ################################################################
-    def __init__(self, comm, mpiftype, nens, gn, debug=False):
+    def __init__(self, comm, mpiftype, nens, gn, debug=False, tilesz=512, maxmem=0,
+                 exchange='allgather', symmetric=False, nthreads=1, scratch=None, 
+                 window=0, timer=None, decomp='x', band=0, patience=2, 
+                 maxdist=0, ckptdir=None, ckptint=600, levchunk=0):
 
         # Class member data:
         self.comm_      = comm
@@ -37,48 +91,123 @@ class BTools:
         assert len(gn)==3, "Invalid dimension spec"
         self.nens_      = nens
         self.gn_        = gn
+        self.decomp_    = BDecomp(gn, self.nprocs_, decomp)
 
         self.debug_     = debug
+        assert tilesz > 0, "Invalid tile size"
+        self.tilesz_    = int(tilesz)
+        assert exchange in ('allgather', 'ring'), "Invalid exchange mode"
+        self.exchange_  = exchange
+        self.symmetric_ = symmetric
+        assert nthreads > 0, "Invalid number of threads"
+        self.nthreads_  = int(nthreads)
+        self.pool_      = None
+        self.timer_     = timer if timer is not None else BTimer(comm)
+        if self.nthreads_ > 1:
+            self.pool_  = ThreadPoolExecutor(max_workers=self.nthreads_)
 
-        # Create recv buffs for this task:
-        nxmax = 0
-        for i in range(0,self.nprocs_):
-            (ib, ie) = BTools.range(self.gn_[2], self.nprocs_, i)
-            nxmax = max(nxmax, ie-ib+1)
-        
-        self.nxmax_ = nxmax
-        szbuff = nens*nxmax*gn[0]*gn[1]
+        # Banded search:
+        assert band >= 0 and patience > 0 and maxdist >= 0, "Invalid band spec"
+        self.band_      = int(band)
+        self.patience_  = int(patience)
+        self.maxdist_   = int(maxdist)
+        self.truncated_ = np.empty(0, dtype=np.int64)
+        self.stopped_   = np.empty(0, dtype=np.int64)
 
-        if self.debug_:
-          print(self.myrank_, ": __init__: nxmax=",nxmax," szbuff=",szbuff," gn=",gn)
-          sys.stdout.flush()
-        buffdims = ([self.comm_.Get_size(), szbuff])
-        if   mpiftype == MPI.FLOAT:
-            self.recvbuff_ = np.ndarray(buffdims, dtype='f')
-        elif mpiftype == MPI.DOUBLE:
-            self.recvbuff_ = np.ndarray(buffdims, dtype='d')
-        else:
-            assert 0, "Input type must be float or double"
-        
-        self.recvbuff_.fill(self.myrank_)
+        # Chunks of grid levels streamed, (kb, ke):
+        nz = int(gn[0])
+        nl = nz if levchunk <= 0 or self.band_ > 0 else min(int(levchunk), nz)
+        self.chunks_    = [(kb, min(kb+nl, nz)-1) for kb in range(0, nz, nl)]
+        if len(self.chunks_) > 1:
+            self.symmetric_ = False
+
+        # Checkpoint/restart:
+        self.ckpt_      = None
+        self.ckpt_mark_ = None      # entries of accumulators saved
+        if ckptdir is not None:
+            self.ckpt_  = BCheckpoint(ckptdir, self.myrank_, ckptint)
+
+        # Out-of-core window is held as two blocks of points, local 
+        # & remote, each a whole number of tiles:
+        self.scratch_   = scratch
+        self.block_     = 0
+        if self.scratch_ is not None:
+            if window <= 0:
+                window = 256*1024*1024
+            itemsz = 4 if mpiftype == MPI.FLOAT else 8
+            self.block_ = max(self.tilesz_, \
+                          (window//(2*nens*itemsz))//self.tilesz_*self.tilesz_)
 
-        linsz = szbuff**2
+        # Row ordinal offsets of each task's points:
+        self.offsets_ = np.zeros(self.nprocs_+1, dtype=np.int64)
+        self.offsets_[1:] = np.cumsum(self.decomp_.counts_)
+
+        # Create recv buffs for this task, each slot sized to the
+        # largest slab:
+        self.nptmax_ = int(self.decomp_.counts_.max())
+        szbuff = nens*self.nptmax_
+        if len(self.chunks_) > 1:       # a chunk of levels at a time
+            szbuff = nens*max([np.diff(self.decomp_.segment(i, kb, ke))[0] \
+                               for i in range(0, self.nprocs_) for (kb, ke) in self.chunks_])
 
         if self.debug_:
-          print("BTools::__init__: linsz=",linsz)
+          print(self.myrank_, ": __init__: nptmax=",self.nptmax_," szbuff=",szbuff," gn=",gn)
           sys.stdout.flush()
+        if self.exchange_ == 'ring':
+            buffdims = ([2, szbuff])
+        else:
+            buffdims = ([self.comm_.Get_size(), szbuff])
         if   mpiftype == MPI.FLOAT:
-            self.Bp_ = np.zeros(linsz, dtype=np.float32)
+            dtype = 'f'
         elif mpiftype == MPI.DOUBLE:
-            self.Bp_ = np.zeros(linsz, dtype=np.float64)
+            dtype = 'd'
         else:
             assert 0, "Input type must be float or double"
-        self.Ip_ = np.zeros(linsz, dtype=np.int64)
-        self.Jp_ = np.zeros(linsz, dtype=np.int64)
+
+        # Slabs are exchanged standardized (see standardize), each
+        # received into a slot of recvbuff_ as a point-major (npts, 
+        # nens) array, and of sdbuff_, its points' RMS, so that the 
+        # kernel reads them in place. Single-node (local) backend: 
+        # slabs of all tasks are held once, in shared memory, each in
+        # its own slot (see exchange):
+        nslot = szbuff//nens
+        self.shared_ = isinstance(self.comm_, BLocalComm)
+        if self.shared_:
+            self.recvbuff_ = self.comm_.share([self.nprocs_, szbuff], dtype)
+            self.sdbuff_   = self.comm_.share([self.nprocs_, nslot], 'd')
+        else:
+            self.recvbuff_ = self.scratch_array(buffdims, dtype)
+            self.sdbuff_   = np.empty([buffdims[0], nslot], dtype='d')
+        
+        if self.scratch_ is None and not self.shared_:
+            self.recvbuff_.fill(self.myrank_)
+
+        # Result accumulator grows with the number of entries found:
+        self.acc_ = BAccum(self.recvbuff_.dtype, maxbytes=maxmem)
 
 	# end, constructor
 
 
+    ################################################################
+    #  Method: scratch_array
+    #  Desc  : Allocate array, in memory, or, for out-of-core operation,
+    #          memory-mapped to an (unlinked) file in scratch directory
+    #  Args  : shape : array shape
+    #          dtype : array data type
+    # Returns: new, uninitialized array
+    ################################################################
+    def scratch_array(self, shape, dtype):
+
+        if self.scratch_ is None:
+            return np.ndarray(shape, dtype=dtype)
+
+        f = tempfile.TemporaryFile(dir=self.scratch_, prefix="btools."+str(self.myrank_)+".")
+        A = np.memmap(f, dtype=dtype, mode='w+', shape=tuple(shape))
+        f.close()                        # mapping keeps file alive
+
+        return A  # end, scratch_array method
+
+
     ################################################################
     #  Method: range
     #  Desc  : Compute (Fortran) array bounds given global length
@@ -91,75 +220,65 @@ class BTools:
     @staticmethod
     def range(gn, nprocs, myrank):
 
-        gib = 1
-        gie = gn
-
-        i1 = 0
-        i2 = 0
-        ib = 0
-        ie = 0
-
-        i1 = int((gie - gib + 1) / nprocs)
-        i2 = (gie - gib + 1) % nprocs
-               
-        ib = myrank*i1 + gib + min(myrank, i2)
-        ie = ib + i1 - 1
-        if i2 > myrank: 
-           ie = ie + 1
-	
-        return int(ib-1), int(ie-1)  # end, range method
+        return BDecomp.range(gn, nprocs, myrank)  # end, range method
 	
 
     ################################################################
-    #  Method: trans_type
-    #  Desc  : Create MPI data type for doing transfer
-    #          sends & receives
-    #  Args  : imin  (in), 
-    #          imax  (in): max & min of 1st dimension
-    #          jmin  (in), 
-    #          jmax  (in): max & min of 2nd dimension
-    #          kmin  (in), 
-    #          kmax  (in): max & min of 3rd dimension
-    #          ib    (in): local starting index of 1st dimension
-    #          ie    (in): local ending index of 1st dimension
-    #          itype (in): input datatype
-    #          otype(out): new output datatype
-    # Returns: none
+    #  Method: slab_msg
+    #  Desc  : MPI message spec of slab of npts points in a slot of
+    #          recvbuff_. A slab is held standardized, point-major, at
+    #          the start of its slot, so it is sent & received in place
+    #          as its npts*nens leading elements, with no packing, and
+    #          no padding sent
+    #  Args  : j     : slot
+    #          npts  : number of points in slab
+    # Returns: [buffer, count, datatype]
     ################################################################
-    @staticmethod
-    def trans_type(imin, imax, jmin, jmax, kmin, kmax,  \
-                   ib, ie, itype, otype):
-        
-        extent = itype.get_extent()       
-             
-        ilen = ib   - ie   + 1  
-        jlen = jmax - jmin + 1  
-        klen = kmax - kmin + 1  
-        
-        sizes    = (imax-imin+1, jmax-jmin+1, kmax-kmin+1)
-        subsizes = (ilen, jlen, klen)
-        idisp    = (ib  , jmin, kmin)
-        otype    = itype.create_subarray(sizes, subsizes, idist, order = MPI.ORDER_FORTRAN)
-        otype.Commit()
+    def slab_msg(self, j, npts):
+
+        return [self.recvbuff_[j], npts*self.nens_, self.mpiftype_]  # end, slab_msg method
+
+
+    ################################################################
+    #  Method: slot
+    #  Desc  : Views of slab of npts points in a slot of the receive
+    #          buffers
+    #  Args  : j     : slot
+    #          npts  : number of points in slab
+    # Returns: Z     : (npts, nens) standardized anomalies
+    #          sd    : (npts) RMS of anomalies
+    ################################################################
+    def slot(self, j, npts):
+
+        return self.recvbuff_[j,0:npts*self.nens_].reshape(npts, self.nens_), \
+               self.sdbuff_[j,0:npts]  # end, slot method
 
-        return # end, trans_type method
-	
 
     ################################################################
     #  Method: buildB
     #  Desc  : Create 'B-matrix' from distributed data.
-    #          Note: This method currently uses an MPI collective
-    #                to gather all task-'local' data into the recvbuff_.
-    #                This is equivalent to having each taks read the 
-    #                entire grid data independently. So, strictly
-    #                speaking, MPI gather isn't required. We retain
-    #                it because it's an artifact of attempts to
-    #                use point-to-point MOPI calls to sendrrecv data,
-    #                and we may wish to return to this, so as to reduce
-    #                the memory footprint on each MPI task. This method
-    #                computes entries for the _entire_ covariance matrix,
-    #                even though it is symmetric. In this way, the distributed
-    #                computation is better load-balenced.
+    #          Each task's slab is multiplied, tile-wise by do_thresh,
+    #          by the slab of every task in turn, visited in ring
+    #          order. How slabs are shared depends on exchange mode
+    #          (see constructor):
+    #            'allgather': slabs of all tasks are received, 
+    #                         point-to-point, into recvbuff_, 
+    #                         so memory per task grows with the 
+    #                         number of tasks
+    #            'ring'     : slabs are passed around a ring of 
+    #                         tasks, and only two are held at a time
+    #          With the single-node (local) backend, either mode is
+    #          'shared': slabs of all tasks are held once, in shared 
+    #          memory, and read there in place.
+    #          Without symmetry, entries for the _entire_ covariance
+    #          matrix are computed, and each task returns entries of
+    #          its own rows I. In symmetric mode (see constructor), 
+    #          each symmetric pair of entries is computed once, on a 
+    #          half-ring schedule that keeps work balanced, and 
+    #          mirrored (J,I) entries are emitted. Entries are then not
+    #          returned by the task owning row I, but the set over all
+    #          tasks is the same. Symmetry is not used when levels are
+    #          streamed in chunks.
     #               
     #  Args  : ldata   : this task's (local)_ data
     #          cthresh : corr coeff threshold
@@ -173,186 +292,1235 @@ class BTools:
         #
         # Build the distributed B matrix.
         #
-        B = np.array([])
-        I = np.array([])
-        J = np.array([])
+        self.acc_.reset()
  	
         if self.debug_:
           print(self.myrank_, ": BTools::buildB: starting...")
           sys.stdout.flush()
 
-	# Gather all slabs here to perform thresholding:
+        ntot = int(self.thresh_all(ldata, [cthresh], [self.acc_])[0])
+
+        # Collect entries from accumulator into return arrays:
+        self.timer_.start('accumulate')
+        B, I, J = self.acc_.get()
+        self.timer_.stop('accumulate')
+
         if self.debug_:
-          print(self.myrank_, ": BTools::buildB: ldata.shape=",ldata.shape, " recvbuff.shape=", self.recvbuff_.shape)
+          print(self.myrank_, ": BTools::buildB: partition thresholding done.")
           sys.stdout.flush()
 
-        self.comm_.barrier()
-        self.comm_.Allgather(ldata,self.recvbuff_)
-        self.comm_.barrier()
+        return ntot,B,I,J  # end, buildB method
+	
+
+    ################################################################
+    #  Method: buildWidths
+    #  Desc  : Compute 'ribbon width' data of distributed B-matrix,
+    #          without storing the B-matrix: for each row, the min & 
+    #          max column index, and the number of entries, meeting
+    #          threshold are accumulated directly from the thresholded
+    #          tiles. Scheduling is as in buildB. In symmetric mode, 
+    #          mirrored entries update rows owned by other tasks, so 
+    #          all rows are tracked, and the rows are then reduced to
+    #          their owners with a reduce-scatter.
+    #          A list of thresholds may be given, in which case
+    #          each correlation is computed once, and thresholded
+    #          against each, so that a threshold sweep costs little
+    #          more than a single threshold.
+    #  Args  : ldata   : this task's (local)_ data
+    #          cthresh : corr coeff threshold, or list of thresholds
+    # Returns: number entries meeting thrershold criterion, on this task
+    #          Jmin, 
+    #          Jmax    : min & max column index of each of this task's
+    #                    rows, in local point order (see slab_index).
+    #                    Rows with no entries have Jmin = max int64,
+    #                    and Jmax = -1
+    #          count   : number of entries in each row
+    #          If cthresh is a list, a list of (ntot, Jmin, Jmax, count)
+    #          is returned, one for each threshold.
+    ################################################################
+    def buildWidths(self, ldata, cthresh):
+
+        sweep   = isinstance(cthresh, (list, tuple, np.ndarray))
+        threshs = list(cthresh) if sweep else [cthresh]
+
+        accs = []
+        for t in threshs:
+          if self.symmetric_:
+            accs.append(BWidths(self.offsets_[-1]))
+          else:
+            accs.append(BWidths(self.offsets_[self.myrank_+1]-self.offsets_[self.myrank_], \
+                                self.offsets_[self.myrank_]))
+
+        ntots = self.thresh_all(ldata, threshs, accs)
+
+        self.timer_.start('reduce')
+        results = []
+        for it in range(0, len(threshs)):
+          (Jmin, Jmax, count) = accs[it].get()
+          accs[it] = None
+
+          if self.symmetric_:
+            counts = np.diff(self.offsets_)
+            nloc   = counts[self.myrank_]
+            lJmin  = np.empty(nloc, dtype=np.int64)
+            lJmax  = np.empty(nloc, dtype=np.int64)
+            lcount = np.empty(nloc, dtype=np.int64)
+            self.comm_.Reduce_scatter(Jmin , lJmin , counts, op=MPI.MIN)
+            Jmin   = None
+            self.comm_.Reduce_scatter(Jmax , lJmax , counts, op=MPI.MAX)
+            Jmax   = None
+            self.comm_.Reduce_scatter(count, lcount, counts, op=MPI.SUM)
+            (Jmin, Jmax, count) = (lJmin, lJmax, lcount)
+
+          results.append((int(ntots[it]), Jmin, Jmax, count))
+        self.timer_.stop('reduce')
 
         if self.debug_:
-          print(self.myrank_, ": BTools::buildB: Allgather done")
+          print(self.myrank_, ": BTools::buildWidths: done.")
           sys.stdout.flush()
 
-        # Multiply local data by all gathered data and threshold:
-        ntot = 0
+        if not sweep:
+          return results[0]
+
+        return results  # end, buildWidths method
+	
+
+    ################################################################
+    #  Method: widthStats
+    #  Desc  : Compute global ribbon width statistics from the 
+    #          widths of rows distributed over tasks
+    #  Args  : W       : ribbon width (Jmax - Jmin) of each of this
+    #                    task's rows, in local point order; rows with
+    #                    no entries have W < 0
+    # Returns: maxWidth : max ribbon width
+    #          irowmax  : global row of max ribbon width (first, if 
+    #                     not unique)
+    #          avgWidth : average of nonzero widths
+    #          avgWidth1: average of nonzero widths, excluding outliers
+    #                     (widths >= avgWidth + 2 std. deviations)
+    ################################################################
+    def widthStats(self, W):
+
+        # Max width, and first global row where it occurs:
+        gidx = self.slab_index(self.myrank_)
+        if len(W) > 0:
+          lmax = int(W.max())
+          lrow = int(gidx[np.argmax(W)])
+        else:
+          lmax = np.iinfo(np.int64).min
+          lrow = -1
+        allmax   = self.comm_.allgather((lmax, lrow))
+        maxWidth = max([m for (m, r) in allmax])
+        irowmax  = min([r for (m, r) in allmax if m == maxWidth])
+
+        # Averages, over nonzero widths:
+        Wkeep    = W[W > 0]
+        nkeep    = self.comm_.allreduce(len(Wkeep), op=MPI.SUM)
+        avgWidth = 0.0
+        if nkeep > 0:
+          avgWidth = self.comm_.allreduce(int(np.sum(Wkeep)), op=MPI.SUM) / nkeep
+        ssq      = self.comm_.allreduce(float(np.sum((Wkeep-avgWidth)*(Wkeep-avgWidth))), op=MPI.SUM)
+        stdWidth = math.sqrt(ssq / max(nkeep, 1))
+
+        Wkeep     = Wkeep[Wkeep < (avgWidth+2*stdWidth)]
+        nkeep     = self.comm_.allreduce(len(Wkeep), op=MPI.SUM)
+        avgWidth1 = 0.0
+        if nkeep > 0:
+          avgWidth1 = self.comm_.allreduce(int(np.sum(Wkeep)), op=MPI.SUM) / nkeep
+
+        return maxWidth, irowmax, avgWidth, avgWidth1  # end, widthStats method
+	
+
+    ################################################################
+    #  Method: sampleWidths
+    #  Desc  : Estimate 'ribbon width' data from a sample of rows.
+    #          Each task samples the same fraction of its own rows,
+    #          so that cost is spread evenly, by stratified sampling:
+    #          its rows are divided into equal, contiguous strata, one
+    #          per sample, and one row is drawn at random from each.
+    #          Sampled rows are thresholded against all columns.
+    #  Args  : ldata   : this task's (local)_ data
+    #          cthresh : list of corr coeff thresholds
+    #          frac    : fraction of rows to sample, (0, 1]
+    #          seed    : random seed
+    # Returns: list, for each threshold, of (ntot, gidx, W, count):
+    #          ntot    : number of sampled entries meeting threshold
+    #          gidx    : global indices of this task's sampled rows
+    #          W       : ribbon width (Jmax - Jmin) of each sampled 
+    #                    row; < 0 for rows with no entries
+    #          count   : number of entries in each sampled row
+    ################################################################
+    def sampleWidths(self, ldata, cthresh, frac, seed=0):
+
+        assert frac > 0.0 and frac <= 1.0, "Invalid sample fraction"
+        nloc  = int(self.offsets_[self.myrank_+1] - self.offsets_[self.myrank_])
+        nsamp = min(nloc, max(1, int(round(frac*nloc)))) if nloc > 0 else 0
+
+        rng   = np.random.default_rng([int(seed), self.myrank_])
+        edges = (np.arange(nsamp+1, dtype=np.int64)*nloc)//max(nsamp, 1)
+        rows  = edges[0:nsamp] + (rng.random(nsamp)*np.diff(edges)).astype(np.int64)
+
+        accs  = [BWidths(nsamp) for t in cthresh]
+        ntots = self.thresh_all(ldata, cthresh, accs, rows)
+
+        gidx    = self.slab_index(self.myrank_)[rows]
+        results = []
+        for it in range(0, len(cthresh)):
+          (Jmin, Jmax, count) = accs[it].get()
+          results.append((int(ntots[it]), gidx, np.where(count > 0, Jmax - Jmin, -1), count))
+
+        return results  # end, sampleWidths method
+
+
+    ################################################################
+    #  Method: sampleStats
+    #  Desc  : Estimate global ribbon width statistics (see widthStats),
+    #          and number of entries, from sampled rows distributed
+    #          over tasks, with confidence intervals. Strata are of
+    #          (nearly) equal size, so the sample is self-weighting,
+    #          and intervals are computed as for a simple random
+    #          sample, with finite population correction; this is 
+    #          conservative for a stratified sample. Averages are
+    #          over rows with nonzero width, as in widthStats. The 
+    #          sample max is a lower bound on maxWidth; its interval
+    #          is given as the fraction of rows that may be wider.
+    #  Args  : gidx    : global indices of this task's sampled rows
+    #          W       : ribbon width of each sampled row (< 0: empty)
+    #          count   : number of entries in each sampled row
+    #          level   : confidence level
+    # Returns: dict of estimates, with intervals as (lo, hi):
+    #            maxWidth, irowmax, maxWidthExceed, avgWidth, 
+    #            avgWidthCI, avgWidth1, avgWidth1CI, count, countCI,
+    #            nsample, nrows, level
+    ################################################################
+    def sampleStats(self, gidx, W, count, level=0.95):
+
+        comm  = self.comm_
+        z     = statistics.NormalDist().inv_cdf(0.5 + 0.5*level)
+        nrows = int(self.offsets_[-1])
+        n     = comm.allreduce(len(W), op=MPI.SUM)
+        fpc   = math.sqrt(max(1.0 - n/max(nrows, 1), 0.0))
+
+        s = {"nsample": n, "nrows": nrows, "level": level}
+
+        # Sample max, and first global row where it occurs:
+        if len(W) > 0:
+          lmax = int(W.max())
+          lrow = int(gidx[np.argmax(W)])
+        else:
+          lmax = np.iinfo(np.int64).min
+          lrow = -1
+        allmax        = comm.allgather((lmax, lrow))
+        s["maxWidth"] = max([m for (m, r) in allmax])
+        s["irowmax"]  = min([r for (m, r) in allmax if m == s["maxWidth"]])
+        s["maxWidthExceed"] = -math.log(1.0-level)/max(n, 1)
+
+        # Averages, over nonzero widths:
+        Wkeep = W[W > 0].astype(np.float64)
+        (s["avgWidth"], s["avgWidthCI"]) = self.mean_ci(Wkeep, z, fpc)
+        nkeep = comm.allreduce(len(Wkeep), op=MPI.SUM)
+        ssq   = comm.allreduce(float(np.sum((Wkeep-s["avgWidth"])**2)), op=MPI.SUM)
+        std   = math.sqrt(ssq / max(nkeep, 1))
+        (s["avgWidth1"], s["avgWidth1CI"]) = self.mean_ci(Wkeep[Wkeep < (s["avgWidth"]+2*std)], z, fpc)
+
+        # Number of entries, from mean entries per row:
+        (avg, ci)     = self.mean_ci(count.astype(np.float64), z, fpc)
+        s["count"]    = avg*nrows
+        s["countCI"]  = (ci[0]*nrows, ci[1]*nrows)
+
+        return s  # end, sampleStats method
+
+
+    ################################################################
+    #  Method: mean_ci
+    #  Desc  : Mean, and its confidence interval, of a sample 
+    #          distributed over tasks
+    #  Args  : v       : this task's sample values
+    #          z       : normal quantile of confidence level
+    #          fpc     : finite population correction factor
+    # Returns: mean, (lo, hi)
+    ################################################################
+    def mean_ci(self, v, z, fpc):
+
+        m   = self.comm_.allreduce(len(v), op=MPI.SUM)
+        if m == 0:
+          return 0.0, (0.0, 0.0)
+        avg = self.comm_.allreduce(float(np.sum(v)), op=MPI.SUM) / m
+        ssq = self.comm_.allreduce(float(np.sum((v-avg)*(v-avg))), op=MPI.SUM)
+        hw  = z*math.sqrt(ssq/max(m-1, 1)/m)*fpc
+
+        return avg, (avg-hw, avg+hw)  # end, mean_ci method
+	
+
+    ################################################################
+    #  Method: gatherWidths
+    #  Desc  : Gather per-row data distributed over tasks onto one 
+    #          task, in global row order
+    #  Args  : W       : data for each of this task's rows, in local 
+    #                    point order
+    #          root    : task to gather to
+    # Returns: array of data for all global rows on root; None elsewhere
+    ################################################################
+    def gatherWidths(self, W, root=0):
+
+        counts = np.diff(self.offsets_)
+        W      = np.ascontiguousarray(W)
+        if self.myrank_ != root:
+          self.comm_.Gatherv(W, None, root=root)
+          return None
+
+        buff = np.empty(self.offsets_[-1], dtype=W.dtype)
+        self.comm_.Gatherv(W, [buff, counts], root=root)
+
+        gW = np.empty(self.offsets_[-1], dtype=W.dtype)
         for i in range(0, self.nprocs_):
+          gW[self.slab_index(i)] = buff[self.offsets_[i]:self.offsets_[i+1]]
 
-            n = self.do_thresh(ldata, self.recvbuff_[i,:], i, self.nens_, cthresh, self.Bp_, self.Ip_, self.Jp_) 
-      
-            if self.debug_:
-              print(self.myrank_, ": BTools::buildB: local factor=", ldata)
-              print(self.myrank_, ": BTools::buildB: recvbuff[",i,"]=",self.recvbuff_[i,:])
-              print(self.myrank_, ": BTools::buildB: I_loc[",i,"]=",self.Ip_)
-              print(self.myrank_, ": BTools::buildB: J_loc[",i,"]=",self.Jp_)
-              print(self.myrank_, ": BTools::buildB: B_loc[",i,"]=",self.Bp_)
-              sys.stdout.flush()
+        return gW  # end, gatherWidths method
+	
+
+    ################################################################
+    #  Method: thresh_all
+    #  Desc  : Threshold correlations of local data with all slabs
+    #          (the rows of the B-matrix owned by this task, or in 
+    #          symmetric mode, the pairs of slabs assigned to this task),
+    #          adding results to specified accumulators
+    #  Args  : ldata   : this task's (local)_ data, or (Z, sd) of it
+    #                    standardized (see standardize), or a reader
+    #                    of either, ldata(kb, ke), returning the task's
+    #                    data on grid levels kb..ke. If levels are streamed 
+    #                    (see constructor), a reader must be given, 
+    #                    and thresh_levels is used instead
+    #          cthresh : list of corr coeff thresholds
+    #          acc     : list of BAccum or BWidths accumulators, one
+    #                    for each threshold
+    #          rows    : if set, only these local rows (indices into
+    #                    local points) are thresholded, against all
+    #                    columns; row ordinals passed to accumulators
+    #                    are then indices into rows. Symmetric mode is
+    #                    not used.
+    #          In banded mode (see constructor), all slabs are
+    #          gathered, and thresholded by do_banded instead.
+    #          With checkpoints (see constructor), progress is saved
+    #          after slabs are done, and on restart, slabs done are
+    #          skipped (but still exchanged). Banded mode is not 
+    #          checkpointed.
+    # Returns: array of number of entries meeting each thrershold
+    #          When threaded, each thread accumulates into its own
+    #          accumulators, which are merged into acc at the end.
+    ################################################################
+    def thresh_all(self, ldata, cthresh, acc, rows=None):
 
-            ntot += n
-            # Concatenate new global indices to return arrays:
-            B = np.concatenate([B,self.Bp_[0:n]])
-            I = np.concatenate([I,self.Ip_[0:n]])
-            J = np.concatenate([J,self.Jp_[0:n]])
+        if callable(ldata):
+          if len(self.chunks_) > 1:
+            return self.thresh_levels(ldata, cthresh, acc, rows)
+          ldata = ldata(0, self.gn_[0]-1)
+        assert len(self.chunks_) == 1, "Streamed levels need a reader"
 
         if self.debug_:
-          print(self.myrank_, ": BTools::buildB: partition thresholding done.")
+          print(self.myrank_, ": BTools::thresh_all: ldata.shape=",np.shape(ldata[0] if isinstance(ldata, tuple) else ldata), \
+                " recvbuff.shape=", self.recvbuff_.shape)
           sys.stdout.flush()
 
-        return ntot,B,I,J  # end, buildB method
+        # Standardize local data once, for use against all slabs, and
+        # to be sent to other tasks; remote slabs arrive standardized.
+        # Slabs are held as (Z, sd, gidx, r0) tuples, where r0 is the
+        # row ordinal of the first point (see do_thresh):
+        # Out-of-core, standardized slabs are held in scratch:
+        self.timer_.start('standardize')
+        lgidx     = self.slab_index(self.myrank_)
+        lz        = None
+        if self.scratch_ is not None:
+          lz      = self.scratch_array([len(lgidx), self.nens_], self.recvbuff_.dtype)
+        (lz, lsd) = self.standardize(ldata, len(lgidx), lz)
+        lslab     = (lz, lsd, lgidx, self.offsets_[self.myrank_])
+        sslab     = lslab                  # slab of rows thresholded
+        if rows is not None:
+          sslab   = (np.asarray(lz[rows]), lsd[rows], lgidx[rows], 0)
+        self.timer_.stop('standardize')
+
+        # Accumulators for each thread:
+        if self.nthreads_ > 1:
+          tacc = [[a.spawn(self.nthreads_) for a in acc] for t in range(0, self.nthreads_)]
+        else:
+          tacc = [acc]
+
+        # Slabs are visited in ring order, slab of task (myrank-k) at
+        # step k. In symmetric mode, each unordered pair of slabs is 
+        # visited once, by computing only steps k <= nprocs/2 ('half 
+        # ring'), and emitting mirrored (J,I) entries. When nprocs is
+        # even, the pair at k = nprocs/2 is shared by both partners,
+        # each computing half of the block:
+        symmetric = self.symmetric_ and rows is None
+        nsteps = self.nprocs_
+        if symmetric:
+          nsteps = self.nprocs_//2 + 1
+
+        ntot = np.zeros(len(cthresh), dtype=np.int64)
+        if self.band_ > 0:
+          ntot += self.do_banded(lslab, sslab, cthresh, tacc)
+        else:
+          # Resume from checkpoint, if there is one of this run:
+          done = set()
+          if self.ckpt_ is not None:
+            ckey = self.ckpt_key(lz, cthresh, acc, rows, symmetric)
+            c    = self.ckpt_.load(ckey)
+            self.ckpt_mark_ = None
+            if c is not None:
+              (done, ntot, states) = (set(c[0]), c[1], c[2])
+              for t in range(0, len(tacc)):
+                for it in range(0, len(acc)):
+                  tacc[t][it].restore(states[t][it])
+              self.ckpt_mark_ = [[a.size() if isinstance(a, BAccum) else 0 for a in t] for t in tacc]
+              states = c = None
+
+          # Multiply local data by each slab as it is made
+          # available by the exchange, and threshold:
+          for (i, rz, rsd) in self.exchange(lz, lsd, np.diff(self.offsets_), nsteps):
+
+              if i in done:
+                continue
+
+              if i == self.myrank_:
+                rslab = lslab
+              else:
+                rslab = (rz, rsd, self.slab_index(i), self.offsets_[i])
+
+              self.timer_.start('kernel')
+              k = (self.myrank_ - i) % self.nprocs_
+              if not symmetric:
+                n = self.do_thresh(sslab, rslab, cthresh, tacc)
+              elif k == 0:
+                n = self.do_thresh(lslab, rslab, cthresh, tacc, diag=True)
+              elif 2*k == self.nprocs_ and self.myrank_ < k:
+                h = len(lgidx)//2                  # first half of local rows
+                n = self.do_thresh(BTools.slab_rows(lslab, 0, h), rslab, \
+                                   cthresh, tacc, mirror=True)
+              elif 2*k == self.nprocs_:
+                h = len(rslab[2])//2               # second half of partner's rows
+                n = self.do_thresh(lslab, BTools.slab_rows(rslab, h, len(rslab[2])), \
+                                   cthresh, tacc, mirror=True)
+              else:
+                n = self.do_thresh(lslab, rslab, cthresh, tacc, mirror=True)
+              self.timer_.stop('kernel', nhits=np.sum(n))
+              rslab = None
+      
+              if self.debug_:
+                print(self.myrank_, ": BTools::thresh_all: local factor=", ldata)
+                print(self.myrank_, ": BTools::thresh_all: rz[",i,"]=",rz)
+                print(self.myrank_, ": BTools::thresh_all: n_loc[",i,"]=",n)
+                sys.stdout.flush()
+
+              ntot += n
+
+              done.add(i)
+              if self.ckpt_ is not None and self.ckpt_.due():
+                self.ckpt_save(ckey, done, ntot, tacc)
+
+          if self.ckpt_ is not None:
+            self.ckpt_save(ckey, done, ntot, tacc)
+
+        # Merge thread accumulators:
+        if self.nthreads_ > 1:
+          self.timer_.start('accumulate')
+          for t in range(0, self.nthreads_):
+            for it in range(0, len(acc)):
+              acc[it].merge(tacc[t][it])
+          tacc = None
+          self.timer_.stop('accumulate')
+
+        return ntot  # end, thresh_all method
 	
 
+    ################################################################
+    #  Method: thresh_levels
+    #  Desc  : As thresh_all, with grid levels streamed in chunks 
+    #          (see constructor). For each chunk p of levels, this 
+    #          task's points on those levels (rows) are read, and 
+    #          thresholded against every task's points on each chunk q
+    #          in turn (columns), which are read, and exchanged, one
+    #          chunk at a time. So, only two chunks of this task's 
+    #          data, and the exchange buffers of one chunk, are held at
+    #          once, and all pairs of levels are covered, with global
+    #          row & column indices as for the whole grid. Points on
+    #          consecutive levels being consecutive in each task's 
+    #          local order, a chunk of a slab is a (Z, sd, gidx, r0)
+    #          slab itself. Data of each chunk are read nchunks times.
+    #          Checkpoints are not taken.
+    #  Args  : reader  : reader(kb, ke) of this task's data on grid 
+    #                    levels kb..ke, flattened
+    #          cthresh, acc, rows: as for thresh_all
+    # Returns: array of number of entries meeting each thrershold
+    ################################################################
+    def thresh_levels(self, reader, cthresh, acc, rows=None):
+
+        # Accumulators for each thread:
+        if self.nthreads_ > 1:
+          tacc = [[a.spawn(self.nthreads_) for a in acc] for t in range(0, self.nthreads_)]
+        else:
+          tacc = [acc]
+
+        lgidx = self.slab_index(self.myrank_)
+        lz = qz = None
+        if self.scratch_ is not None:
+          nmax = self.sdbuff_.shape[1]
+          lz   = self.scratch_array([nmax, self.nens_], self.recvbuff_.dtype)
+          qz   = self.scratch_array([nmax, self.nens_], self.recvbuff_.dtype)
+
+        ntot = np.zeros(len(cthresh), dtype=np.int64)
+        for (pb, pe) in self.chunks_:
+          # Rows: this task's points on levels of chunk p:
+          lp       = reader(pb, pe)
+          self.timer_.start('standardize')
+          (s0, s1) = self.decomp_.segment(self.myrank_, pb, pe)
+          (lzp, lsd) = self.standardize(lp, s1-s0, lz)
+          if rows is None:
+            sslab  = (lzp, lsd, lgidx[s0:s1], self.offsets_[self.myrank_] + s0)
+          else:
+            ib     = int(np.searchsorted(rows, s0))
+            sel    = rows[ib:int(np.searchsorted(rows, s1))] - s0
+            sslab  = (np.asarray(lzp[sel]), lsd[sel], lgidx[s0:s1][sel], ib)
+          self.timer_.stop('standardize')
+
+          # Columns: all tasks' points on levels of each chunk q:
+          for (qb, qe) in self.chunks_:
+            seg = [self.decomp_.segment(i, qb, qe) for i in range(0, self.nprocs_)]
+            if qb == pb:
+              (lzq, lsdq) = (lzp, lsd)
+            else:
+              lq = reader(qb, qe)
+              self.timer_.start('standardize')
+              (lzq, lsdq) = self.standardize(lq, seg[self.myrank_][1]-seg[self.myrank_][0], qz)
+              self.timer_.stop('standardize')
+              lq = None
+            for (i, rz, rsd) in self.exchange(lzq, lsdq, [r1-r0 for (r0, r1) in seg]):
+              (r0, r1) = seg[i]
+              if r1 == r0 or len(sslab[2]) == 0:
+                continue
+
+              rslab = (rz, rsd, self.slab_index(i)[r0:r1], self.offsets_[i] + r0)
+              self.timer_.start('kernel')
+              n = self.do_thresh(sslab, rslab, cthresh, tacc)
+              self.timer_.stop('kernel', nhits=np.sum(n))
+              rslab = None
+              ntot += n
+            lzq = lsdq = None
+          lp = lzp = sslab = None
+
+        # Merge thread accumulators:
+        if self.nthreads_ > 1:
+          self.timer_.start('accumulate')
+          for t in range(0, self.nthreads_):
+            for it in range(0, len(acc)):
+              acc[it].merge(tacc[t][it])
+          tacc = None
+          self.timer_.stop('accumulate')
+
+        return ntot  # end, thresh_levels method
+
+
+    ################################################################
+    #  Method: ckpt_key
+    #  Desc  : Make checkpoint compatibility key of a thresh_all call
+    #  Args  : lz      : this task's standardized slab (so that the key
+    #                    is the same whether or not the slab was cached)
+    #          cthresh, acc, rows: as for thresh_all
+    #          symmetric: whether symmetric mode is used
+    # Returns: key string
+    ################################################################
+    def ckpt_key(self, lz, cthresh, acc, rows, symmetric):
+
+        config = {"nprocs"   : self.nprocs_,
+                  "gn"       : [int(n) for n in self.gn_],
+                  "nens"     : int(self.nens_),
+                  "decomp"   : self.decomp_.mode_,
+                  "tilesz"   : self.tilesz_,
+                  "nthreads" : self.nthreads_,
+                  "symmetric": bool(symmetric),
+                  "thresh"   : [float(c) for c in cthresh],
+                  "acc"      : [type(a).__name__ for a in acc],
+                  "rows"     : None if rows is None else [int(r) for r in rows]}
+
+        return BCheckpoint.key(lz, config)  # end, ckpt_key method
+
+
+    ################################################################
+    #  Method: ckpt_save
+    #  Desc  : Save checkpoint of thresh_all progress. Of entry
+    #          accumulators, only entries added since the last save
+    #          (or restore) are saved, as recorded in ckpt_mark_
+    #  Args  : key     : from ckpt_key
+    #          done    : set of slabs (task ids) done
+    #          ntot    : entry counts so far
+    #          tacc    : accumulators of each thread
+    # Returns: none
+    ################################################################
+    def ckpt_save(self, key, done, ntot, tacc):
+
+        self.timer_.start('checkpoint')
+        incr = [[isinstance(a, BAccum) for a in t] for t in tacc]
+        mark = self.ckpt_mark_ if self.ckpt_mark_ is not None else [[0 for a in t] for t in tacc]
+        self.ckpt_.save(key, done, ntot, [[tacc[t][it].state(mark[t][it]) \
+                                           for it in range(0, len(tacc[t]))] \
+                                          for t in range(0, len(tacc))], incr)
+        self.ckpt_mark_ = [[a.size() if isinstance(a, BAccum) else 0 for a in t] for t in tacc]
+        self.timer_.stop('checkpoint')
+
+        return # end, ckpt_save method
+
+
+    ################################################################
+    #  Method: ckpt_clear
+    #  Desc  : Remove checkpoints of all tasks, once results are 
+    #          safely written, so that a later run doesn't restore 
+    #          them. Collective, so that no checkpoint is removed 
+    #          unless all tasks got here
+    #  Args  : none
+    # Returns: none
+    ################################################################
+    def ckpt_clear(self):
+
+        if self.ckpt_ is not None:
+          self.comm_.barrier()
+          self.ckpt_.remove()
+
+        return # end, ckpt_clear method
+
+
+    ################################################################
+    #  Method: exchange
+    #  Desc  : Generator that makes every task's slab available to
+    #          this task, one at a time, according to exchange mode:
+    #            'allgather': every slab needed is received into
+    #                         its own slot of recvbuff_, with a non-
+    #                         blocking receive posted for each at the
+    #                         start (and the local slab sent to each
+    #                         task needing it). The local slab is
+    #                         yielded first, then the remote slabs, in
+    #                         ring order, each once it has landed; later
+    #                         transfers overlap the caller's compute on
+    #                         earlier slabs, and slabs landing early wait
+    #                         in their slots, so that the order of
+    #                         results doesn't vary from run to run. No
+    #                         barriers are needed
+    #            'ring'     : slabs rotate around ring of tasks; at 
+    #                         each step the slab held is sent to the
+    #                         right neighbor while the next is received
+    #                         from the left, non-blocking, so that the
+    #                         transfer overlaps the caller's compute on
+    #                         the slab yielded. Only two slab buffers
+    #                         are held. Slabs are visited in ring order:
+    #                         at step k, the slab of task (myrank-k) 
+    #                         mod nprocs.
+    #          Either way, the slabs visited are those of tasks 
+    #          (myrank-k) mod nprocs, for k < nsteps. With the local
+    #          backend (see bcomm), each task copies its slab into its
+    #          slot of the shared recvbuff_, and others' slabs are read
+    #          in place, in ring order, whatever the exchange mode.
+    #          Slabs are exchanged standardized, point-major, as made
+    #          by standardize, so that they land in the layout the 
+    #          kernel reads, and are used in place. Slots are received
+    #          into, and forwarded from, as in slab_msg.
+    #  Args  : lz    : this task's standardized slab, (npts, nens)
+    #          lsd   : this task's slab RMS, (npts)
+    #          npts  : number of points in slab of each task
+    #          nsteps: number of slabs to visit (default: all)
+    # Returns: yields (irank, rz, rsd), the standardized slab, and RMS,
+    #          of task irank. In ring mode, these are valid only until
+    #          the next slab is requested
+    ################################################################
+    def exchange(self, lz, lsd, npts, nsteps=None):
+
+        if nsteps is None:
+          nsteps = self.nprocs_
+
+        if self.shared_:
+          # Wait until no task is still reading this task's slot (from
+          # an earlier exchange), fill it, and wait until all are full:
+          self.timer_.start('exchange')
+          self.comm_.barrier()
+          (z, sd) = self.slot(self.myrank_, len(lsd))
+          z[:]    = lz
+          sd[:]   = lsd
+          self.comm_.barrier()
+          self.timer_.stop('exchange')
+
+          for k in range(0, nsteps):
+            i = (self.myrank_ - k) % self.nprocs_
+            yield (i,) + self.slot(i, npts[i])
+
+        elif self.exchange_ == 'allgather':
+          # Post receives of slabs of tasks (myrank-k), and sends to
+          # tasks (myrank+k), that visit this task's slab at step k.
+          # Slabs shorter than a slot (uneven decompositions) are 
+          # received into its start:
+          self.timer_.start('exchange')
+          rsrc  = [(self.myrank_ - k) % self.nprocs_ for k in range(1, nsteps)]
+          rreqs = [self.comm_.Irecv(self.slab_msg(i, npts[i]), source=i, tag=77) for i in rsrc]
+          dreqs = [self.comm_.Irecv([self.sdbuff_[i], npts[i], MPI.DOUBLE], source=i, tag=78) \
+                   for i in rsrc]
+          sreqs = []
+          for k in range(1, nsteps):
+            dest = (self.myrank_ + k) % self.nprocs_
+            sreqs.append(self.comm_.Isend([lz , self.mpiftype_], dest=dest, tag=77))
+            sreqs.append(self.comm_.Isend([lsd, MPI.DOUBLE    ], dest=dest, tag=78))
+          self.timer_.stop('exchange')
+
+          if nsteps > 0:
+            yield self.myrank_, lz, lsd
+
+          # Visit remote slabs in ring order:
+          for j in range(0, len(rreqs)):
+            self.timer_.start('exchange')
+            i = rsrc[j]
+            rreqs[j].Wait()
+            dreqs[j].Wait()
+            self.timer_.stop('exchange', nbytes=npts[i]*(self.nens_*self.recvbuff_.itemsize + 8))
+
+            if self.debug_:
+              print(self.myrank_, ": BTools::exchange: received slab of ", i)
+              sys.stdout.flush()
+
+            yield (i,) + self.slot(i, npts[i])
+
+          self.timer_.start('exchange')
+          MPI.Request.Waitall(sreqs)
+          self.timer_.stop('exchange')
+
+        elif self.exchange_ == 'ring':
+          right = (self.myrank_ + 1) % self.nprocs_
+          left  = (self.myrank_ - 1) % self.nprocs_
+          icur  = 0
+          (z, sd) = self.slot(icur, len(lsd))
+          z[:]    = lz
+          sd[:]   = lsd
+          for k in range(0, nsteps):
+            # Post transfer of next slab before handing off this one:
+            self.timer_.start('exchange')
+            i    = (self.myrank_ - k) % self.nprocs_
+            inxt = (i - 1) % self.nprocs_
+            reqs = []
+            if k < nsteps-1:
+              reqs.append(self.comm_.Irecv(self.slab_msg(1-icur, npts[inxt]), source=left, tag=2*k))
+              reqs.append(self.comm_.Irecv([self.sdbuff_[1-icur], npts[inxt], MPI.DOUBLE], \
+                                           source=left, tag=2*k+1))
+              reqs.append(self.comm_.Isend(self.slab_msg(icur, npts[i]), dest=right, tag=2*k))
+              reqs.append(self.comm_.Isend([self.sdbuff_[icur], npts[i], MPI.DOUBLE], \
+                                           dest=right, tag=2*k+1))
+            self.timer_.stop('exchange')
+
+            yield (i,) + self.slot(icur, npts[i])
+
+            # Only time not overlapped with compute is counted:
+            self.timer_.start('exchange')
+            MPI.Request.Waitall(reqs)
+            self.timer_.stop('exchange', nbytes=len(reqs)//4*npts[inxt]* \
+                                                (self.nens_*self.recvbuff_.itemsize + 8))
+            icur = 1 - icur
+
+        else:
+          assert 0, "Invalid exchange mode"
+
+        return # end, exchange method
+
+
+    ################################################################
+    #  Method: slab_index
+    #  Desc  : Compute global B-matrix (row/column) index of each
+    #          point in a task's slab, in the slab's local point order.
+    #          Global index of grid point (k,j,i) is
+    #              i + j*Nx + k*Nx*Ny
+    #          Local points are ordered as the flattened slab returned
+    #          by getSlabData, for the decomposition in use (see 
+    #          BDecomp.index). Indices are in increasing order.
+    #  Args  : irank : task id owning the slab
+    # Returns: gidx  : int64 array of global indices
+    ################################################################
+    def slab_index(self, irank):
+
+        return self.decomp_.index(irank)  # end, slab_index method
+
+
+    ################################################################
+    #  Method: standardize
+    #  Desc  : Convert a flattened slab of ensemble anomalies into
+    #          point-major standardized form, so that correlation
+    #          coefficients between two slabs are a single matrix
+    #          product:
+    #              corr = Z_l X Transpose(Z_r) / nens
+    #          Points with zero variance are given all-zero
+    #          standardized vectors, so they never correlate.
+    #          Out-of-core, the slab is processed in blocks of points,
+    #          so that it need never be in memory all at once. A slab
+    #          given already standardized, as (Z, sd), e.g. from the
+    #          slab cache (see getSlabData), is used as is.
+    #  Args  : data  : flattened slab data of size nens*npts (may be
+    #                  longer, e.g. padded receive buffer); or (Z, sd)
+    #          npts  : number of grid points in slab
+    #          Z     : array of at least npts x nens to hold result
+    #                  (None: allocate)
+    # Returns: Z     : (npts, nens) standardized anomalies
+    #          sd    : (npts) RMS of anomalies, sqrt(<T'T'>), for
+    #                  recovering covariances
+    ################################################################
+    def standardize(self, data, npts, Z=None):
+
+        if isinstance(data, tuple):
+          return np.asarray(data[0][0:npts], dtype=self.recvbuff_.dtype), data[1][0:npts]
+
+        return BTools.standardizeSlab(data, self.nens_, npts, Z, self.block_)  # end, standardize method
+
+
+    ################################################################
+    #  Method: standardizeSlab
+    #  Desc  : Standardize a flattened slab of ensemble anomalies, as
+    #          standardize does, with no BTools instance (e.g. to cache
+    #          the slab standardized)
+    #  Args  : data  : flattened slab data of size nens*npts
+    #          nens  : number of ensemble members
+    #          npts  : number of grid points in slab
+    #          Z     : array of at least npts x nens to hold result
+    #                  (None: allocate)
+    #          nblk  : points processed at once (0: all)
+    # Returns: Z, sd : as for standardize
+    ################################################################
+    @staticmethod
+    def standardizeSlab(data, nens, npts, Z=None, nblk=0):
+
+        A    = data[0:nens*npts].reshape(nens, npts)
+        if Z is None:
+          Z  = np.empty((npts, nens), dtype=A.dtype)
+        Z    = Z[0:npts]
+        sd   = np.empty(npts, dtype=np.float64)
+
+        nblk = nblk if nblk > 0 else max(npts, 1)
+        for ib in range(0, npts, nblk):
+          Ab   = np.asarray(A[:,ib:ib+nblk])
+          var  = np.einsum('ep,ep->p', Ab, Ab, dtype=np.float64) / nens
+          sd[ib:ib+nblk] = np.sqrt(var)
+          rsd  = np.zeros(len(var), dtype=np.float64)
+          np.divide(1.0, sd[ib:ib+nblk], out=rsd, where=sd[ib:ib+nblk] > 0)
+          Z[ib:ib+nblk] = (Ab*rsd.astype(A.dtype)).T
+
+        return Z, sd  # end, standardizeSlab method
+
+
+    ################################################################
+    #  Method: slab_rows
+    #  Desc  : Restrict a (Z, sd, gidx, r0) slab tuple to a range of
+    #          its points
+    #  Args  : slab  : slab tuple
+    #          ib, ie: starting, ending+1 point of range
+    # Returns: slab tuple for range, referencing original data
+    ################################################################
+    @staticmethod
+    def slab_rows(slab, ib, ie):
+
+        (Z, sd, gidx, r0) = slab
+
+        return (Z[ib:ie], sd[ib:ie], gidx[ib:ie], r0+ib)  # end, slab_rows method
+
+
     ####################################################
     #  Method: do_thresh
     #  Desc  : With local data, and off-task data, compute
-    #          global indices where covariance exceeds
-    #          specified threshold.
-    #  Args  : ldata : this task's (local) data block, assumed 'flattened'
-    #          rdata : off-task (remote) data block, assumed 'flattened'
-    #          irecv : task id that rdata is received from
-    #          nens  : number of ensembles (always the first index)
-    #          thresh: corr coeff threshold
-    #          B     : array of covariances whose corr. coeffs exceed cthresh
-    #          I, J  : arrays of indices into global B mat
-    #		       where cov > thresh. We assume that I, J 
-    #                  are the same length as B
-    #                  as B
-    # Returns: number of values found that meet threshold criterion
-    ################################################################
-    def do_thresh(self, ldata, rdata, irecv, nens, thresh, B, I, J):
-	
-        assert len(ldata.shape)==1
-        assert len(rdata.shape)==1
-        assert len(B)==len(I) and len(B)==len(J)
+    #          global indices where correlation exceeds
+    #          specified threshold. Correlations are computed
+    #          tile-by-tile as matrix products of the standardized
+    #          anomalies, so that each tile costs one GEMM, and
+    #          is thresholded with vectorized masks. Tile edge
+    #          length is set by tilesz in the constructor.
+    #  Args  : lslab : this task's (local) slab tuple (Z, sd, gidx, r0):
+    #                  Z   : standardized data, (nl, nens)
+    #                  sd  : RMS of anomalies, (nl)
+    #                  gidx: global indices of points, (nl)
+    #                  r0  : row ordinal of first point; ordinals
+    #                        number points of all tasks consecutively
+    #                        in task order (see offsets_)
+    #          rslab : off-task (remote) slab tuple, as for lslab
+    #          thresh: list of corr coeff thresholds
+    #          acc   : list, for each thread, of lists of accumulators,
+    #                  one for each threshold:
+    #                  BAccum into which covariances, and I, J
+    #                  global indices of entries found are appended,
+    #                  or BWidths, whose row data are updated
+    #          mirror: if True, also append mirrored (J,I) entries
+    #          diag  : if True, local and remote data are the same
+    #                  slab; only tiles on or above the diagonal are
+    #                  computed, and those above are mirrored
+    # Returns: array of number of values found that meet each threshold
+    #          criterion, including mirrored entries
+    ################################################################
+    def do_thresh(self, lslab, rslab, thresh, acc, mirror=False, diag=False):
 
-        
-        # Just in case, resize operand arrays if necessary:
-        if len(ldata)*len(rdata) > len(self.Bp_):
-            if self.mpiftype_ == MPI.FLOAT:
-               self.Bp_ = np.zeros(len(ldata)*len(rdata), dtype=np.float32)
-            elif self.mpiftype_ == MPI.DOUBLE:
-               self.Bp_ = np.zeros(len(ldata)*len(rdata), dtype=np.float64)
-            self.Ip_ = np.zeros(len(ldata)*len(rdata), dtype=np.int64) 
-            self.Jp_ = np.zeros(len(ldata)*len(rdata), dtype=np.int64)
-
-        imin = 1
-        jmin = 1
-        kmin = 1
-        imax = self.gn_[2]
-        jmax = self.gn_[1]
-        kmax = self.gn_[0]
-                                
-        # Find global starting index of recv'd block:
-        (ib, ie) = self.range(imax, self.nprocs_, irecv)
-        rnb0 = ib*(jmax-jmin+1)*(kmax-kmin+1)
-        nrslice = ie - ib + 1
-        rdata   = rdata.reshape(nens, self.gn_[0]*self.gn_[1], self.nxmax_)
-        if self.debug_:
-          print(self.myrank_, ": do_thresh: rdata.shape=",rdata.shape)
-          sys.stdout.flush()
+        nl   = lslab[0].shape[0]
+        nr   = rslab[0].shape[0]
+        ts   = self.tilesz_
 
-        # Find global starting index of local block:
-        (ib, ie) = self.range(imax, self.nprocs_, self.myrank_)
-        lnb = ib*(jmax-jmin+1)*(kmax-kmin+1)
-        nlslice = ie - ib + 1
-        if self.debug_:
-        # print(self.myrank_, ": do_thresh: ldata=",ldata)
-          print(self.myrank_, ": do_thresh: ldata.shape=",ldata.shape, " nlslice=", nlslice)
-          sys.stdout.flush()
-        ldata   = ldata.reshape(nens, self.gn_[0]*self.gn_[1], nlslice)
-
-    	# Order s.t. we multiply
-	    #    Transpose(ldata) X rdata:
-        # where Transpose(ldata) is a column vector, 
-        # and rdata, a row vector in matrix-speak
-        n = 0
-        for ii in range(0,nlslice):              # loop over l-slices
-          lslice = ldata[:,:,ii]  
-          ldims  = lslice.shape
-         #if self.debug_:
-         #  print(self.myrank_, ": do_thrersh: lslice[",ii,"]=",lslice)
-         #  sys.stdout.flush()
-          lnb = (ib+ii)*(jmax-jmin+1)*(kmax-kmin+1)
-          for i in range(0,ldims[1]):
-     	    # Locate in global grid:
-            ig    = int( float(lnb+i)/float(self.gn_[0]*self.gn_[1]) )
-            ntmp  = ig*self.gn_[0]*self.gn_[1]
-            jg    = int( float(lnb+i-ntmp)/float(self.gn_[0]) )
-            kg    = lnb + i - jg*self.gn_[0] - ntmp
-
-#           kg    = int( float(lnb+i)/float(self.gn_[1]*self.gn_[2]) )
-#           ntmp  = kg*self.gn_[1]*self.gn_[2]
-#           jg    = int( float(lnb+i-ntmp)/float(self.gn_[2]) )
-#           ig    = lnb + i - jg*self.gn_[2] - ntmp
-
-  	    # Compute global matrix index: 	    
-###         Ig    = kg + jg*self.gn_[0] + ig*self.gn_[0]*self.gn_[1]
-            Ig    = ig + jg*self.gn_[2] + kg*self.gn_[1]*self.gn_[2]
-            CII   = np.mean(lslice[:,i]**2)     # variance=average over ensembles
-#           if i%10 == 0:
-#             print(self.myrank_, ": do_thrersh: lslice[",i,"]=",lslice[:,i])
-            sys.stdout.flush()
-            for jj in range(0, nrslice):         # loop over r-slices
-              rslice = rdata[:,:,jj]
-              rdims  = rslice.shape
-              rnb = rnb0 + jj*(jmax-jmin+1)*(kmax-kmin+1)
-              for j in range(0,rdims[1]):
-                CJJ   = np.mean(rslice[:,j]**2)  # variance=average over ensembles
-                vcov  = np.multiply(lslice[:,i], rslice[:,j])
-                                                 # covariance for each ensemble member
-                covar = np.mean(vcov,0)          # covariance
-                ccoef = abs(covar)/math.sqrt(CII*CJJ)  # correlation coefficient
-#               if i%10 == 0:
-#                 print(self.myrank_,": do_thresh: vcov=", vcov)
-#                 print(self.myrank_,": do_thresh: CII=",CII," CJJ=",CJJ, " covar=", covar)
-                if ccoef >= thresh:
-         	      # Locate in global grid:
-                  ig    = int( float(rnb+j)/float(self.gn_[0]*self.gn_[1]) )
-                  ntmp  = ig*self.gn_[0]*self.gn_[1]
-                  jg    = int( float(rnb+j-ntmp)/float(self.gn_[0]) )
-                  kg    = rnb + j - jg*self.gn_[0] - ntmp
-
-#                 kg    = int( float(rnb+j)/float(self.gn_[1]*self.gn_[2]) )
-#                 ntmp  = kg*self.gn_[1]*self.gn_[2]
-#                 jg    = int( float(rnb+j-ntmp)/float(self.gn_[2]) )
-#                 ig    = rnb + j - jg*self.gn_[2] - ntmp
-           
-    	          # Compute global matrix indices: 	    
-###               Jg    = kg + jg*self.gn_[0] + ig*self.gn_[0]*self.gn_[1]
-                  Jg    = ig + jg*self.gn_[2] + kg*self.gn_[1]*self.gn_[2]
-
-                  B[n] = covar
-                  I[n] = int(Ig)
-                  J[n] = int(Jg)
-           
-                  n += 1
+        if self.block_ > 0 and max(nl, nr) > self.block_:
+          return self.do_blocks(lslab, rslab, thresh, acc, mirror, diag)
+
+        # List the tile pairs to compute:
+        tiles = [(il, jr) for il in range(0, nl, ts) \
+                          for jr in range(il if diag else 0, nr, ts)]
+
+        if len(acc) == 1:
+          return self.do_tiles(lslab, rslab, thresh, acc[0], mirror, diag, tiles)
+
+        # Deal tile pairs round-robin to threads; the GEMM and
+        # thresholding release the GIL:
+        nthr = len(acc)
+        futs = [self.pool_.submit(self.do_tiles, lslab, rslab, thresh, acc[t], \
+                                  mirror, diag, tiles[t::nthr]) for t in range(0, nthr)]
+        n    = np.zeros(len(thresh), dtype=np.int64)
+        for f in futs:
+          n += f.result()
 
         return n  # end, do_thresh method
-	
+
+
+    ################################################################
+    #  Method: do_blocks
+    #  Desc  : Out-of-core do_thresh: stream blocks of local & remote 
+    #          points from (memory-mapped) slabs into memory, and 
+    #          threshold each pair of blocks in turn. Local blocks are
+    #          visited once; remote blocks are visited in serpentine
+    #          order, so that the last block read for one local block is
+    #          reused for the next. Arguments are as for do_thresh.
+    # Returns: array of number of values found that meet each threshold
+    #          criterion, including mirrored entries
+    ################################################################
+    def do_blocks(self, lslab, rslab, thresh, acc, mirror, diag):
+
+        nl   = lslab[0].shape[0]
+        nr   = rslab[0].shape[0]
+        nb   = self.block_
+
+        n       = np.zeros(len(thresh), dtype=np.int64)
+        cached  = (-1, None)                     # last remote block read
+        forward = True
+        for il in range(0, nl, nb):
+          lblk = BTools.slab_rows(lslab, il, il+nb)
+          lblk = (np.array(lblk[0]),) + lblk[1:]
+
+          # In diagonal slabs, only blocks on or above the diagonal:
+          jrs = list(range(il if diag else 0, nr, nb))
+          if not forward:
+            jrs.reverse()
+          for jr in jrs:
+            if diag and jr == il:
+              rblk = lblk
+            elif cached[0] == jr:
+              rblk = cached[1]
+            else:
+              rblk   = BTools.slab_rows(rslab, jr, jr+nb)
+              rblk   = (np.array(rblk[0]),) + rblk[1:]
+              cached = (jr, rblk)
+            n += self.do_thresh(lblk, rblk, thresh, acc, \
+                                mirror or (diag and jr > il), diag and jr == il)
+          forward = not forward
+
+        return n  # end, do_blocks method
+
+
+    ################################################################
+    #  Method: do_banded
+    #  Desc  : Banded search: rather than thresholding local rows
+    #          against every column, each tile of local rows is 
+    #          thresholded against columns in growing shells of grid
+    #          distance, each band_ grid points wide, where distance
+    #          is the Chebyshev (max over dimensions) distance from
+    #          the bounding box of the tile's points. Search stops once
+    #          patience_ consecutive shells give no entries (at the 
+    #          lowest threshold), or at maxdist_. Rows that still have
+    #          entries in the last shell, when the search reaches 
+    #          maxdist_, may have been truncated; their global indices
+    #          are kept in truncated_ (see truncatedRows). Rows whose
+    #          search stops for patience_, while columns are left 
+    #          unsearched, may miss entries beyond; their global 
+    #          indices are kept in stopped_ (see stoppedRows). Banded
+    #          results are thus approximate, unless both are 0.
+    #          As banded search needs columns in any order, the slabs
+    #          of tasks with points within maxdist_ of this task's 
+    #          points (see BDecomp.near; all tasks if no maxdist_) are
+    #          gathered, point to point, whatever the exchange mode.
+    #  Args  : lslab : this task's slab (see thresh_all)
+    #          sslab : slab of rows to threshold
+    #          thresh: list of corr coeff thresholds
+    #          acc   : list over threads of lists over thresholds of
+    #                  accumulators, as for do_thresh
+    # Returns: array of number of values found that meet each 
+    #          threshold criterion
+    ################################################################
+    def do_banded(self, lslab, sslab, thresh, acc):
+
+        # Gather standardized data of points of nearby tasks, in row
+        # ordinal order:
+        gslab = self.gather_near(lslab)
+        ggidx = gslab[2]
+
+        # Grid coordinates, (z, y, x), of all points:
+        (nz, ny, nx) = self.gn_
+        gcoord = np.stack((ggidx//(nx*ny), (ggidx//nx) % ny, ggidx % nx))
+
+        self.timer_.start('kernel')
+        ts     = self.tilesz_
+        tiles  = list(range(0, len(sslab[2]), ts))
+        if self.pool_ is None:
+          (n, trunc, stop) = self.do_band_tiles(sslab, gslab, gcoord, thresh, acc[0], tiles)
+        else:
+          futs = [self.pool_.submit(self.do_band_tiles, sslab, gslab, gcoord, thresh, \
+                                    acc[t], tiles[t::self.nthreads_]) \
+                  for t in range(0, self.nthreads_)]
+          res   = [f.result() for f in futs]
+          n     = np.sum([r[0] for r in res], axis=0)
+          trunc = np.concatenate([r[1] for r in res])
+          stop  = np.concatenate([r[2] for r in res])
+        self.timer_.stop('kernel', nhits=np.sum(n))
+        self.truncated_ = np.sort(trunc)
+        self.stopped_   = np.sort(stop)
+
+        return n  # end, do_banded method
+
+
+    ################################################################
+    #  Method: gather_near
+    #  Desc  : Gather the standardized slabs of tasks with points 
+    #          within maxdist_ of this task's points, for banded 
+    #          search. The near relation being symmetric, this task's
+    #          slab is sent to the same tasks it receives from. Slabs
+    #          are received in place, in task (row ordinal) order;
+    #          out-of-core, into scratch. With the local backend, they
+    #          are copied from the shared slots.
+    #  Args  : lslab : this task's slab (see thresh_all)
+    # Returns: slab tuple (Z, sd, gidx, 0) of the points gathered
+    ################################################################
+    def gather_near(self, lslab):
+
+        near   = self.decomp_.near(self.myrank_, self.maxdist_)
+        counts = np.diff(self.offsets_)
+        pos    = np.concatenate(([0], np.cumsum(counts[near])))
+        npts   = int(pos[-1])
+        gz     = self.scratch_array([npts, self.nens_], self.recvbuff_.dtype)
+        gsd    = np.empty(npts, dtype=np.float64)
+        ggidx  = np.empty(npts, dtype=np.int64)
+        where  = dict(zip(near, zip(pos[:-1], pos[1:])))
+        for i in near:
+          (o0, o1) = where[i]
+          ggidx[o0:o1] = self.slab_index(i)
+
+        self.timer_.start('exchange')
+        if self.shared_:
+          self.timer_.stop('exchange')
+          for (i, rz, rsd) in self.exchange(lslab[0], lslab[1], counts):
+            if i in where:
+              (o0, o1) = where[i]
+              gz [o0:o1] = rz
+              gsd[o0:o1] = rsd
+          self.timer_.start('exchange')
+        else:
+          reqs = []
+          for i in near:
+            (o0, o1) = where[i]
+            if i == self.myrank_:
+              gz [o0:o1] = lslab[0]
+              gsd[o0:o1] = lslab[1]
+              continue
+            reqs.append(self.comm_.Irecv([gz [o0:o1], self.mpiftype_], source=i, tag=79))
+            reqs.append(self.comm_.Irecv([gsd[o0:o1], MPI.DOUBLE     ], source=i, tag=80))
+            reqs.append(self.comm_.Isend([lslab[0]  , self.mpiftype_], dest=i  , tag=79))
+            reqs.append(self.comm_.Isend([lslab[1]  , MPI.DOUBLE     ], dest=i  , tag=80))
+          MPI.Request.Waitall(reqs)
+        self.timer_.stop('exchange', nbytes=(npts-len(lslab[1]))*(self.nens_*self.recvbuff_.itemsize + 8))
+
+        return (gz, gsd, ggidx, 0)  # end, gather_near method
+
+
+    ################################################################
+    #  Method: do_band_tiles
+    #  Desc  : Banded search of specified tiles of rows; see 
+    #          do_banded. Columns of each shell are thresholded in
+    #          tiles, in increasing global index order, by do_tiles.
+    #  Args  : lslab : slab of rows
+    #          gslab : slab of points gathered (see gather_near)
+    #          gcoord: (3, npts) grid coordinates (z, y, x) of gslab
+    #          thresh: list of corr coeff thresholds
+    #          acc   : list over thresholds of accumulators
+    #          tiles : list of starting rows of tiles
+    # Returns: array of number of values found that meet each 
+    #          threshold criterion, and int64 arrays of global indices
+    #          of rows whose search may have been truncated at maxdist,
+    #          and of rows whose search was stopped for patience
+    ################################################################
+    def do_band_tiles(self, lslab, gslab, gcoord, thresh, acc, tiles):
+
+        ts    = self.tilesz_
+        (nz, ny, nx) = self.gn_
+        lcoord= np.stack((lslab[2]//(nx*ny), (lslab[2]//nx) % ny, lslab[2] % nx))
+        imin  = int(np.argmin(thresh))           # most permissive threshold
+
+        n     = np.zeros(len(thresh), dtype=np.int64)
+        trunc = []
+        stop  = []
+        for il in tiles:
+          tslab = BTools.slab_rows(lslab, il, il+ts)
+
+          # Distance of each point from tile's bounding box, and shell:
+          lo    = lcoord[:,il:il+ts].min(axis=1)[:,None]
+          hi    = lcoord[:,il:il+ts].max(axis=1)[:,None]
+          dist  = np.maximum(np.maximum(lo - gcoord, gcoord - hi), 0).max(axis=0)
+          keep  = np.nonzero(dist <= self.maxdist_)[0] if self.maxdist_ > 0 \
+                  else np.arange(len(dist))
+          # Whether grid points lie beyond maxdist_ (they need not
+          # have been gathered):
+          beyond= self.maxdist_ > 0 and (np.any(lo[:,0] > self.maxdist_) or \
+                  np.any(hi[:,0] + self.maxdist_ < np.array(self.gn_) - 1))
+          shell = dist[keep] // self.band_
+          keep  = keep[np.lexsort((gslab[2][keep], shell))]
+          shell = np.sort(shell)
+          nshell= int(shell[-1]) + 1 if len(shell) > 0 else 0
+          sb    = np.searchsorted(shell, np.arange(nshell+1))
+
+          # Expand shells until patience_ consecutive are empty,
+          # counting entries of each row in the last shell:
+          empty = 0
+          hits  = np.zeros(len(tslab[2]), dtype=np.int64)
+          for s in range(0, nshell):
+            cols  = keep[sb[s]:sb[s+1]]
+            hits[:] = 0
+            if len(cols) == 0:
+              empty += 1
+            else:
+              cslab = (np.asarray(gslab[0][cols]), gslab[1][cols], gslab[2][cols], 0)
+              ns    = self.do_tiles(tslab, cslab, thresh, acc, False, False, \
+                                    [(0, jr) for jr in range(0, len(cols), ts)], hits)
+              n    += ns
+              empty = empty + 1 if ns[imin] == 0 else 0
+            if empty >= self.patience_:
+              break
+
+          # Search stopped for patience, with columns left; or ran out
+          # at maxdist, while rows still had entries:
+          if empty >= self.patience_:
+            if s < nshell-1 or beyond:
+              stop.append(tslab[2])
+          elif beyond:
+            trunc.append(tslab[2][hits > 0])
+
+        none = np.empty(0, dtype=np.int64)
+
+        return n, np.concatenate(trunc) if trunc else none, \
+                  np.concatenate(stop) if stop else none  # end, do_band_tiles method
+
+
+    ################################################################
+    #  Method: truncatedRows
+    #  Desc  : Number of rows, over all tasks, whose banded search
+    #          (see do_banded) may have been truncated, in last
+    #          computation. Collective.
+    #  Args  : none
+    # Returns: number of rows
+    ################################################################
+    def truncatedRows(self):
+
+        return self.comm_.allreduce(len(self.truncated_), op=MPI.SUM)  # end, truncatedRows method
+
+
+    ################################################################
+    #  Method: stoppedRows
+    #  Desc  : Number of rows, over all tasks, whose banded search
+    #          (see do_banded) was stopped for patience, with columns
+    #          left unsearched, in last computation. Collective.
+    #  Args  : none
+    # Returns: number of rows
+    ################################################################
+    def stoppedRows(self):
+
+        return self.comm_.allreduce(len(self.stopped_), op=MPI.SUM)  # end, stoppedRows method
+
+
+    ################################################################
+    #  Method: do_tiles
+    #  Desc  : Compute, and threshold, specified correlation tiles
+    #          for do_thresh
+    #  Args  : lslab, 
+    #          rslab : local, remote slab tuples, as in do_thresh
+    #          thresh: list of corr coeff thresholds
+    #          acc   : list of accumulators, one for each threshold
+    #          mirror,
+    #          diag  : as in do_thresh
+    #          tiles : list of (il, jr) starting local, remote points
+    #                  of tiles to compute
+    #          hits  : if given, number of entries of each local row
+    #                  meeting the lowest threshold is added to it
+    #                  (mirrored entries not included)
+    # Returns: array of number of values found that meet each threshold
+    #          criterion, including mirrored entries
+    ################################################################
+    def do_tiles(self, lslab, rslab, thresh, acc, mirror, diag, tiles, hits=None):
+
+        (lz, lsd, lgidx, l0) = lslab
+        (rz, rsd, rgidx, r0) = rslab
+        assert len(thresh)==len(acc)
+
+        nens = self.nens_
+        ts   = self.tilesz_
+        assert lz.shape[1]==nens and rz.shape[1]==nens
+
+        # Compare tile products against thresh*nens directly,
+        # rather than scaling each tile:
+        tnens = [t*nens for t in thresh]
+        imin  = int(np.argmin(thresh))
+        if min(thresh) <= 0.0:
+          lvalid = lsd > 0
+          rvalid = rsd > 0
+
+        n = np.zeros(len(thresh), dtype=np.int64)
+        for (il, jr) in tiles:                    # loop over tiles
+            zl    = lz[il:il+ts]
+            zr    = rz[jr:jr+ts]
+            C     = np.dot(zl, zr.T)              # nens * corr. coeff
+            Cabs  = np.abs(C)
+            for it in range(0, len(thresh)):      # loop over thresholds
+              mask  = Cabs >= tnens[it]
+              if thresh[it] <= 0.0:
+                mask &= lvalid[il:il+ts,None] & rvalid[None,jr:jr+ts]
+              if hits is not None and it == imin:
+                hits[il:il+ts] += np.count_nonzero(mask, axis=1)
+
+              if isinstance(acc[it], BWidths):
+                n[it] += acc[it].update(mask, l0+il, rgidx[jr:jr+ts])
+                if mirror or (diag and jr > il):
+                  n[it] += acc[it].update(mask.T, r0+jr, lgidx[il:il+ts])
+                continue
+
+              ii, jj = np.nonzero(mask)
+              nhit  = len(ii)
+              if nhit == 0:
+                continue
+
+              # Covariance = corr. coeff * sqrt(CII*CJJ):
+              ig = il + ii
+              jg = jr + jj
+              bcov = C[ii,jj] * (lsd[ig]*rsd[jg] / nens)
+              acc[it].append(bcov, lgidx[ig], rgidx[jg])
+              n[it] += nhit
+              if mirror or (diag and jr > il):
+                acc[it].append(bcov, rgidx[jg], lgidx[ig])
+                n[it] += nhit
+
+        return n  # end, do_tiles method
+
 
     ################################################################
     #  Method: getSlabData
     #  Desc  : Reads specified NetCDF4 file, and returns a slab of data
-    #          'owned' by specified MPI rank.
+    #          'owned' by specified MPI rank. Only the rank's own 
+    #          (decimated) points are read, as strided hyperslabs, and
+    #          the file is opened read-only. If a communicator is given,
+    #          and the netCDF4 library supports parallel I/O, the file 
+    #          is opened in parallel, and read collectively; otherwise,
+    #          each rank opens the file independently.
     #  Args  : 
     #          fileName    : string, filename of the netCDF file to open
     #          ensembleName: string, name of the ensemble
@@ -363,17 +1531,37 @@ class BTools:
     #          means       : integer, 1,2,3 where:
     #                         1: <T(x,y,x)> = Sum ens T(ens,x,y,z)/num ensembles
     #                         2: T(ens,x,y,z) - <T(x,y,z)>
-    #                         4: raw (no subtracted mean)
+    #                         3: raw (no subtracted mean)
     #          decimate    : integer, shorten the slab by decimate (0 is no decimate).
     #                        So, if you decimate by 4, you keep every 4th data point
+    #          comm        : MPI communicator of the mpiTasks tasks, for 
+    #                        parallel reads (None: independent reads)
+    #          timer       : BTimer in which read & anomaly phases are
+    #                        recorded (None: not recorded)
+    #          decomp      : domain decomposition mode; see BDecomp
+    #          cache       : directory of anomaly slab cache (see BCache);
+    #                        slabs are taken from it if there, and 
+    #                        current, and stored in it if not
+    #                        (None: no cache)
+    #          levels      : list of file levels used, as grid levels
+    #                        0, 1, ... (None: first level only)
+    #          klev        : (kb, ke): only the rank's points on grid 
+    #                        levels kb..ke are read, e.g. to stream 
+    #                        levels (None: all)
+    #          standardized: return (and cache) the slab standardized,
+    #                        as BTools exchanges it (see standardize),
+    #                        so that cached slabs need no further work
     # ReturnsL N    : numpy array, data for a particular mpiRank of 
-    #                 size (Nx_p, Ny, Nz), where Nx_p is are the number
-    #                 x-planes corresponding to mpiRank.
+    #                 size (nens, Nz_p, Ny_p, Nx_p), the extents of the 
+    #                 box corresponding to mpiRank (clipped to klev); in
+    #                 'points' mode, of size (nens, Npts_p). For 
+    #                 means=1, nens=1. If standardized, (Z, sd) of the
+    #                 float32 data, Z of size (Npts_p, nens).
     #          nens : number of ensemble members
-    #          gdims: dims of original grid
+    #          gdims: dims of (decimated) global grid: (Nz, Ny, Nx)
     ################################################################
     @staticmethod
-    def getSlabData(fileName, ensembleName, itime, mpiTasks, mpiRank, means, decimate):
+    def getSlabData(fileName, ensembleName, itime, mpiTasks, mpiRank, means, decimate, comm=None, timer=None, decomp='x', cache=None, levels=None, klev=None, standardized=False):
         # N = Btools_getSlabData(fileName, ensembleName, itime, mpiTask, mpiRank, means, decimate)
         # N is a slab of data (x,y,z) 
         #
@@ -391,21 +1579,70 @@ class BTools:
         if (type(fileName) is not str):
             sys.exit("Error, bad fileName type in Btools_getSlabData!")
 
-        decimate = int(decimate)
-        if decimate < 0:
-          decimate = 1
+        if means not in (1, 2, 3):
+            sys.exit("Error, bad mean spec!")
+
+        decimate = max(int(decimate), 1)
+        if timer is None:
+            timer = BTimer()
 
-        nz = 1
+        #
+        # Use cached slab, if all tasks have one (so that all, or
+        # none, take part in parallel reads):
+        #
+        if cache is not None:
+            timer.start('read')
+            C        = BCache(cache)
+            (cname, ckey) = BCache.key(fileName, ensembleName, itime, means, decimate, \
+                                       decomp, mpiTasks, mpiRank, levels, klev, standardized)
+            cached   = C.load(cname, ckey)
+            hit      = cached is not None
+            if comm is not None:
+                hit  = comm.allreduce(hit, op=MPI.LAND)
+            if hit:
+                nbytes = cached[0][0].nbytes + cached[0][1].nbytes if standardized else cached[0].nbytes
+                timer.stop('read', nbytes=nbytes)
+                return cached
+            cached   = None
+            timer.stop('read')
 
         # 
-        # Open the netCDF file, what is read depends on means.
+        # Open the netCDF file read-only; in parallel if we can:
         #
-#       nc=Dataset(fileName,'r+',parallel=True)
-        nc=Dataset(fileName,'r+')
-        N = nc.variables[ensembleName]
-        if len(N.shape) != 5:
+        timer.start('read')
+        nc = None
+        if comm is not None and comm.Get_size() > 1 and not isinstance(comm, BLocalComm) \
+           and getattr(netCDF4, '__has_parallel4_support__', False):
+            try:
+                nc = Dataset(fileName, 'r', parallel=True, comm=comm, info=MPI.INFO_NULL)
+            except (OSError, RuntimeError, ValueError):
+                nc = None
+        parallel = nc is not None
+        if not parallel:
+            nc = Dataset(fileName, 'r')
+
+        V = nc.variables[ensembleName]
+        if len(V.shape) != 5:
             sys.exit("Error, ensemble should have five dimensions!")
-        gdims = N.shape[2:5]
+        nensembles,ntimes,iz,iy,ix = V.shape
+        if itime < 0 or itime >= ntimes:
+            sys.exit("Error, bad itime in Btools_getSlabData!")
+        if levels is not None and (min(levels) < 0 or max(levels) >= iz):
+            sys.exit("Error, bad levels in Btools_getSlabData!")
+        V.set_auto_mask(False)
+        if parallel:
+            V.set_collective(True)
+
+        #
+        # Find this rank's part of decimated global grid, and read
+        # only that:
+        #
+        gdims = BTools.gridDims(V.shape, decimate, levels)
+        D     = BDecomp(gdims, mpiTasks, decomp)
+        N     = D.read(V, itime, mpiRank, decimate, levels, klev)
+
+        nc.close()
+        timer.stop('read', nbytes=N.nbytes)
 
         #
         # Return the selected data.
@@ -414,48 +1651,101 @@ class BTools:
         #    2: T(ens,x,y,z) - <T(x,y,z)>
         #    3: raw (no subtracted mean)
 
-        if means == 1: # T(x,y,x) >= Sum ens T(ens,x,y,z)/num ensembles
-           N = nc.variables[ensembleName]
-           if len(N.shape) != 5:
-              sys.exit("Error, ensemble should have five dimensions!")
-           nensembles,ntimes,iz,iy,ix = N.shape
-           Nsum = np.zeros([1,iy,ix],dtype=np.float32)
-           for i in range(0,nensembles):
-              Nsum = Nsum + N[i,itime,1,:,:]
-           N = np.true_divide(Nsum,nensembles+1)
-        elif means == 2:  # Subtract the ensemble mean.
-           N = nc.variables[ensembleName]
-           if len(N.shape) != 5:
-              sys.exit("Error, ensemble should have five dimensions!")
-           nensembles,ntimes,iz,iy,ix = N.shape
-           N = N[:,0,0:nz,:,:]
-           mean = np.mean(N, 0)
-           for i in range(0,nensembles): # subtract mean from each ens. member
-              N[i,:,:,:] -= mean
-        elif means == 3:
-           N = nc.variables[ensembleName]
-           if len(N.shape) != 5:
-              sys.exit("Error, ensemble should have five dimensions!")
-           nensembles,ntimes,iz,iy,ix = N.shape
+        timer.start('anomaly')
+        box = D.box(mpiRank)
+        if box is not None:
+          if klev is not None:
+            box = ((max(box[0][0], klev[0]), max(min(box[0][1], klev[1]), klev[0]-1)),) + box[1:]
+          N = np.ascontiguousarray(N.reshape([nensembles] + [max(e-b+1, 0) for (b, e) in box]))
         else:
-           sys.exit("Error, bad mean spec!")
- 
-        if decimate > 1:
-           N = N[:,:,::decimate,::decimate]
-        gdims = ([ N.shape[1], N.shape[2], N.shape[3] ])
-        iLstart,iLend = BTools.range(gdims[2], mpiTasks, mpiRank)
-        N = N[:,:,:,iLstart:(iLend+1)]
-
-        nc.close
+          N = np.ascontiguousarray(N)
+        if means == 1:   # <T(x,y,x)> = Sum ens T(ens,x,y,z)/num ensembles
+           N = np.mean(N, 0, keepdims=True)
+        elif means == 2: # Subtract the ensemble mean.
+           N -= np.mean(N, 0)
+        timer.stop('anomaly')
 #       print (mpiRank,": getSlabData: N.shape_final=",N.shape, " nensembles=", nensembles)
 #       sys.stdout.flush()
-        if len(gdims) == 2:
-          gdims = ([1, gdims[0], gdims[1]])
         gdims = ([int(gdims[0]),int(gdims[1]),int(gdims[2]) ])
 
+        if standardized:
+            timer.start('standardize')
+            N = BTools.standardizeSlab(np.ascontiguousarray(N, dtype=np.float32).reshape(-1), \
+                                       N.shape[0], N.size//max(N.shape[0], 1))
+            timer.stop('standardize')
+
+        if cache is not None:
+            C.store(cname, ckey, N, nensembles, gdims)
+
         return N, nensembles, gdims  # end, getSlabData netghid
 
 
+    ################################################################
+    #  Method: gridDims
+    #  Desc  : Dims of (decimated) global grid used, given shape of
+    #          ensemble variable
+    #  Args  : 
+    #          shape       : (nens, ntimes, Nz, Ny, Nx) of variable
+    #          decimate    : decimation factor in x, y
+    #          levels      : list of file levels used (None: first
+    #                        level only)
+    # Returns: gdims: [Nz, Ny, Nx]
+    ################################################################
+    @staticmethod
+    def gridDims(shape, decimate, levels=None):
+
+        decimate = max(int(decimate), 1)
+        (nens, ntimes, iz, iy, ix) = shape
+        nz = 1 if levels is None else len(levels)
+
+        return [nz, len(range(0,iy,decimate)), len(range(0,ix,decimate))]  # end, gridDims method
+
+
+    ################################################################
+    #  Method: getDims
+    #  Desc  : Reads only the metadata of specified NetCDF4 file, to
+    #          find the problem size, without reading data
+    #  Args  : 
+    #          fileName    : string, filename of the netCDF file to open
+    #          ensembleName: string, name of the ensemble
+    #          decimate    : integer, decimation factor (see getSlabData)
+    #          levels      : list of file levels used (see getSlabData)
+    # Returns: nens : number of ensemble members
+    #          ntimes: number of times
+    #          gdims: dims of (decimated) global grid: (Nz, Ny, Nx)
+    ################################################################
+    @staticmethod
+    def getDims(fileName, ensembleName, decimate, levels=None):
+
+        nc = Dataset(fileName, 'r')
+        V  = nc.variables[ensembleName]
+        if len(V.shape) != 5:
+            sys.exit("Error, ensemble should have five dimensions!")
+        shape = V.shape
+        nc.close()
+        if levels is not None and (min(levels) < 0 or max(levels) >= shape[2]):
+            sys.exit("Error, bad levels for " + ensembleName + "!")
+
+        return shape[0], shape[1], BTools.gridDims(shape, decimate, levels)  # end, getDims method
+
+
+    ################################################################
+    #  Method: writeSparse
+    #  Desc  : Writes BMata results in compact, compressed, row-sorted
+    #          sparse (CSR) form; see BSparse.write. Collective.
+    #  Args  : 
+    #          B, I, J     : this task's B-matrix entries, and I,J 
+    #                        locations in matrix
+    #          filename    : output file prefix
+    #          attrs       : dict of attributes to store with results
+    # Returns: name of index file
+    ################################################################
+    def writeSparse(self, B, I, J, filename, attrs=None):
+
+      return BSparse.write(self.comm_, B, I, J, int(self.offsets_[-1]), filename, \
+                           attrs=attrs)  # end, method writeSparse
+
+
     ################################################################
     #  Method: writeResults
     #  Desc  : Writes BMata ressults to a file
@@ -463,10 +1753,12 @@ class BTools:
     #          B, I, J     : B-matrix entries, and I,J locations in matrix
     #          fileName    : string, filename of the netCDF file to open
     #          mpiRank     : MPI task id
+    #          attrs       : dict of global attributes to store with
+    #                        results, e.g. threshold (None: none)
     # Returns: none.
     ################################################################
     @staticmethod
-    def writeResults(xB,xI,xJ,filename,mpiRank):
+    def writeResults(xB,xI,xJ,filename,mpiRank,attrs=None):
 
       #
       # Check the inputs.
@@ -481,7 +1773,7 @@ class BTools:
 
       # Open the netCDF4 file.
       filename = filename + "." + str(mpiRank) + ".nc"
-      ncout = Dataset(filename, 'w', formt='NETCDF4')
+      ncout = Dataset(filename, 'w', format='NETCDF4')
       
       # Define a dimension for B,I,J.
       nResults = xB.size
@@ -496,6 +1788,8 @@ class BTools:
       B[:] = xB
       I[:] = xI
       J[:] = xJ
+      if attrs is not None:
+         ncout.setncatts(attrs)
 
       # Close the file.
       ncout.close()
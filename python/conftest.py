@@ -0,0 +1,35 @@
+################################################################
+#  Module: conftest.py
+#  Desc  : pytest fixtures shared by the tests: a one-task
+#          communicator of the local backend, in process, and a
+#          runner of scripts as tasks of the local launcher
+################################################################
+import os
+import subprocess
+import sys
+import pytest
+from   bcomm import BLocalComm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# One-task communicator of the local backend; while in use, MPI
+# names resolve to the local backend, as in a launcher worker:
+@pytest.fixture
+def local_comm(monkeypatch):
+  comm = BLocalComm.single()
+  monkeypatch.setattr(BLocalComm, "world_", comm)
+  return comm
+
+
+# Runner of a script as ntasks tasks of the local launcher, in a
+# directory; returns the exit code, with output in <cwd>/log:
+@pytest.fixture
+def launch():
+  def run(ntasks, script, args, cwd, env=None):
+    cmd = [sys.executable, os.path.join(HERE, "bcomm.py"), "-n", str(ntasks), script] \
+        + [str(a) for a in args]
+    with open(os.path.join(cwd, "log"), 'w') as log:
+      return subprocess.call(cmd, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, \
+                             env=dict(os.environ, **(env or {})), timeout=300)
+  return run
@@ -0,0 +1,117 @@
+################################################################
+#  Module: test_baccum.py
+#  Desc  : Tests of BAccum & BWidths accumulators, and of the
+#          result memory cap of an analysis run
+#
+#          Usage:
+#            python -m pytest -q test_baccum.py
+################################################################
+import numpy as np
+import pytest
+import threading
+from   baccum import BAccum, BWidths
+
+
+# Entries (B, I, J) of n hits:
+def entries(n, seed=0):
+  rng = np.random.default_rng(seed)
+  return rng.standard_normal(n).astype(np.float32), np.arange(n), rng.integers(0, 1000, n)
+
+
+# Smooth random ensemble, N(nens, npts), of a 1 x ny x nx grid:
+def smooth_ensemble(nens=16, ny=20, nx=30, seed=1):
+  rng = np.random.default_rng(seed)
+  N   = rng.standard_normal((nens, ny, nx)).cumsum(axis=2).cumsum(axis=1)
+  N  -= N.mean(axis=0)
+  return N.reshape(nens, -1).astype(np.float32), [1, ny, nx]
+
+
+def test_append_get_order():
+  (B, I, J) = entries(10000)
+  a = BAccum(np.float32, chunksz=3000)
+  for k in range(0, 10000, 777):
+    a.append(B[k:k+777], I[k:k+777], J[k:k+777])
+  assert a.size() == 10000
+  (B1, I1, J1) = a.get()
+  assert np.array_equal(B1, B) and np.array_equal(I1, I) and np.array_equal(J1, J)
+  assert a.size() == 0 and a.nbytes() == 0
+
+
+def test_chunks_grow_from_small():
+  a = BAccum(np.float32)
+  a.append(*entries(10))
+  assert a.nbytes() == BAccum.minchunk_*a.entsz_
+
+
+def test_cap_smaller_than_chunk():
+  # A cap far below one full chunk holds a few thousand entries:
+  a = BAccum(np.float32, maxbytes=100000)
+  a.append(*entries(3000))
+  assert a.size() == 3000 and a.nbytes() <= 100000
+
+
+def test_cap_exceeded():
+  a = BAccum(np.float32, maxbytes=100000)
+  with pytest.raises(SystemExit):
+    a.append(*entries(100000//a.entsz_ + 1))
+
+
+def test_spawned_share_cap():
+  a   = BAccum(np.float32, maxbytes=200000)
+  t   = [a.spawn(4) for k in range(0, 4)]
+  (B, I, J) = entries(6000)
+
+  # Hits skewed to one thread still fit the shared cap:
+  t[0].append(B[0:5000], I[0:5000], J[0:5000])
+  th = [threading.Thread(target=t[k].append, args=(B[4750+k*250:5000+k*250],
+                         I[4750+k*250:5000+k*250], J[4750+k*250:5000+k*250])) for k in range(1, 4)]
+  [h.start() for h in th]
+  [h.join() for h in th]
+  for k in range(0, 4):
+    a.merge(t[k])
+  assert a.size() == 5750 and a.budget_.used_ == a.nbytes()
+  (B1, I1, J1) = a.get()
+  assert np.array_equal(np.sort(I1), I[0:5750])
+  assert a.budget_.used_ == 0
+
+  # ... but not, together, more than the cap:
+  t = [a.spawn(2) for k in range(0, 2)]
+  t[0].append(*entries(5000))
+  with pytest.raises(SystemExit):
+    t[1].append(*entries(5000))
+
+
+def test_state_restore():
+  (B, I, J) = entries(5000)
+  a = BAccum(np.float64)
+  a.append(B, I, J)
+  s = a.state()
+  b = BAccum(np.float64)
+  b.restore(s)
+  assert np.array_equal(b.get()[2], J) and a.size() == 5000
+
+
+def test_widths_merge():
+  w = BWidths(4, row0=10)
+  t = w.spawn()
+  cg = np.array([3, 5, 8])
+  w.update(np.array([[1, 0, 1], [0, 0, 0]], dtype=bool), 10, cg)
+  t.update(np.array([[0, 1, 0], [0, 1, 1]], dtype=bool), 11, cg)
+  t.update(np.array([[1, 0, 0]], dtype=bool), 10, cg)
+  w.merge(t)
+  (jmin, jmax, count) = w.get()
+  assert list(jmin[0:3]) == [3, 5, 5] and list(jmax[0:3]) == [8, 5, 8]
+  assert list(count) == [3, 1, 2, 0] and jmax[3] == -1
+
+
+def test_capped_run():
+  from banalyze import BAnalyzer
+  (N, gdims) = smooth_ensemble()
+
+  # A few thousand hits, under a 1 MB cap:
+  R = BAnalyzer(decfact=1, maxmem=1024*1024).analyze(N, 0.9, gdims=gdims)
+  assert 1000 < R.counts_[0] < 40000 and len(R.B_) == R.counts_[0]
+
+  # Over the cap:
+  with pytest.raises(SystemExit):
+    BAnalyzer(decfact=1, maxmem=R.counts_[0]*8).analyze(N, 0.9, gdims=gdims)
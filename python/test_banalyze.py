@@ -0,0 +1,62 @@
+################################################################
+#  Module: test_banalyze.py
+#  Desc  : Tests of the analysis API: analyze of file and array
+#          sources, reuse of analyzers and their buffers, and bmata
+#          run in process through its console entry point
+#
+#          Usage:
+#            python -m pytest -q test_banalyze.py
+################################################################
+import numpy as np
+from   netCDF4 import Dataset
+import banalyze
+import bmata
+from   test_btools import smooth_ensemble, check, entries, ref_widths
+from   test_bcache import write_ensemble
+
+
+def test_analyze(tmp_path, monkeypatch, local_comm):
+  monkeypatch.setattr(banalyze, "_analyzer", None)
+  (N, gdims) = smooth_ensemble(nz=2)
+  fileName   = str(tmp_path / "ens.nc")
+  write_ensemble(fileName, N, gdims)
+
+  # File and array sources give the entries of brute force:
+  R  = banalyze.analyze(fileName, 0.6, varname="T", decfact=1, levels=[0, 1])
+  A  = banalyze._analyzer
+  check(R, N, 0.6)
+  assert R.gdims_ == gdims and R.nens_ == N.shape[0] and list(R.rows_) == list(range(0, N.shape[1]))
+  assert R.stats(0) == (R.maxWidth_[0], R.irowmax_[0], R.avgWidth_[0], R.avgWidth1_[0])
+  Ra = banalyze.analyze(N, 0.6, gdims=gdims, decfact=1, levels=[0, 1])
+  check(Ra, N, 0.6)
+  assert set(entries(Ra)) == set(entries(R)) and np.array_equal(Ra.gwidths_[0], R.gwidths_[0])
+
+  # The analyzer, and its BTools buffers, are kept for the same
+  # settings and dims; other settings get another analyzer:
+  assert banalyze._analyzer is A
+  T  = A.tools_
+  Rw = banalyze.analyze(N, [0.5, 0.7], gdims=gdims, decfact=1, levels=[0, 1])
+  assert banalyze._analyzer is A and A.tools_ is T and Rw.B_ is None
+  for it in range(0, 2):
+    ((Wlo, nlo), (Whi, nhi)) = ref_widths(N, [0.5, 0.7][it])
+    assert nlo <= Rw.counts_[it] <= nhi
+  Rs = banalyze.analyze(N, 0.6, gdims=gdims, decfact=1, levels=[0, 1], symmetric=True)
+  assert banalyze._analyzer is not A and set(entries(Rs)) == set(entries(R))
+  check(Rs, N, 0.6)
+
+
+def test_main(tmp_path, local_comm):
+  # bmata's console entry point, in process, writes the results of
+  # an analysis:
+  (N, gdims) = smooth_ensemble()
+  fileName   = str(tmp_path / "ens.nc")
+  write_ensemble(fileName, N, gdims)
+  bmata.main(["-infile", fileName, "-dfact", "1", "-thresh", "0.6", "-opref", str(tmp_path / "B")])
+
+  R  = banalyze.BAnalyzer(local_comm, decfact=1).analyze(N, 0.6, gdims=gdims)
+  nc = Dataset(str(tmp_path / "B.0.nc"), 'r')
+  assert len(nc.variables['B'][:]) == R.counts_[0]
+  nc.close()
+  assert np.array_equal(np.loadtxt(tmp_path / "B.width.0.6.1.txt"), R.gwidths_[0])
+  summary = (tmp_path / "B.summary.0.6.1.txt").read_text()
+  assert "max ribbon width............: %d\n" % R.maxWidth_[0] in summary
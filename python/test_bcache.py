@@ -0,0 +1,67 @@
+################################################################
+#  Module: test_bcache.py
+#  Desc  : Tests of BCache: slabs are cached standardized, and a
+#          cached run neither reads nor standardizes its data; a
+#          changed input file is read again
+#
+#          Usage:
+#            python -m pytest -q test_bcache.py
+################################################################
+import glob
+import os
+import numpy as np
+from   netCDF4 import Dataset
+import btools
+from   banalyze import BAnalyzer
+from   test_btools import smooth_ensemble, check, entries
+
+
+# Write ensemble file, of variable T(ens, time, lev, lat, lon), of
+# anomalies N(nens, npts), at time 0:
+def write_ensemble(fileName, N, gdims):
+  nc = Dataset(fileName, 'w', format='NETCDF4')
+  for (d, n) in zip(['ens', 'time', 'lev', 'lat', 'lon'], [N.shape[0], 1] + gdims):
+    nc.createDimension(d, n)
+  nc.createVariable('T', 'f4', ('ens', 'time', 'lev', 'lat', 'lon'))[:] = N.reshape([N.shape[0], 1] + gdims)
+  nc.close()
+
+
+def test_standardized_slab(tmp_path):
+  (N, gdims) = smooth_ensemble()
+  fileName   = str(tmp_path / "ens.nc")
+  write_ensemble(fileName, N, gdims)
+
+  # Slab read standardized is that BTools makes of the anomalies:
+  (A, nens, g) = btools.BTools.getSlabData(fileName, "T", 0, 1, 0, 2, 1)
+  ((Z, sd), nens, g) = btools.BTools.getSlabData(fileName, "T", 0, 1, 0, 2, 1, standardized=True)
+  (Zr, sdr) = btools.BTools.standardizeSlab(A.reshape(-1), nens, A.size//nens)
+  assert Z.shape == (N.shape[1], nens) and np.array_equal(Z, Zr) and np.array_equal(sd, sdr)
+
+
+def test_cached_run(tmp_path, monkeypatch):
+  (N, gdims) = smooth_ensemble()
+  fileName   = str(tmp_path / "ens.nc")
+  write_ensemble(fileName, N, gdims)
+  cache      = str(tmp_path / "cache")
+
+  R = BAnalyzer(decfact=1, cachedir=cache).analyze(fileName, 0.6, varname="T")
+  check(R, N, 0.6)
+  assert len(glob.glob(os.path.join(cache, "*.sd.npy"))) == 1
+
+  # Cached: the file isn't opened, nor the slab standardized:
+  def fail(*args, **kwargs):
+    raise AssertionError("slab not cached")
+  with monkeypatch.context() as m:
+    m.setattr(btools, "Dataset", fail)
+    m.setattr(btools.BTools, "standardizeSlab", staticmethod(fail))
+    Rc = BAnalyzer(decfact=1, cachedir=cache).analyze(fileName, 0.6, varname="T")
+  assert entries(Rc) == entries(R)
+
+  # A changed file is read again, and its entry replaced:
+  (N2, gdims) = smooth_ensemble(seed=2)
+  write_ensemble(fileName, N2, gdims)
+  st = os.stat(fileName)
+  os.utime(fileName, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+  R2 = BAnalyzer(decfact=1, cachedir=cache).analyze(fileName, 0.6, varname="T")
+  check(R2, N2, 0.6)
+  assert len(glob.glob(os.path.join(cache, "*.npy"))) == 2
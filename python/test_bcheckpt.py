@@ -0,0 +1,71 @@
+################################################################
+#  Module: test_bcheckpt.py
+#  Desc  : Tests of BCheckpoint save & load, and of a run restored
+#          from its checkpoint
+#
+#          Usage:
+#            python -m pytest -q test_bcheckpt.py
+################################################################
+import glob
+import numpy as np
+import pytest
+import btools
+from   banalyze import BAnalyzer
+from   bcheckpt import BCheckpoint
+from   test_btools import smooth_ensemble, entries
+
+
+# Accumulator states, of entries k0..k1-1, of 2 threads & 1 threshold:
+def states(k0, k1):
+  return [[{"B": np.arange(k0, k1)*0.5, "I": np.arange(k0, k1)}], [{"W": np.full(3, k1)}]]
+
+
+def test_save_load(tmp_path):
+  key = BCheckpoint.key(np.ones(10, dtype=np.float32), {"thresh": [0.5]})
+  C   = BCheckpoint(str(tmp_path), 2, interval=0)
+  assert C.load(key) is None and C.due()
+
+  # Appended states are saved a segment at a time; whole ones, each
+  # save:
+  append = [[True], [False]]
+  C.save(key, [0], [5], states(0, 5), append)
+  C.save(key, [0, 2], [9], states(5, 9), append)
+  assert C.nseg_ == 2 and len(glob.glob(str(tmp_path / "ckpt.2.seg*.npz"))) == 2
+
+  D = BCheckpoint(str(tmp_path), 2)
+  (done, ntot, s) = D.load(key)
+  assert done == [0, 2] and list(ntot) == [9] and D.nseg_ == 2
+  assert np.array_equal(s[0][0]["I"], np.arange(0, 9)) and np.array_equal(s[0][0]["B"], np.arange(0, 9)*0.5)
+  assert np.array_equal(s[1][0]["W"], [9, 9, 9])
+  assert not D.due()
+
+  # Another key (changed data, or settings) has no checkpoint:
+  assert D.load(BCheckpoint.key(np.zeros(10, dtype=np.float32), {"thresh": [0.5]})) is None
+  assert D.load(BCheckpoint.key(np.ones(10, dtype=np.float32), {"thresh": [0.6]})) is None
+
+  # Temporary files of a crashed save are removed; remove removes all:
+  (tmp_path / "ckpt.2.seg2.tmp.npz").write_bytes(b"partial")
+  D = BCheckpoint(str(tmp_path), 2)
+  assert D.load(key)[0] == [0, 2] and not (tmp_path / "ckpt.2.seg2.tmp.npz").exists()
+  D.remove()
+  assert glob.glob(str(tmp_path / "ckpt.2.*")) == [] and D.load(key) is None
+
+
+@pytest.mark.parametrize("settings", [{}, {"nthreads": 2}, {"widthsonly": True}])
+def test_restore_run(tmp_path, monkeypatch, settings):
+  (N, gdims) = smooth_ensemble()
+  R = BAnalyzer(decfact=1, ckptdir=str(tmp_path), ckptint=0, **settings).analyze(N, 0.6, gdims=gdims)
+  assert (tmp_path / "ckpt.0.npz").exists()
+
+  # All slabs are done, as restored from the checkpoint:
+  def do_thresh(self, *args, **kwargs):
+    raise AssertionError("slab not restored")
+  monkeypatch.setattr(btools.BTools, "do_thresh", do_thresh)
+  Rc = BAnalyzer(decfact=1, ckptdir=str(tmp_path), ckptint=0, **settings).analyze(N, 0.6, gdims=gdims)
+  assert Rc.counts_[0] == R.counts_[0] and np.array_equal(Rc.gwidths_[0], R.gwidths_[0])
+  if R.B_ is not None:
+    assert entries(Rc) == entries(R)
+
+  # ... but not for another threshold:
+  with pytest.raises(AssertionError):
+    BAnalyzer(decfact=1, ckptdir=str(tmp_path), ckptint=0, **settings).analyze(N, 0.7, gdims=gdims)
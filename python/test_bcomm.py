@@ -0,0 +1,44 @@
+################################################################
+#  Module: test_bcomm.py
+#  Desc  : Tests of how MPI names resolve without mpi4py: to a
+#          single task of the local backend, unless an MPI launcher
+#          started the process
+#
+#          Usage:
+#            python -m pytest -q test_bcomm.py
+################################################################
+import sys
+import pytest
+from   bcomm import BLocalComm, BMPI, MPI
+
+
+# Environment of no MPI launcher, with mpi4py not importable:
+@pytest.fixture
+def no_mpi4py(monkeypatch):
+  for v in BMPI.sizevars_ + BMPI.rankvars_:
+    monkeypatch.delenv(v, raising=False)
+  monkeypatch.setitem(sys.modules, "mpi4py", None)
+  monkeypatch.setattr(BLocalComm, "world_", None)
+
+
+def test_single_task(no_mpi4py):
+  comm = MPI.COMM_WORLD
+  assert isinstance(comm, BLocalComm) and (comm.Get_rank(), comm.Get_size()) == (0, 1)
+  assert MPI.COMM_WORLD is comm and MPI.SUM(2, 3) == 5
+  assert comm.allreduce(4, op=MPI.SUM) == 4
+
+
+@pytest.mark.parametrize("var, value", [("OMPI_COMM_WORLD_SIZE", "4"), ("PMI_SIZE", "2"), \
+                         ("SLURM_NTASKS", "8"), ("PMIX_RANK", "0")])
+def test_launcher(no_mpi4py, monkeypatch, var, value):
+  # Tasks of an MPI launcher don't each run alone:
+  monkeypatch.setenv(var, value)
+  with pytest.raises(ImportError, match="mpi4py is required"):
+    MPI.COMM_WORLD
+  assert BLocalComm.world_ is None
+
+
+def test_launcher_one_task(no_mpi4py, monkeypatch):
+  # A task count of 1 alone is no launcher (e.g. a 1-task allocation):
+  monkeypatch.setenv("SLURM_NTASKS", "1")
+  assert BMPI.launcher() is None and MPI.COMM_WORLD.Get_size() == 1
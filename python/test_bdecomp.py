@@ -0,0 +1,102 @@
+################################################################
+#  Module: test_bdecomp.py
+#  Desc  : Tests of BDecomp domain decompositions: points of all
+#          tasks cover the grid, once; bounding boxes, near tasks,
+#          level segments, and reads of a task's points
+#
+#          Usage:
+#            python -m pytest -q test_bdecomp.py
+################################################################
+import numpy as np
+import pytest
+from   bdecomp import BDecomp
+
+# Grids, and task counts, including more tasks than rows, or levels:
+CASES = [((1, 12, 10), 1), ((1, 12, 10), 3), ((4, 7, 9), 4), ((3, 5, 16), 6), \
+         ((2, 3, 4), 30)]
+
+
+# Grid coordinates (k, j, i) of global indices:
+def coords(gidx, gn):
+  return np.stack(np.unravel_index(gidx, gn), axis=1)
+
+
+@pytest.mark.parametrize("mode", BDecomp.modes)
+@pytest.mark.parametrize("gn, nprocs", CASES)
+def test_covering_disjoint(mode, gn, nprocs):
+  D   = BDecomp(gn, nprocs, mode)
+  idx = [D.index(i) for i in range(0, nprocs)]
+
+  for i in range(0, nprocs):
+    assert len(idx[i]) == D.count(i) == D.counts_[i]
+    assert np.all(np.diff(idx[i]) > 0)
+  assert np.array_equal(np.sort(np.concatenate(idx)), np.arange(int(np.prod(gn))))
+
+
+def test_task_grid():
+  # Largest box is smallest; ties split the slowest-varying dims:
+  assert BDecomp.task_grid((8, 8, 8), 2) == (2, 1, 1)
+  assert BDecomp.task_grid((1, 8, 8), 2) == (1, 2, 1)
+  assert BDecomp.task_grid((1, 4, 16), 4) == (1, 4, 1)
+  assert BDecomp.task_grid((8, 8, 8), 8) == (8, 1, 1)
+  assert BDecomp.task_grid((1, 3, 16), 4) == (1, 1, 4)
+
+
+@pytest.mark.parametrize("mode", BDecomp.modes)
+@pytest.mark.parametrize("gn, nprocs", CASES)
+def test_bbox_near(mode, gn, nprocs):
+  D   = BDecomp(gn, nprocs, mode)
+  pts = [coords(D.index(i), gn) for i in range(0, nprocs)]
+
+  for i in range(0, nprocs):
+    b = D.bbox(i)
+    if len(pts[i]) == 0:
+      assert b is None
+      continue
+    for d in range(0, 3):
+      assert b[d][0] <= pts[i][:, d].min() and pts[i][:, d].max() <= b[d][1]
+
+  # No task with points within dist is missed, and near is symmetric:
+  for dist in [1, 2, 5]:
+    near = [D.near(i, dist) for i in range(0, nprocs)]
+    for i in range(0, nprocs):
+      assert near[i] == sorted(near[i]) and (len(pts[i]) == 0 or i in near[i])
+      for j in range(0, nprocs):
+        if len(pts[i]) > 0 and len(pts[j]) > 0:
+          dmin = np.abs(pts[i][:, None, :] - pts[j][None, :, :]).max(axis=2).min()
+          assert dmin > dist or j in near[i]
+        assert (j in near[i]) == (i in near[j])
+  assert D.near(0, 0) == list(range(0, nprocs))
+
+
+@pytest.mark.parametrize("mode", BDecomp.modes)
+@pytest.mark.parametrize("gn, nprocs", CASES)
+def test_segment(mode, gn, nprocs):
+  D = BDecomp(gn, nprocs, mode)
+  for i in range(0, nprocs):
+    lev = D.index(i) // (gn[1]*gn[2])
+    for kb in range(0, gn[0]):
+      for ke in range(kb, gn[0]):
+        (s0, s1) = D.segment(i, kb, ke)
+        on = np.nonzero((lev >= kb) & (lev <= ke))[0]
+        assert s1 - s0 == len(on)
+        assert len(on) == 0 or (on[0] == s0 and on[-1] == s1 - 1)
+
+
+@pytest.mark.parametrize("mode", BDecomp.modes)
+@pytest.mark.parametrize("gn, nprocs", CASES)
+def test_read(mode, gn, nprocs):
+  # A 5-D variable, (ens, time, lev, lat, lon), read at decimation 2,
+  # at file levels that are not all consecutive:
+  d      = 2
+  levels = [0, 1, 3, 4][0:gn[0]]
+  shape  = (3, 2, max(levels)+1, d*gn[1]-1, d*gn[2])
+  V      = np.arange(np.prod(shape), dtype=np.float32).reshape(shape)
+  G      = V[:, 1, levels][:, :, ::d, ::d].reshape(shape[0], -1)
+
+  D = BDecomp(gn, nprocs, mode)
+  for i in range(0, nprocs):
+    assert np.array_equal(D.read(V, 1, i, d, levels), G[:, D.index(i)])
+    for k in range(0, gn[0]):
+      (s0, s1) = D.segment(i, k, k)
+      assert np.array_equal(D.read(V, 1, i, d, levels, klev=(k, k)), G[:, D.index(i)[s0:s1]])
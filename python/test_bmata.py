@@ -0,0 +1,235 @@
+################################################################
+#  Module: test_bmata.py
+#  Desc  : End-to-end tests of bmata runs of several tasks, of the
+#          local launcher, against a brute-force B-matrix: exchange
+#          modes, decompositions, output formats, a run resumed from
+#          checkpoints after a crash, boffline analysis of the
+#          results, batches of items, and levels streamed in chunks
+#
+#          Usage:
+#            python -m pytest -q test_bmata.py
+################################################################
+import glob
+import os
+import types
+import numpy as np
+import pytest
+from   netCDF4 import Dataset
+from   boffline import BOffline
+import boffline
+from   test_btools import smooth_ensemble, check, ref_widths
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Runner of bmata, whose tasks exit after CRASH thresholding steps
+# each, if set, else append their number of steps to file steps:
+CRASHER = """
+import os, sys, runpy
+import btools
+crash     = int(os.environ.get("CRASH", "0"))
+do_thresh = btools.BTools.do_thresh
+nsteps    = [0]
+def counting(self, *args, **kwargs):
+  nsteps[0] += 1
+  if crash > 0 and nsteps[0] > crash:
+    os._exit(3)
+  return do_thresh(self, *args, **kwargs)
+btools.BTools.do_thresh = counting
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+with open("steps", "a") as f:
+  f.write("%d\\n" % nsteps[0])
+"""
+
+
+# Ensemble file, of variable T(ens, time, lev, lat, lon), at time 0,
+# and its anomalies, N(nens, npts):
+@pytest.fixture(scope="module")
+def ensemble(tmp_path_factory):
+  (N, gdims) = smooth_ensemble(nz=2, ny=14, nx=12)
+  fileName   = str(tmp_path_factory.mktemp("data") / "ens.nc")
+  nc = Dataset(fileName, 'w', format='NETCDF4')
+  for (d, n) in zip(['ens', 'time', 'lev', 'lat', 'lon'], [N.shape[0], 1] + gdims):
+    nc.createDimension(d, n)
+  nc.createVariable('T', 'f4', ('ens', 'time', 'lev', 'lat', 'lon'))[:] = N.reshape([N.shape[0], 1] + gdims)
+  nc.close()
+  return fileName, N
+
+
+# Run bmata as ntasks tasks, in dir, at threshold(s) thresh; returns
+# the exit code:
+def bmata(launch, ntasks, fileName, dir, thresh, args=[]):
+  return launch(ntasks, os.path.join(HERE, "bmata.py"), ["-infile", fileName, "-dfact", 1, \
+                "-levels", "0:2", "-thresh"] + list(np.atleast_1d(thresh)) + ["-opref", "B"] + args, dir)
+
+
+# Entries of a run, of output prefix opref, as a result:
+def results(dir, ntasks, opref="B"):
+  if os.path.exists(os.path.join(dir, opref + ".csr.json")):
+    from bsparse import BSparseReader
+    R = BSparseReader(os.path.join(dir, opref))
+    (I, J, B) = R.rows(0, R.nrows_)
+    R.close()
+  else:
+    Bs, Is, Js = [], [], []
+    for r in range(0, ntasks):
+      nc = Dataset(os.path.join(dir, opref + "." + str(r) + ".nc"), 'r')
+      Bs.append(np.asarray(nc.variables['B'][:]))
+      Is.append(np.asarray(nc.variables['I'][:], dtype=np.int64))
+      Js.append(np.asarray(nc.variables['J'][:], dtype=np.int64))
+      nc.close()
+    (B, I, J) = (np.concatenate(Bs), np.concatenate(Is), np.concatenate(Js))
+  return types.SimpleNamespace(B_=B, I_=I, J_=J)
+
+
+# Check widths written by a run, of output prefix opref, against
+# reference:
+def check_widths(dir, N, thresh, opref="B"):
+  W = np.loadtxt(os.path.join(dir, opref + ".width." + str(thresh) + ".1.txt"))
+  ((Wlo, nlo), (Whi, nhi)) = ref_widths(N, thresh)
+  assert np.all(Wlo <= W) and np.all(W <= Whi)
+
+
+@pytest.mark.parametrize("ntasks, args", [(3, []), (3, ["-exch", "ring"]), (4, ["-sym"]), \
+                         (3, ["-decomp", "xyz", "-nthreads", "2"]), (3, ["-ofmt", "csr"]), \
+                         (2, ["-sym", "-exch", "ring", "-decomp", "points"])])
+def test_tasks(tmp_path, launch, ensemble, ntasks, args):
+  (fileName, N) = ensemble
+  assert bmata(launch, ntasks, fileName, tmp_path, 0.6, args) == 0
+  check(results(tmp_path, ntasks), N, 0.6)
+  check_widths(tmp_path, N, 0.6)
+
+
+def test_widths_thresholds(tmp_path, launch, ensemble):
+  (fileName, N) = ensemble
+  assert bmata(launch, 3, fileName, tmp_path, [0.5, 0.8], ["-nthreads", "2"]) == 0
+  assert not os.path.exists(tmp_path / "B.0.nc")
+  check_widths(tmp_path, N, 0.5)
+  check_widths(tmp_path, N, 0.8)
+
+
+@pytest.mark.parametrize("args, nsteps", [([], 3), (["-sym"], 2)])
+def test_resume(tmp_path, launch, ensemble, args, nsteps):
+  (fileName, N) = ensemble
+  script = tmp_path / "crasher.py"
+  script.write_text(CRASHER)
+  args   = ["-ckpt", "ckpt", "-ckptint", 0] + args
+
+  # Tasks exit after their first slab is thresholded ...
+  rc = launch(3, script, [os.path.join(HERE, "bmata.py"), "-infile", fileName, "-dfact", 1, \
+              "-levels", "0:2", "-thresh", 0.6, "-opref", "B"] + args, tmp_path, {"CRASH": "1"})
+  assert rc != 0 and not os.path.exists(tmp_path / "B.width.0.6.1.txt")
+  assert len(glob.glob(str(tmp_path / "ckpt" / "ckpt.*.npz"))) > 0
+
+  # ... and, run again, resume from their checkpoints (at least that
+  # of the first to exit), which are removed once results are written:
+  assert launch(3, script, [os.path.join(HERE, "bmata.py"), "-infile", fileName, "-dfact", 1, \
+                "-levels", "0:2", "-thresh", 0.6, "-opref", "B"] + args, tmp_path) == 0
+  steps = np.loadtxt(tmp_path / "steps", dtype=int)
+  assert len(steps) == 3 and steps.max() <= nsteps and steps.sum() < 3*nsteps
+  check(results(tmp_path, 3), N, 0.6)
+  check_widths(tmp_path, N, 0.6)
+  assert glob.glob(str(tmp_path / "ckpt" / "ckpt.*")) == []
+
+
+@pytest.mark.parametrize("ofmt", ["nc", "csr"])
+def test_boffline(tmp_path, launch, ensemble, ofmt):
+  (fileName, N) = ensemble
+  assert bmata(launch, 3, fileName, tmp_path, 0.6, ["-ofmt", ofmt]) == 0
+  W    = np.loadtxt(tmp_path / "B.width.0.6.1.txt")
+  npts = N.shape[1]
+
+  # Widths of the results, as written by bmata:
+  r = BOffline(str(tmp_path / "B"), npts, nproc=2, chunk=100).run([0.6])[0]
+  assert np.array_equal(np.where(r["count"] > 0, r["jmax"] - r["jmin"], 0), W)
+  assert r["count"].sum() == len(results(tmp_path, 3).B_)
+
+  # Re-thresholded, as a stricter run:
+  var = BOffline.variance(fileName, "T", 0, 1, [0, 1], nparts=3)
+  A   = N.astype(np.float64)
+  assert var == pytest.approx((A*A).mean(axis=0), rel=1.0e-5)
+  r   = BOffline(str(tmp_path / "B"), npts, var, nproc=1).run([0.6, 0.8])
+  assert np.array_equal(r[0]["count"], np.bincount(results(tmp_path, 3).I_, minlength=npts))
+  ((Wlo, nlo), (Whi, nhi)) = ref_widths(N, 0.8)
+  W8 = np.where(r[1]["count"] > 0, r[1]["jmax"] - r[1]["jmin"], 0)
+  assert np.all(Wlo <= W8) and np.all(W8 <= Whi) and nlo <= r[1]["count"].sum() <= nhi
+
+  # From the command line, widths & summary files:
+  boffline.main(["-ipref", str(tmp_path / "B"), "-npts", str(npts), "-thresh", "0.6", \
+                 "-opref", str(tmp_path / "off"), "-nproc", "1"])
+  assert np.array_equal(np.loadtxt(tmp_path / "off.width.0.6.1.txt"), W)
+  assert os.path.exists(tmp_path / "off.summary.0.6.1.txt")
+
+
+@pytest.mark.parametrize("ofmt", ["nc", "csr", "nc-unlabeled"])
+def test_boffline_rethreshold(tmp_path, launch, ensemble, ofmt):
+  (fileName, N) = ensemble
+  assert bmata(launch, 3, fileName, tmp_path, 0.6, ["-ofmt", ofmt.split("-")[0]]) == 0
+  args = ["-ipref", str(tmp_path / "B"), "-opref", str(tmp_path / "off"), "-nproc", "1"]
+  if ofmt == "nc-unlabeled":      # results without their threshold
+    for r in range(0, 3):
+      nc = Dataset(str(tmp_path / ("B." + str(r) + ".nc")), 'a')
+      nc.delncattr("threshold")
+      nc.close()
+  else:
+    assert BOffline(str(tmp_path / "B"), N.shape[1]).attrs_ == {"threshold": 0.6, "decimation": 1}
+
+  # A threshold other than that of the results, or any threshold if
+  # that is unknown, needs variances ...
+  for t in ["0.8"] + (["0.6"] if ofmt == "nc-unlabeled" else []):
+    with pytest.raises(SystemExit):
+      boffline.main(args + ["-thresh", t])
+    assert not os.path.exists(tmp_path / ("off.width." + t + ".1.txt"))
+
+  # ... computed from the input file, and stored:
+  boffline.main(args + ["-thresh", "0.8", "-var", str(tmp_path / "var.npy"), "-infile", fileName, \
+                        "-levels", "0:2"])
+  assert os.path.exists(tmp_path / "var.npy")
+  ((Wlo, nlo), (Whi, nhi)) = ref_widths(N, 0.8)
+  W8 = np.loadtxt(tmp_path / "off.width.0.8.1.txt")
+  assert np.all(Wlo <= W8) and np.all(W8 <= Whi)
+
+
+def test_batch(tmp_path, launch):
+  # Items of two variables, at two times, each written under its own
+  # prefix, as separate runs would be:
+  gdims    = [2, 10, 9]
+  Ns       = dict([((v, t), smooth_ensemble(nz=2, ny=10, nx=9, seed=10*iv+t)[0]) \
+                   for (iv, v) in enumerate(['T', 'Q']) for t in range(0, 2)])
+  fileName = str(tmp_path / "ens.nc")
+  nc = Dataset(fileName, 'w', format='NETCDF4')
+  for (d, n) in zip(['ens', 'time', 'lev', 'lat', 'lon'], [16, 2] + gdims):
+    nc.createDimension(d, n)
+  for v in ['T', 'Q']:
+    nc.createVariable(v, 'f4', ('ens', 'time', 'lev', 'lat', 'lon'))[:] = \
+      np.stack([Ns[(v, t)].reshape([16] + gdims) for t in range(0, 2)], axis=1)
+  nc.close()
+
+  assert launch(3, os.path.join(HERE, "bmata.py"), ["-infile", fileName, "-varname", "T", "Q", \
+                "-times", "0:2", "-dfact", 1, "-levels", "0:2", "-thresh", 0.6, "-opref", "B"], \
+                tmp_path) == 0
+  for ((v, t), N) in Ns.items():
+    opref = "B." + v + ".t" + str(t)
+    check(results(tmp_path, 3, opref), N, 0.6)
+    check_widths(tmp_path, N, 0.6, opref)
+    assert os.path.exists(tmp_path / (opref + ".timing.0.6.1.json"))
+
+
+@pytest.mark.parametrize("args", [["-decomp", "z"], ["-decomp", "xyz", "-levchunk", 1], \
+                         ["-decomp", "z", "-levchunk", 1, "-exch", "ring"]])
+def test_levels(tmp_path, launch, args):
+  # File levels 1 and 3 of 4, as grid levels 0 and 1, all at once, or
+  # streamed a chunk of levels at a time:
+  (N4, gdims) = smooth_ensemble(nz=4, ny=9, nx=8)
+  fileName = str(tmp_path / "ens.nc")
+  nc = Dataset(fileName, 'w', format='NETCDF4')
+  for (d, n) in zip(['ens', 'time', 'lev', 'lat', 'lon'], [N4.shape[0], 1] + gdims):
+    nc.createDimension(d, n)
+  nc.createVariable('T', 'f4', ('ens', 'time', 'lev', 'lat', 'lon'))[:] = N4.reshape([N4.shape[0], 1] + gdims)
+  nc.close()
+  N = N4.reshape(N4.shape[0], 4, -1)[:,[1, 3]].reshape(N4.shape[0], -1)
+
+  assert launch(3, os.path.join(HERE, "bmata.py"), ["-infile", fileName, "-dfact", 1, "-levels", 1, 3, \
+                "-thresh", 0.6, "-opref", "B"] + args, tmp_path) == 0
+  check(results(tmp_path, 3), N, 0.6)
+  check_widths(tmp_path, N, 0.6)
@@ -0,0 +1,109 @@
+################################################################
+#  Module: test_bplan.py
+#  Desc  : Tests of BPlan predictions: buffer sizes by hand, and
+#          against the buffers BTools allocates; communication,
+#          flops, and suggestions that fit a budget
+#
+#          Usage:
+#            python -m pytest -q test_bplan.py
+################################################################
+import numpy as np
+import pytest
+from   banalyze import BAnalyzer
+from   bdecomp import BDecomp
+from   bplan import BPlan
+
+
+# Buffers of a plan, name -> bytes, with slot counts dropped:
+def buffers(P):
+  return dict([(n.split(" (")[0], b) for (n, b) in P.buffers()])
+
+
+def test_buffers_by_hand():
+  # 640 points, 160 per task, of 16 members:
+  P    = BPlan((1, 20, 32), 16, 4, tilesz=64)
+  slab = 16*160*4
+  b    = buffers(P)
+  assert P.nptmax_ == 160 and P.ntot_ == 640
+  assert b["input slab"] == 2*slab and b["standardized local slab"] == slab
+  assert b["receive buffer"] == 4*slab and b["receive buffer, slab RMS"] == 4*160*8
+  assert b["tile workspace"] == 64*64*9
+  assert b["result entries"] == 0 and b["global ribbon width arrays"] == 16*640
+  assert P.memory() == sum(b.values()) and P.unbounded()
+
+  # Ring exchange holds 2 slabs, but not with the local backend's
+  # shared slabs; scratch files hold slabs out-of-core:
+  assert buffers(BPlan((1, 20, 32), 16, 4, exchange='ring'))["receive buffer"] == 2*slab
+  assert buffers(BPlan((1, 20, 32), 16, 4, exchange='ring', shared=True))["receive buffer"] == 4*slab
+  b = buffers(BPlan((1, 20, 32), 16, 4, scratch="/tmp"))
+  assert b["receive buffer"] == 0 and b["standardized local slab"] == 0
+
+  # Result entries, capped, or of an expected fraction of pairs:
+  P = BPlan((1, 20, 32), 16, 4, maxmem=10**6)
+  assert buffers(P)["result entries"] == 10**6 and not P.unbounded()
+  P = BPlan((1, 20, 32), 16, 4, hitfrac=0.01)
+  assert buffers(P)["result entries"] == 1024*20 and not P.unbounded()
+
+  # Widths only: row accumulators of each thread, and of the task:
+  P = BPlan((1, 20, 32), 16, 4, nthreads=2, widthsonly=True, nthresh=3)
+  assert buffers(P)["row width accumulators"] == 3*3*160*24 and not P.unbounded()
+
+
+def test_comm_flops():
+  slab = 16*160*4
+  P    = BPlan((1, 20, 32), 16, 4)
+  assert P.comm_volume() == 3*slab and P.flops() == 2.0*16*160*640
+  P    = BPlan((1, 20, 32), 16, 4, symmetric=True)
+  assert P.comm_volume() == 2*slab and P.flops() == 16*160*640
+  P    = BPlan((1, 20, 32), 16, 4, sample=0.1)
+  assert not P.symmetric_ and P.flops() == 2.0*16*16*640
+
+
+def test_band_near():
+  P = BPlan((1, 20, 32), 16, 5, band=4, maxdist=3)
+  D = BDecomp((1, 20, 32), 5)
+  assert P.nnear_ == D.counts_[D.near(0, 3)].sum() == 2*7*20
+  assert buffers(P)["gathered standardized points"] == 280*(16*4 + 32)
+
+
+def test_level_chunk():
+  P = BPlan((8, 10, 10), 16, 2, decomp='z')
+  assert P.nchunks_ == 1 and P.level_chunk(P.memory()) == 0
+
+  # Chunks of 3 levels fit, and 4 don't:
+  P3 = BPlan((8, 10, 10), 16, 2, decomp='z', levchunk=3)
+  P4 = BPlan((8, 10, 10), 16, 2, decomp='z', levchunk=4)
+  assert P3.nchunks_ == 3 and P3.nptchunk_ == 300 and P4.memory() > P3.memory()
+  assert P.level_chunk(P3.memory()) == 3
+  assert P.level_chunk(1000) is None
+
+
+def test_suggest_fits():
+  # Ring exchange memory falls with task count:
+  P = BPlan((4, 64, 64), 32, 1, exchange='ring')
+  for ppn in [1, 4]:
+    for budget in [P.memory(64)//3, P.memory(64)//10]:
+      (tile, nprocs) = P.suggest(budget, ppn)
+      assert nprocs % ppn == 0 and P.fits(nprocs, budget)
+      assert nprocs == ppn or not P.fits(nprocs - ppn, budget)
+      assert tile is None or P.memory(tile) <= budget
+  (tile, nprocs) = P.suggest(P.memory(256))
+  assert tile == 256 and nprocs == 1
+  assert P.suggest(1000, maxprocs=64) == (None, None)
+
+
+@pytest.mark.parametrize("exchange", ["allgather", "ring"])
+@pytest.mark.parametrize("backend", ["mpi", "local"])
+def test_tools_buffers(request, backend, exchange):
+  # Receive buffers of a run are as planned; the local backend holds
+  # slabs of all tasks, in shared memory, in either exchange mode:
+  if backend == "mpi":
+    pytest.importorskip("mpi4py")
+  comm = request.getfixturevalue("local_comm") if backend == "local" else None
+  rng  = np.random.default_rng(0)
+  N    = rng.standard_normal((16, 640)).astype(np.float32)
+  A    = BAnalyzer(comm, decfact=1, exchange=exchange)
+  A.analyze(N, 0.9, gdims=[1, 20, 32])
+  b    = buffers(BPlan((1, 20, 32), 16, 1, exchange=exchange, shared=(backend == "local")))
+  assert A.tools_.recvbuff_.nbytes == b["receive buffer"]
+  assert A.tools_.sdbuff_.nbytes == b["receive buffer, slab RMS"]
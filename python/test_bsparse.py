@@ -0,0 +1,76 @@
+################################################################
+#  Module: test_bsparse.py
+#  Desc  : Tests of BSparse CSR storage: entries written by one or
+#          more tasks are read back by BSparseReader
+#
+#          Usage:
+#            python -m pytest -q test_bsparse.py
+################################################################
+import os
+import numpy as np
+import pytest
+from   bsparse import BSparse, BSparseReader
+
+# Writer of random entries, each task writing every ntasks-th entry
+# (as tasks of the local launcher):
+WRITER = """
+import sys
+import numpy as np
+from   bcomm import MPI
+from   bsparse import BSparse
+sys.path.insert(0, sys.argv[1])
+from   test_bsparse import entries
+comm = MPI.COMM_WORLD
+(B, I, J, nrows) = entries()
+k = slice(comm.Get_rank(), None, comm.Get_size())
+BSparse.write(comm, B[k], I[k], J[k], nrows, "out", attrs={"threshold": 0.5})
+"""
+
+
+# Random entries (B, I, J) of a B-matrix of nrows rows, unsorted,
+# with some empty rows, and the number of rows:
+def entries(nrows=50, nnz=400, seed=3):
+  rng = np.random.default_rng(seed)
+  ij  = rng.choice(nrows*nrows, nnz, replace=False)
+  (I, J) = np.divmod(ij, nrows)
+  keep   = (I % 7) != 3
+  return rng.standard_normal(nnz)[keep].astype(np.float32), I[keep], J[keep], nrows
+
+
+# Check entries read back against those written:
+def check(prefix, nfiles):
+  (B, I, J, nrows) = entries()
+  o = np.lexsort((J, I))
+  R = BSparseReader(prefix)
+  assert R.nrows_ == nrows and R.nnz_ == len(B) and len(R.files_) == nfiles
+  assert R.index_["attrs"] == {"threshold": 0.5}
+
+  (I1, J1, B1) = R.rows(0, nrows)
+  assert np.array_equal(I1, I[o]) and np.array_equal(J1, J[o]) and np.array_equal(B1, B[o])
+  assert np.array_equal(R.row_counts(), np.bincount(I, minlength=nrows))
+  for i in [0, 3, 17, nrows-1]:
+    (Ji, Bi) = R.row(i)
+    assert np.array_equal(Ji, J[o][I[o] == i]) and np.array_equal(Bi, B[o][I[o] == i])
+
+  # A range of rows across files:
+  (I1, J1, B1) = R.rows(12, 38)
+  k = (I[o] >= 12) & (I[o] < 38)
+  assert np.array_equal(I1, I[o][k]) and np.array_equal(J1, J[o][k])
+  assert len(R.rows(10, 10)[0]) == 0
+  R.close()
+
+
+def test_one_task(tmp_path, local_comm):
+  (B, I, J, nrows) = entries()
+  prefix = str(tmp_path / "out")
+  assert BSparse.write(local_comm, B, I, J, nrows, prefix, attrs={"threshold": 0.5}) \
+      == prefix + ".csr.json"
+  check(prefix, 1)
+
+
+@pytest.mark.parametrize("ntasks", [3, 4])
+def test_tasks(tmp_path, launch, ntasks):
+  script = tmp_path / "writer.py"
+  script.write_text(WRITER)
+  assert launch(ntasks, script, [os.path.dirname(os.path.abspath(__file__))], tmp_path) == 0
+  check(str(tmp_path / "out"), ntasks)
@@ -0,0 +1,177 @@
+################################################################
+#  Module: test_btools.py
+#  Desc  : Tests of BTools thresholding, on one task, of the MPI
+#          and local backends, against a brute-force B-matrix; of
+#          sampled estimates of ribbon statistics; of threshold
+#          sweeps against separate runs; and of streamed levels
+#
+#          Usage:
+#            python -m pytest -q test_btools.py
+################################################################
+import numpy as np
+import pytest
+from   banalyze import BAnalyzer
+
+
+# Smooth random ensemble anomalies, N(nens, npts), of a nz x ny x nx
+# grid:
+def smooth_ensemble(nens=16, nz=1, ny=12, nx=10, seed=1):
+  rng = np.random.default_rng(seed)
+  N   = rng.standard_normal((nens, nz, ny, nx)).cumsum(axis=3).cumsum(axis=2)
+  N  -= N.mean(axis=0)
+  return N.reshape(nens, -1).astype(np.float32), [nz, ny, nx]
+
+
+# Brute-force entries (B, I, J), as sorted by (I, J), of all pairs
+# with |corr| >= thresh, and pairs within tol of thresh:
+def reference(N, thresh, tol=1.0e-4):
+  A    = N.astype(np.float64)
+  sd   = np.sqrt((A*A).mean(axis=0))
+  C    = (A.T @ A) / A.shape[0]
+  corr = np.abs(C / np.outer(sd, sd))
+  (I, J) = np.nonzero(corr >= thresh)
+  near   = set(zip(*np.nonzero(np.abs(corr - thresh) < tol)))
+  return C[I, J], I, J, near
+
+
+# Brute-force ribbon widths (0: no entries), and entry counts, of
+# strict and loose thresholds, thresh +/- tol; widths & counts found
+# lie between them:
+def ref_widths(N, thresh, tol=1.0e-4):
+  A    = N.astype(np.float64)
+  sd   = np.sqrt((A*A).mean(axis=0))
+  corr = np.abs(((A.T @ A) / A.shape[0]) / np.outer(sd, sd))
+  res  = []
+  for t in [thresh + tol, thresh - tol]:
+    M = corr >= t
+    j = np.arange(M.shape[1])
+    W = np.where(M.any(axis=1), np.where(M, j, -1).max(axis=1) - np.where(M, j, M.shape[1]).min(axis=1), 0)
+    res.append((W, int(M.sum())))
+  return res
+
+
+# Check entries found against reference:
+def check(R, N, thresh):
+  (B, I, J, near) = reference(N, thresh)
+  got  = dict(zip(zip(R.I_.tolist(), R.J_.tolist()), R.B_.tolist()))
+  want = dict(zip(zip(I.tolist(), J.tolist()), B.tolist()))
+  assert len(got) == len(R.B_)                           # no duplicates
+  assert set(got) ^ set(want) <= near
+  for ij in set(got) & set(want):
+    assert got[ij] == pytest.approx(want[ij], rel=1.0e-4, abs=1.0e-6)
+
+
+# Entries (I, J) -> B of a result:
+def entries(R):
+  return dict(zip(zip(R.I_.tolist(), R.J_.tolist()), R.B_.tolist()))
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_out_of_core_blocks(tmp_path, symmetric):
+  (N, gdims) = smooth_ensemble(ny=20, nx=12)
+
+  # A window of a few tiles' data forces several blocks of points:
+  window = 2*3*16*N.shape[0]*4
+  A  = BAnalyzer(decfact=1, tilesz=16, symmetric=symmetric, scratch=str(tmp_path), window=window)
+  Rs = A.analyze(N, 0.6, gdims=gdims)
+  assert A.tools_.block_ == 48 and N.shape[1] > 2*A.tools_.block_
+  Ri = BAnalyzer(decfact=1, tilesz=16, symmetric=symmetric).analyze(N, 0.6, gdims=gdims)
+
+  assert entries(Rs) == entries(Ri)
+  assert np.array_equal(Rs.gwidths_[0], Ri.gwidths_[0])
+  check(Rs, N, 0.6)
+
+
+# Run settings compared with brute force:
+SETTINGS = [{}, {"symmetric": True}, {"nthreads": 3}, {"tilesz": 16}, {"exchange": "ring"},
+            {"decomp": "xyz"}, {"decomp": "points", "symmetric": True, "nthreads": 2}]
+
+
+# Communicator of a backend: None (MPI.COMM_WORLD, of mpi4py, if
+# installed), or local:
+def backend_comm(request, backend):
+  if backend == "mpi":
+    pytest.importorskip("mpi4py")
+    return None
+  return request.getfixturevalue("local_comm")
+
+
+@pytest.mark.parametrize("settings", SETTINGS)
+@pytest.mark.parametrize("backend", ["mpi", "local"])
+def test_brute_force(request, backend, settings):
+  (N, gdims) = smooth_ensemble(nz=2)
+  R = BAnalyzer(backend_comm(request, backend), decfact=1, **settings).analyze(N, 0.6, gdims=gdims)
+  check(R, N, 0.6)
+  ((Wlo, nlo), (Whi, nhi)) = ref_widths(N, 0.6)
+  assert nlo <= R.counts_[0] <= nhi
+  assert np.all(Wlo <= R.gwidths_[0]) and np.all(R.gwidths_[0] <= Whi)
+
+
+@pytest.mark.parametrize("backend", ["mpi", "local"])
+def test_widths_thresholds(request, backend):
+  # Widths only, and several thresholds at once:
+  (N, gdims) = smooth_ensemble(nz=2)
+  thresh = [0.5, 0.7, 0.9]
+  for settings in [{"widthsonly": True}, {"nthreads": 2}]:
+    t = thresh if "nthreads" in settings else thresh[1:2]
+    R = BAnalyzer(backend_comm(request, backend), decfact=1, **settings).analyze(N, t, gdims=gdims)
+    assert R.B_ is None
+    for it in range(0, len(t)):
+      ((Wlo, nlo), (Whi, nhi)) = ref_widths(N, t[it])
+      assert nlo <= R.counts_[it] <= nhi
+      assert np.all(Wlo <= R.gwidths_[it]) and np.all(R.gwidths_[it] <= Whi)
+
+
+def test_sample_all_rows():
+  # A sample of all rows gives exact statistics, with empty intervals:
+  (N, gdims) = smooth_ensemble(nz=2)
+  R = BAnalyzer(decfact=1).analyze(N, 0.6, gdims=gdims)
+  s = BAnalyzer(decfact=1, sample=1.0).analyze(N, 0.6, gdims=gdims).samples_[0]
+  assert s["nsample"] == s["nrows"] == N.shape[1]
+  assert (s["maxWidth"], s["irowmax"]) == (R.maxWidth_[0], R.irowmax_[0])
+  assert s["avgWidth"] == pytest.approx(R.avgWidth_[0]) and s["count"] == pytest.approx(R.counts_[0])
+  assert s["avgWidth1"] == pytest.approx(R.avgWidth1_[0])
+  for ci in ["avgWidthCI", "avgWidth1CI", "countCI"]:
+    assert s[ci][0] == pytest.approx(s[ci][1])
+
+
+def test_sample_intervals():
+  # Intervals of most samples cover the exact statistics:
+  (N, gdims) = smooth_ensemble(ny=30, nx=20)
+  R = BAnalyzer(decfact=1).analyze(N, 0.6, gdims=gdims)
+  nseed = 40
+  cover = {"avgWidthCI": 0, "countCI": 0}
+  for seed in range(0, nseed):
+    s = BAnalyzer(decfact=1, sample=0.2, seed=seed).analyze(N, 0.6, gdims=gdims).samples_[0]
+    assert s["nsample"] == 120 and s["level"] == 0.95
+    assert s["maxWidth"] <= R.maxWidth_[0] and s["avgWidthCI"][0] <= s["avgWidth"] <= s["avgWidthCI"][1]
+    cover["avgWidthCI"] += s["avgWidthCI"][0] <= R.avgWidth_[0] <= s["avgWidthCI"][1]
+    cover["countCI"]    += s["countCI"][0] <= R.counts_[0] <= s["countCI"][1]
+  assert cover["avgWidthCI"] >= 0.8*nseed and cover["countCI"] >= 0.8*nseed
+
+
+@pytest.mark.parametrize("settings", [{}, {"symmetric": True, "nthreads": 2}])
+def test_sweep_equals_runs(settings):
+  # A sweep of thresholds gives the widths & counts of separate runs:
+  (N, gdims) = smooth_ensemble(nz=2)
+  thresh = [0.5, 0.7, 0.9]
+  R = BAnalyzer(decfact=1, **settings).analyze(N, thresh, gdims=gdims)
+  for it in range(0, len(thresh)):
+    Rt = BAnalyzer(decfact=1, widthsonly=True, **settings).analyze(N, thresh[it], gdims=gdims)
+    assert R.counts_[it] == Rt.counts_[0] and np.array_equal(R.gwidths_[it], Rt.gwidths_[0])
+    assert (R.maxWidth_[it], R.irowmax_[it]) == (Rt.maxWidth_[0], Rt.irowmax_[0])
+
+
+@pytest.mark.parametrize("settings", [{"decomp": "x"}, {"decomp": "z", "nthreads": 2}, {"widthsonly": True}])
+def test_streamed_levels(settings):
+  # Levels read a chunk at a time give the entries of all at once:
+  (N, gdims) = smooth_ensemble(nz=3, ny=8, nx=7)
+  L      = N.reshape(N.shape[0], gdims[0], -1)
+  reader = lambda kb, ke: np.ascontiguousarray(L[:,kb:ke+1]).reshape(-1)
+  R  = BAnalyzer(decfact=1, **settings).analyze(N, 0.6, gdims=gdims)
+  A  = BAnalyzer(decfact=1, levchunk=1, **settings)
+  Rs = A.analyze((reader, N.shape[0], gdims), 0.6)
+  assert len(A.tools_.chunks_) == 3
+  assert Rs.counts_[0] == R.counts_[0] and np.array_equal(Rs.gwidths_[0], R.gwidths_[0])
+  if R.B_ is not None:
+    assert entries(Rs) == entries(R)